@@ -32,7 +32,13 @@ if not munge_path():
     munge_path()
 
 
-from shapely import speedups
+from tools import daemon
+
+# If the daemon is running then let it run the command
+status = daemon.run_client(sys.argv[1:])
+if status is not None:
+    sys.exit(status)
+
 from tools import (
     case,
     infofile,
@@ -42,6 +48,7 @@ from tools import (
     targets,
     tidy,
     test,
+    watch,
 )
 
 
@@ -65,7 +72,7 @@ def list_cases():
     return _list_targets(case.Case)
 
 
-def _do_build(label, cls, args, argattr):
+def _do_build(label, cls, args, argattr, **kwargs):
     if getattr(args, argattr):
         to_build = [targets.Targets.get(name)
                     for name in getattr(args, argattr)]
@@ -79,12 +86,18 @@ def _do_build(label, cls, args, argattr):
     else:
         to_build = _list_targets(cls)
 
+    if args.watch:
+        watch.watch([f.full_name for f in to_build],
+                    lambda f: f.build(**kwargs))
+        return
+
     for f in to_build:
-        f.build()
+        f.build(**kwargs)
 
 
 def do_build(args):
-    return _do_build('firmware', firmware.Firmware, args, 'firmware')
+    return _do_build('firmware', firmware.Firmware, args, 'firmware',
+                     jobs=args.jobs)
 
 
 def do_upload(args):
@@ -96,11 +109,21 @@ def do_upload(args):
     f.upload(args.port)
 
 
+def enable_speedups():
+    ''' shapely is slow to import, so we only do this for the
+        subcommands that use it '''
+    from shapely import speedups
+    if speedups.available:
+        speedups.enable()
+
+
 def do_genpcb(args):
+    enable_speedups()
     return _do_build('pcb', pcb.Pcb, args, 'pcb')
 
 
 def do_gencase(args):
+    enable_speedups()
     return _do_build('case', case.Case, args, 'case')
 
 
@@ -131,11 +154,18 @@ def do_tests(args):
         to_build = list_tests()
 
     for f in to_build:
-        f.build()
+        f.build(jobs=args.jobs)
         f.run_tests()
 
 
+def do_daemon(args):
+    daemon.Daemon('src', run).serve()
+
+
 def do_clean(args):
+    # The daemon keeps its socket in the outputs dir
+    if daemon.stop():
+        print('Stopped the clacker daemon')
     outputs = os.path.join(projectdir.Root, 'outputs')
     shutil.rmtree(outputs)
 
@@ -159,6 +189,12 @@ build_parser = subparsers.add_parser('build', help='Build firmware',
     ''')
 build_parser.add_argument(
     'firmware', help='which firmware to build', nargs='*')
+build_parser.add_argument(
+    '-j', '--jobs', type=int,
+    help='how many compiles to run at once (default: one per cpu)')
+build_parser.add_argument(
+    '--watch', action='store_true',
+    help='rebuild the firmware whenever its source files change')
 build_parser.set_defaults(func=do_build)
 
 upload_parser = subparsers.add_parser('upload',
@@ -207,6 +243,9 @@ run_test_parser = subparsers.add_parser('test', help='Run tests',
     ''')
 run_test_parser.add_argument(
     'test', help='which tests to build and run', nargs='*')
+run_test_parser.add_argument(
+    '-j', '--jobs', type=int,
+    help='how many compiles to run at once (default: one per cpu)')
 run_test_parser.set_defaults(func=do_tests)
 
 setup_parser = subparsers.add_parser('setup', help='Setup clacker',
@@ -233,6 +272,9 @@ genpcb_parser = subparsers.add_parser('gen-pcb', help='Generate PCB',
     ''')
 genpcb_parser.add_argument(
     'pcb', help='which pcb to generate', nargs='*')
+genpcb_parser.add_argument(
+    '--watch', action='store_true',
+    help='generate the pcb again whenever its layout changes')
 genpcb_parser.set_defaults(func=do_genpcb)
 
 
@@ -245,11 +287,27 @@ gencase_parser = subparsers.add_parser('gen-case', help='Generate case',
     ''')
 gencase_parser.add_argument(
     'case', help='which case to generate', nargs='*')
+gencase_parser.add_argument(
+    '--watch', action='store_true',
+    help='generate the case again whenever its layout changes')
 gencase_parser.set_defaults(func=do_gencase)
 
-if speedups.available:
-    speedups.enable()
+daemon_parser = subparsers.add_parser('daemon',
+                                      help='Run the build daemon',
+                                      description='''
+    Loads the info files and then stays resident, running the build,
+    upload, test, list and gen commands of other invocations of
+    clacker.py in the same directory so that they start quickly.
+    The info files are loaded again when they or the keyboard layouts
+    change.
+    ''')
+daemon_parser.set_defaults(func=do_daemon)
+
+
+def run(argv):
+    args = parser.parse_args(argv)
+    if hasattr(args, 'func'):
+        args.func(args)
+
 
-args = parser.parse_args()
-if hasattr(args, 'func'):
-    args.func(args)
+run(sys.argv[1:])
@@ -0,0 +1,86 @@
+''' Tests that the daemon is still free for the next client after one
+    goes away in the middle of its command. '''
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import textwrap
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs a daemon whose build command either blocks, like an upload waiting
+# for its device, or prints its args
+SERVER = textwrap.dedent('''
+    import sys
+    import time
+    sys.path.insert(0, %r)
+    from tools import daemon
+
+    class Daemon(daemon.Daemon):
+        def _stat_inputs(self):
+            return {}
+
+    def run(argv):
+        if argv[1] == 'block':
+            print('blocking')
+            sys.stdout.flush()
+            while True:
+                time.sleep(1)
+        print('built', argv[1])
+
+    Daemon('src', run).serve()
+''' % ROOT)
+
+CLIENT = textwrap.dedent('''
+    import sys
+    sys.path.insert(0, %r)
+    from tools import daemon
+    sys.exit(daemon.run_client(sys.argv[1:]))
+''' % ROOT)
+
+
+def _wait_for(predicate, timeout=10):
+    end = time.time() + timeout
+    while not predicate():
+        assert time.time() < end
+        time.sleep(0.05)
+
+
+def test_client_hangup_frees_the_daemon(tmp_path):
+    socket_path = tmp_path / 'outputs' / '.clacker-daemon'
+    server = subprocess.Popen([sys.executable, '-c', SERVER],
+                              cwd=str(tmp_path), stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+    try:
+        _wait_for(socket_path.exists)
+
+        blocked = subprocess.Popen(
+            [sys.executable, '-c', CLIENT, 'build', 'block'],
+            cwd=str(tmp_path), stdout=subprocess.PIPE)
+        assert blocked.stdout.readline() == b'blocking\n'
+        blocked.kill()
+        blocked.wait()
+        blocked.stdout.close()
+
+        client = subprocess.run(
+            [sys.executable, '-c', CLIENT, 'build', 'ok'],
+            cwd=str(tmp_path), stdout=subprocess.PIPE, timeout=10)
+        assert client.returncode == 0
+        assert client.stdout == b'built ok\n'
+
+        stopper = subprocess.run(
+            [sys.executable, '-c', 'import sys; sys.path.insert(0, %r); '
+             'from tools import daemon; daemon.stop()' % ROOT],
+            cwd=str(tmp_path), timeout=10)
+        assert stopper.returncode == 0
+        server.wait(timeout=10)
+        assert not socket_path.exists()
+        assert b'Interrupted build block' in server.stdout.read()
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+        server.stdout.close()
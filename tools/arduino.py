@@ -2,10 +2,18 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import glob
+import json
 import re
 import os
 import subprocess
 
+from . import filesystem
+
+PREFS_FILE = os.path.join('outputs', 'arduinoprefs.txt')
+BOARD_PREFS_DIR = os.path.join('outputs', 'boardprefs')
+
+_PREF_REF = re.compile('\\{([a-zA-Z0-9_._+-]+)\\}')
+
 
 def find_arduino_exe():
     ''' Find the arduino executable '''
@@ -42,9 +50,11 @@ class Arduino(object):
         if not self.home_arduino:
             raise Exception("did not find arduino!")
         self.prefs = self.load_prefs()
+        self._board_prefs = {}
+        self._templates = {}
 
     def load_prefs(self):
-        prefs = os.path.join('outputs', 'arduinoprefs.txt')
+        prefs = PREFS_FILE
         if not os.path.isfile(prefs):
             if not os.path.isdir('outputs'):
                 os.mkdir('outputs')
@@ -63,8 +73,41 @@ class Arduino(object):
     def board_prefs(self, fqbn):
         ''' Given a FQBN, load the builder prefs.  This provides information
             needed to figure out how to compile and flash a project to the
-            device '''
-
+            device.
+            Loading them runs arduino-builder, so they are remembered for
+            each fqbn and saved in BOARD_PREFS_DIR, keyed by the IDE version
+            and the mtime of our prefs file.  Returns a new dict each
+            time, as the callers modify it. '''
+        if fqbn not in self._board_prefs:
+            key = {
+                'fqbn': fqbn,
+                'ide_version': self.prefs.get('runtime.ide.version'),
+                'prefs_mtime': os.stat(PREFS_FILE).st_mtime,
+            }
+            filename = os.path.join(
+                BOARD_PREFS_DIR, re.sub('[^a-zA-Z0-9_.-]', '_', fqbn) + '.json')
+
+            prefs = None
+            try:
+                with open(filename, 'r') as f:
+                    saved = json.load(f)
+                if saved['key'] == key:
+                    prefs = saved['prefs']
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+
+            if prefs is None:
+                prefs = self._dump_board_prefs(fqbn)
+                filesystem.mkdir_p(BOARD_PREFS_DIR)
+                with open(filename, 'w') as f:
+                    json.dump({'key': key, 'prefs': prefs}, f)
+
+            self._board_prefs[fqbn] = prefs
+
+        return dict(self._board_prefs[fqbn])
+
+    def _dump_board_prefs(self, fqbn):
+        ''' Runs arduino-builder to get the prefs for fqbn '''
         packages = os.path.join(self.home_arduino, 'packages')
         if not os.path.isdir(packages):
             packages = None
@@ -109,13 +152,24 @@ class Arduino(object):
                 prefs[cols[0]] = cols[1]
         return prefs
 
+    def _template(self, value):
+        ''' Splits a pref value into a list of alternating literal text
+            and the names of the prefs that it interpolates.  This is
+            remembered for each distinct value, so the recipes are only
+            parsed once. '''
+        template = self._templates.get(value)
+        if template is None:
+            template = _PREF_REF.split(value)
+            self._templates[value] = template
+        return template
+
     def resolve_pref(self, key, prefs=None):
         ''' Evaluate a pref value, expanding interpolated keys '''
 
         prefs = prefs or self.prefs
-        value = prefs[key]
-        r = re.compile('\\{([a-zA-Z0-9_._+-]+)\\}')
 
+        # Interpolated names that aren't prefs themselves are looked up
+        # relative to each of the prefixes of key
         path = []
         for ele in key.split('.'):
             if path:
@@ -123,39 +177,41 @@ class Arduino(object):
             else:
                 path.append(ele)
 
-        while True:
-            before = value
-
-            m = r.search(value)
-            if not m:
+        def lookup(name, value):
+            if name in prefs:
+                return name
+            for ele in path:
+                k = '%s.%s' % (ele, name)
+                if k in prefs:
+                    return k
+            import pprint
+            pprint.pprint(prefs)
+            raise Exception(
+                'could not resolve prefs from %s (key %s)' % (value, name))
+
+        def expand(value, active):
+            template = self._template(value)
+            if len(template) == 1:
                 return value
-
-            key = m.group(1)
-            if key not in prefs:
-                # search configuration path
-                key = None
-                for ele in path:
-                    k = '%s.%s' % (ele, m.group(1))
-                    if k in prefs:
-                        key = k
-                        break
-                if not key:
-                    import pprint
-                    pprint.pprint(prefs)
-                    raise Exception(
-                        'could not resolve prefs from %s (key %s)' % (value, m.group(1)))
-
-            value = value.replace(m.group(0), prefs[key])
-
-            if value == before:
-                break
-        return value
+            result = []
+            for i, part in enumerate(template):
+                if i % 2 == 0:
+                    result.append(part)
+                    continue
+                name = lookup(part, value)
+                if name in active:
+                    # A pref that refers to itself; leave it be
+                    result.append('{%s}' % part)
+                    continue
+                result.append(expand(prefs[name], active | {name}))
+            return ''.join(result)
+
+        return expand(prefs[key], frozenset([key]))
 
 
 def clear_prefs():
-    prefs = os.path.join('outputs', 'arduinoprefs.txt')
     try:
-        os.unlink(prefs)
+        os.unlink(PREFS_FILE)
     except:
         pass
 
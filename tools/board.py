@@ -1,24 +1,25 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from pprint import pprint
 from glob import glob
 import os
 import re
 import subprocess
 import shlex
 import time
-import serial
 import sys
 
 from . import arduino
 from . import library
+from . import objcache
 from . import projectdir
+from . import scheduler
 
 
 def reset_arduino_on_port(port):
     ''' try to persuade the device to jump to the bootloader
         (this doesn't seem to work with all hardware) '''
+    import serial
     ser = serial.Serial(port, 1200)
     ser.close()
     # If we got here, then we need to give the firmware a few
@@ -48,24 +49,57 @@ def _cmd_split(args):
 class Board(object):
     ''' Defines a board that we can deploy code to '''
 
+    def compile_command(self, srcfile, objfile, depfile=None, cppflags=None):
+        ''' returns the command that compiles srcfile into objfile.
+            The command also writes the deps into depfile. '''
+        raise NotImplementedError()
+
     def compile_src(self, srcfile, objfile, depfile=None, cppflags=None):
         ''' compile srcfile and store the result into objfile.
-            Optionally compute and store deps into depfile. '''
+            Optionally compute and store deps into depfile.
+            The object may come from the object cache instead. '''
+        objcache.get().compile(self.compile_command(srcfile, objfile,
+                                                    depfile, cppflags),
+                               objfile, depfile, srcfile)
+
+    def link_exe_commands(self, exefile, objfiles):
+        ''' returns the list of the commands that link a set of objects
+            and libraries together into exefile '''
         raise NotImplementedError()
 
     def link_exe(self, exefile, objfiles):
         ''' link a set of objects and libraries together and store
             the result into exefile '''
+        for cmd in self.link_exe_commands(exefile, objfiles):
+            scheduler.check_call(cmd)
+
+    def link_lib_commands(self, libfile, objfiles):
+        ''' returns the list of the commands that link a set of objects
+            together into libfile '''
         raise NotImplementedError()
 
     def link_lib(self, libfile, objfiles):
         ''' link a set of objects together and store
             the result into libfile '''
+
+        # Remove the library first, as we may have removed an input
+        # object file and we don't want to allow that to mess with
+        # linking later on
+        if os.path.exists(libfile):
+            os.unlink(libfile)
+
+        for cmd in self.link_lib_commands(libfile, objfiles):
+            scheduler.check_call(cmd)
+
+    def exe_to_hex_commands(self, exefile, hexfile):
+        ''' returns the list of the commands that transform an
+            executable into a hex image '''
         raise NotImplementedError()
 
     def exe_to_hex(self, exefile, hexfile):
         ''' transform an executable into a hex image '''
-        raise NotImplementedError()
+        for cmd in self.exe_to_hex_commands(exefile, hexfile):
+            scheduler.check_call(cmd)
 
     def injected_deps(self):
         ''' If the board has some core libraries that must be implicitly
@@ -84,28 +118,28 @@ class HostCompiler(Board):
     def __init__(self):
         self.fqbn = 'host'
 
-    def compile_src(self, srcfile, objfile, depfile=None, cppflags=None):
+    def compile_command(self, srcfile, objfile, depfile=None, cppflags=None):
         cppflags = _cmd_split(cppflags or '')
         cppflags.append('-D__CLACKER_HOST_BOARD')
         if srcfile.endswith('.cpp'):
-            subprocess.check_call(
-                ['g++', '-g', '-c', '-std=c++11', '-MMD', '-o', objfile, srcfile] + cppflags)
-        else:
-            subprocess.check_call(
-                ['gcc', '-g', '-c', '-MMD', '-o', objfile, srcfile] + cppflags)
+            return ['g++', '-g', '-c', '-std=c++11', '-MMD', '-o', objfile, srcfile] + cppflags
+        return ['gcc', '-g', '-c', '-MMD', '-o', objfile, srcfile] + cppflags
 
-    def link_exe(self, exefile, objfiles):
+    def link_exe_commands(self, exefile, objfiles):
         cmd = ['g++', '-o', exefile] + objfiles
         if sys.platform.startswith('linux'):
             cmd += ['-pthread']
-        subprocess.check_call(cmd)
-        print('OK: %s' % exefile)
+        return [cmd]
 
-    def link_lib(self, libfile, objfiles):
-        subprocess.check_call(['ar', 'rcs', libfile] + objfiles)
+    def link_exe(self, exefile, objfiles):
+        super(HostCompiler, self).link_exe(exefile, objfiles)
+        scheduler.log('OK: %s' % exefile)
 
-    def exe_to_hex(self, exefile, hexfile):
-        pass
+    def link_lib_commands(self, libfile, objfiles):
+        return [['ar', 'rcs', libfile] + objfiles]
+
+    def exe_to_hex_commands(self, exefile, hexfile):
+        return []
 
 
 class FQBN(Board):
@@ -114,14 +148,23 @@ class FQBN(Board):
     def __init__(self, fqbn, prefs=None):
         self.fqbn = fqbn
         self.prefs = prefs or {}
+        self._resolved_prefs = None
+
+    def _board_prefs(self):
+        ''' Returns a copy of the builder prefs for the board with our
+            own prefs applied. '''
+        if self._resolved_prefs is None:
+            prefs = arduino.get().board_prefs(self.fqbn)
+            prefs.update(self.prefs)
+            self._resolved_prefs = prefs
+        return dict(self._resolved_prefs)
 
     def injected_deps(self):
         ''' Inject the core and variant libraries as dependencies when
             we compile with this board '''
         a = arduino.get()
 
-        prefs = a.board_prefs(self.fqbn)
-        prefs.update(self.prefs)
+        prefs = self._board_prefs()
 
         srcs = []
 
@@ -148,11 +191,10 @@ class FQBN(Board):
 
         return libs
 
-    def compile_src(self, srcfile, objfile, depfile=None, cppflags=None):
+    def compile_command(self, srcfile, objfile, depfile=None, cppflags=None):
         a = arduino.get()
 
-        prefs = a.board_prefs(self.fqbn)
-        prefs.update(self.prefs)
+        prefs = self._board_prefs()
 
         flags = [cppflags or '']
         core_path = a.resolve_pref('build.core.path', prefs)
@@ -170,25 +212,13 @@ class FQBN(Board):
         if ext == '.s':
             ext = '.S'
 
-        cmd = _cmd_split(a.resolve_pref(
+        return _cmd_split(a.resolve_pref(
             'recipe%s.o.pattern' % ext, prefs))
-        # print(cmd)
-        subprocess.check_call(cmd)
-
-    def link_lib(self, libfile, objfiles):
-        ''' link a set of objects together and store
-            the result into libfile '''
-
-        # Remove the library first, as we may have removed an input
-        # object file and we don't want to allow that to mess with
-        # linking later on
-        if os.path.exists(libfile):
-            os.unlink(libfile)
 
+    def link_lib_commands(self, libfile, objfiles):
         a = arduino.get()
 
-        prefs = a.board_prefs(self.fqbn)
-        prefs.update(self.prefs)
+        prefs = self._board_prefs()
         # pprint(prefs)
         build_dir = os.path.dirname(libfile)
         prefs['build.path'] = build_dir
@@ -199,41 +229,55 @@ class FQBN(Board):
         prefs['recipe.ar.pattern'] = prefs['recipe.ar.pattern'].replace(
             '{build.path}/core/{archive_file}', '{archive_file_path}')
 
+        cmds = []
         for obj in objfiles:
             prefs['object_file'] = obj
-            cmd = _cmd_split(a.resolve_pref(
-                'recipe.ar.pattern', prefs))
-            # pprint(cmd)
-            subprocess.check_call(cmd)
+            cmds.append(_cmd_split(a.resolve_pref(
+                'recipe.ar.pattern', prefs)))
+        return cmds
 
-    def link_exe(self, exefile, objfiles):
+    def link_exe_commands(self, exefile, objfiles):
         a = arduino.get()
         # The recipe adds .elf, so avoid doubling up
         exefile, _ = os.path.splitext(exefile)
 
-        prefs = a.board_prefs(self.fqbn)
-        prefs.update(self.prefs)
+        prefs = self._board_prefs()
         build_dir = os.path.dirname(exefile)
         prefs['build.path'] = build_dir
         prefs['build.project_name'] = os.path.basename(exefile)
         prefs['archive_file'] = os.path.relpath(objfiles[-1], build_dir)
         prefs['object_files'] = ' '.join(objfiles[0:-1])
 
-        cmd = _cmd_split(a.resolve_pref(
-            'recipe.c.combine.pattern', prefs))
-        # pprint(cmd)
-        subprocess.check_call(cmd)
+        return [_cmd_split(a.resolve_pref(
+            'recipe.c.combine.pattern', prefs))]
 
-    def exe_to_hex(self, exefile, hexfile):
-        a = arduino.get()
+    def _exe_prefs(self, exefile):
         # The recipe adds .elf, so avoid doubling up
         exefile, _ = os.path.splitext(exefile)
 
-        prefs = a.board_prefs(self.fqbn)
-        prefs.update(self.prefs)
+        prefs = self._board_prefs()
         build_dir = os.path.dirname(exefile)
         prefs['build.path'] = build_dir
         prefs['build.project_name'] = os.path.basename(exefile)
+        return prefs
+
+    def exe_to_hex_commands(self, exefile, hexfile):
+        a = arduino.get()
+        prefs = self._exe_prefs(exefile)
+
+        # Not every platform has all of these
+        cmds = []
+        for obj in ('hex', 'bin', 'zip'):
+            try:
+                cmds.append(_cmd_split(a.resolve_pref(
+                    'recipe.objcopy.%s.pattern' % obj, prefs)))
+            except:
+                pass
+        return cmds
+
+    def exe_to_hex(self, exefile, hexfile):
+        a = arduino.get()
+        prefs = self._exe_prefs(exefile)
 
         def size():
             cmd = a.resolve_pref('recipe.size.pattern', prefs)
@@ -265,20 +309,19 @@ class FQBN(Board):
             except:
                 return None
 
-        for obj in ('hex', 'bin', 'zip'):
+        for cmd in self.exe_to_hex_commands(exefile, hexfile):
             try:
-                cmd = _cmd_split(a.resolve_pref(
-                    'recipe.objcopy.%s.pattern' % obj, prefs))
-                subprocess.check_call(cmd)
+                scheduler.check_call(cmd)
             except:
                 pass
 
-        print('%s: %r' % (hexfile, size()))
+        scheduler.log('%s: %r' % (hexfile, size()))
 
     def upload(self, hexfile, port=None):
+        from pprint import pprint
+
         a = arduino.get()
-        prefs = a.board_prefs(self.fqbn)
-        prefs.update(self.prefs)
+        prefs = self._board_prefs()
         build_dir = os.path.dirname(hexfile)
 
         # The recipe adds .hex, so avoid doubling up
@@ -370,7 +413,7 @@ class AVRBoard(Board):
         self.clock = clock
         self.fqbn = 'avr-libc:%s:%s' % (mcu, clock)
 
-    def compile_src(self, srcfile, objfile, depfile=None, cppflags=None):
+    def compile_command(self, srcfile, objfile, depfile=None, cppflags=None):
         cppflags = [
             '-g',
             '-c',
@@ -388,26 +431,23 @@ class AVRBoard(Board):
                 '-fno-exceptions',
                 '-fno-threadsafe-statics',
             ] + cppflags
-            subprocess.check_call(
-                ['avr-g++'] + cppflags + ['-o', objfile, srcfile])
-        else:
-            cppflags = [
-                '-std=gnu11',
-            ] + cppflags
-            subprocess.check_call(
-                ['avr-gcc'] + cppflags + ['-o', objfile, srcfile])
+            return ['avr-g++'] + cppflags + ['-o', objfile, srcfile]
 
-    def link_lib(self, libfile, objfiles):
-        subprocess.check_call(['avr-ar', 'rcs', libfile] + objfiles)
+        cppflags = [
+            '-std=gnu11',
+        ] + cppflags
+        return ['avr-gcc'] + cppflags + ['-o', objfile, srcfile]
 
-    def link_exe(self, exefile, objfiles):
-        subprocess.check_call(['avr-g++', '-Os', '-mmcu=%s' %
-                               self.mcu, '-Wl,--gc-sections', '-o', exefile] + objfiles)
-        subprocess.check_call(['avr-size', exefile])
+    def link_lib_commands(self, libfile, objfiles):
+        return [['avr-ar', 'rcs', libfile] + objfiles]
 
-    def exe_to_hex(self, exefile, hexfile):
-        subprocess.check_call(
-            ['avr-objcopy', '-O', 'ihex', '-R', '.eeprom', exefile, hexfile])
+    def link_exe_commands(self, exefile, objfiles):
+        return [['avr-g++', '-Os', '-mmcu=%s' %
+                 self.mcu, '-Wl,--gc-sections', '-o', exefile] + objfiles,
+                ['avr-size', exefile]]
+
+    def exe_to_hex_commands(self, exefile, hexfile):
+        return [['avr-objcopy', '-O', 'ihex', '-R', '.eeprom', exefile, hexfile]]
 
     def upload(self, hexfile, port=None):
         cmd = [
@@ -0,0 +1,188 @@
+''' A persistent record of how each output file was built.
+
+    This is similar to the .ninja_log and .ninja_deps files that ninja
+    keeps.  For each object we record the command line that built it,
+    the files that it depends on (from the depfile written by the
+    compiler) and the content hashes of those files at the time.  The
+    libraries, executables and hex images are recorded in the same way,
+    with their ordered list of inputs as the dependencies.
+    An output is out of date if it is missing, was built with a different
+    command line or any of its dependencies have different contents.
+
+    The hash of each file is stored along with the mtime and size that
+    it had when it was hashed, so we only need to read a file again if
+    its stat info has changed; switching branches with git changes the
+    mtimes but not usually the contents.  The files are only stat'ed
+    once per invocation, however many objects depend on them.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+from . import filesystem
+
+LOG_VERSION = 1
+
+
+def parse_depfile(depfile):
+    ''' Returns the list of the dependencies from a makefile compatible
+        dependency file, or None if it doesn't exist '''
+    try:
+        with open(depfile, 'r') as f:
+            blob = f.read()
+    except (IOError, OSError):
+        return None
+    blob = blob.replace('\\', ' ')
+    words = re.sub(r'\s+', ' ', blob).strip().split(' ')
+    # The first word is our own object, the rest are the deps.  Skip any
+    # phony targets for the headers, as generated by -MP
+    deps = [w for w in words[1:] if w and not w.endswith(':')]
+    return deps
+
+
+class BuildLog(object):
+    ''' Loads and saves the log from filename.  record() may be called
+        from multiple threads. '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._hashes = {}
+        self._dirty = False
+        self.files = {}
+        self.objects = {}
+
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == LOG_VERSION:
+                self.files = data['files']
+                self.objects = data['objects']
+        except (IOError, OSError, ValueError):
+            pass
+
+    def forget_stats(self):
+        ''' Forgets the stat info and hashes of the files, so that a
+            log that is used for more than one build sees the changes
+            made in between '''
+        self._stats = {}
+        self._hashes = {}
+
+    def _stat(self, path):
+        ''' (mtime_ns, size) of path, or None if it doesn't exist.
+            This is cached for the life of the log, so it must only be
+            used for the inputs of the build. '''
+        if path not in self._stats:
+            try:
+                st = os.stat(path)
+                self._stats[path] = [st.st_mtime_ns, st.st_size]
+            except OSError:
+                self._stats[path] = None
+        return self._stats[path]
+
+    def _hash(self, path):
+        ''' The sha1 of the contents of path, or None if it doesn't exist.
+            We avoid reading the file when its stat info matches that of
+            the last time that we hashed it. '''
+        if path in self._hashes:
+            return self._hashes[path]
+
+        stat = self._stat(path)
+        digest = None
+        if stat is not None:
+            known = self.files.get(path)
+            if known is not None and known[:2] == stat:
+                digest = known[2]
+            else:
+                h = hashlib.sha1()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), b''):
+                        h.update(chunk)
+                digest = h.hexdigest()
+                with self._lock:
+                    self.files[path] = stat + [digest]
+                    self._dirty = True
+        self._hashes[path] = digest
+        return digest
+
+    def needs_build(self, output, command, deps=None):
+        ''' Returns True if output needs to be built with command.
+            If deps is given, it is the list of the inputs of the
+            command, and output also needs to be built if those aren't
+            the inputs that it was last built from. '''
+        entry = self.objects.get(output)
+        if entry is None or entry['command'] != command:
+            return True
+        if deps is not None and entry['deps'] != deps:
+            return True
+        if not os.path.exists(output):
+            return True
+        for dep, digest in zip(entry['deps'], entry['hashes']):
+            if self._hash(dep) != digest:
+                return True
+        return False
+
+    def deps_under(self, dir):
+        ''' Returns the set of the source files that the outputs that
+            were built under dir depend on '''
+        prefix = os.path.join(dir, '')
+        deps = set()
+        for output, entry in self.objects.items():
+            if output.startswith(prefix):
+                deps.update(d for d in entry['deps']
+                            if d not in self.objects)
+        return deps
+
+    def record(self, objfile, command, depfile, srcfile):
+        ''' Records that objfile was just built from srcfile by command,
+            which wrote its dependencies to depfile. '''
+        self.record_step(objfile, command, parse_depfile(depfile) or [srcfile])
+
+    def record_step(self, output, command, deps):
+        ''' Records that output was just built by command from the
+            list of files deps. '''
+        # If we hashed a dependency before the build then we keep that
+        # hash; should it have changed since, we'll build again next time
+        hashes = [self._hash(dep) for dep in deps]
+        with self._lock:
+            self.objects[output] = {
+                'command': command,
+                'deps': list(deps),
+                'hashes': hashes,
+            }
+            self._dirty = True
+
+    def save(self):
+        ''' Writes out the log if it has changed '''
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({
+                'version': LOG_VERSION,
+                'files': self.files,
+                'objects': self.objects,
+            }, sort_keys=True)
+            self._dirty = False
+
+        filesystem.mkdir_p(os.path.dirname(self.filename))
+        tmp = '%s.tmp%d' % (self.filename, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, self.filename)
+
+
+log = None
+
+
+def get():
+    ''' Returns the log for this invocation '''
+    global log
+    if not log:
+        log = BuildLog(os.path.join('outputs', '.build_log'))
+    return log
@@ -3,16 +3,14 @@ from __future__ import print_function
 
 import os
 import subprocess
-from shapely.affinity import (translate, scale, rotate)
-from shapely.geometry import (Point, box)
-from shapely.ops import unary_union
 from . import targets
 from . import filesystem
-from .circuitlib import shape
-from . import svg
-from . import matrix
 from . import openscad
 
+# The geometry modules take a while to import and every invocation of
+# clacker.py loads this module, so they are imported by the methods
+# that use them.
+
 PONOKO_LASER_CUT = {
     'fill': 'none',
     'stroke_width': '0.01mm',
@@ -45,6 +43,9 @@ class Case(targets.Target):
         self.layout = layout
         self.shape_config = shape_config
 
+    def get_inputs(self):
+        return super(Case, self).get_inputs() + self.layout.files()
+
     def build(self):
         print('Gen case %s' % self.full_name)
         # Compute outputs dir
@@ -53,6 +54,9 @@ class Case(targets.Target):
                 'outputs',
                 self.full_name.replace(':', '/')))
         filesystem.mkdir_p(outputs)
+        from .circuitlib import shape
+        from . import kle
+
         layout = self.layout.layout
         shapes = shape.make_shapes(layout, shape_config=self.shape_config)
 
@@ -60,8 +64,11 @@ class Case(targets.Target):
         self.case_top(shapes, outputs)
         self.switch_plate(shapes, outputs)
         self.case_top_3d(shapes, outputs)
+        print('Key geometry cache: %s' % kle.cache_stats)
 
     def case_bottom(self, shapes, outputs):
+        from . import svg
+
         doc = svg.SVG()
 
         doc.add(shapes['bottom_plate'].symmetric_difference(shapes['corner_holes']),
@@ -77,6 +84,8 @@ class Case(targets.Target):
         doc.save(os.path.join(outputs, 'case-bottom.svg'))
 
     def case_top(self, shapes, outputs):
+        from . import svg
+
         doc = svg.SVG()
 
         doc.add(shapes['top_plate'],
@@ -85,6 +94,8 @@ class Case(targets.Target):
         doc.save(os.path.join(outputs, 'case-top.svg'))
 
     def switch_plate(self, shapes, outputs):
+        from . import svg
+
         doc = svg.SVG()
 
         doc.add(shapes['switch_plate'],
@@ -102,6 +113,10 @@ class Case(targets.Target):
         doc.save(os.path.join(outputs, 'switch-plate-full.svg'))
 
     def case_top_3d(self, shapes, outputs):
+        from shapely.affinity import (translate, rotate)
+        from shapely.geometry import box
+        from shapely.ops import unary_union
+
         Shape = openscad.Shape
         scad = openscad.Script()
 
@@ -289,7 +289,9 @@ class Circuit(object):
             part.add_to_pcb(self.pcb)
             # part.remove_nc_pads()
 
-    def computeRoutingData(self):
+    def computeRoutingData(self, workers=None):
+        ''' workers is the number of processes used to compute the
+            Steiner trees of the nets; None uses one per cpu. '''
         to_route = networkx.Graph()
         tri = triangulation.Triangulation()
 
@@ -301,6 +303,7 @@ class Circuit(object):
         smap = spatialmap.SpatialMap()
 
         list_of_nets = []
+        steiner_nets = []
 
         for net in self.circuit.nets:
             if net == self.circuit.NC:
@@ -334,9 +337,17 @@ class Circuit(object):
             else:
                 # Prefer the steiner variant of the MST because it generates
                 # a layout that is easier to route than the pure MST.
-                mst = msteinertree.rectilinear_steiner_minimum_spanning_tree(
-                    pins_in_net, net=net)
-                two_nets += mst
+                steiner_nets.append((net, pins_in_net))
+
+        # The Steiner trees of the nets are independent, so they are
+        # computed in parallel from just the pin coordinates and then
+        # mapped back to the nodes here, in net order.
+        trees = msteinertree.steiner_trees(
+            [[(t.shape.centroid.x, t.shape.centroid.y) for t in pins]
+             for _, pins in steiner_nets], workers=workers)
+        for (net, pins), (steiner_points, edges) in zip(steiner_nets, trees):
+            two_nets += msteinertree.tree_to_nodes(pins, steiner_points,
+                                                   edges, net=net)
 
         for part in self._parts:
             for pad, shape, drillshape in part._pads_by_idx.values():
@@ -1,51 +1,306 @@
+''' Shortest path search over networkx graphs and CSRGraphs.
+
+    All of the searches accept an edge_weight callback that returns the
+    cost of traversing an edge, or None if the edge cannot be used; for
+    networkx graphs it is called as edge_weight(v, u, edgedata) and for
+    a CSRGraph as edge_weight(edge_id).  They also accept an optional
+    cutoff; paths whose cost would exceed the cutoff are not considered.
+    They return (cost, path) where path is the list of nodes
+    from source to target and cost is the sum of the distances from the
+    source of each of the nodes in the path, or (None, None) if there is
+    no path within the cutoff.
+'''
 import itertools
+import math
 from heapq import heappush, heappop
-from tqdm import tqdm
 
 
-def dijkstra(G, source, target, cutoff=None, edge_weight=None):
-    if edge_weight is None:
-        def edge_weight(v, u, e):
-            return e.get('weight', 1)
-
-    with tqdm(desc='path finding') as pbar:
-        G_succ = G.succ if G.is_directed() else G.adj
-
-        paths = {source: [source]}
-        push = heappush
-        pop = heappop
-        dist = {}  # dictionary of final distances
-        seen = {source: 0}
-        c = itertools.count()
-        fringe = []  # use heapq with (distance,label) tuples
-        push(fringe, (0, next(c), source))
-        while fringe:
-            (d, _, v) = pop(fringe)
-            if v in dist:
-                continue  # already searched this node.
-            dist[v] = d
-            if v == target:
-                break
-
-            for u, e in G_succ[v].items():
-                cost = edge_weight(v, u, e)
-                if cost is None:
+class SearchStats(object):
+    ''' Counts the work performed by the searches in this module '''
+
+    def __init__(self):
+        self.searches = 0
+        self.expanded = 0
+
+    def __str__(self):
+        return '%d searches expanded %d nodes' % (self.searches, self.expanded)
+
+
+stats = SearchStats()
+
+# The relative difference in distance below which A* treats a cheaper
+# path to a node that it has already settled as float rounding
+ROUNDING_TOLERANCE = 1e-9
+
+
+def _default_edge_weight(v, u, e):
+    return e.get('weight', 1)
+
+
+def euclidean_heuristic(position, scale=1.0):
+    ''' Returns a heuristic function for astar() that estimates the cost
+        between two nodes as the straight line distance between them,
+        multiplied by scale.  position(node) must return (x, y).
+        This is admissible provided that no edge costs less than scale
+        times the distance between its end points. '''
+    def heuristic(u, target):
+        ux, uy = position(u)
+        tx, ty = position(target)
+        return scale * math.hypot(ux - tx, uy - ty)
+    return heuristic
+
+
+def _path_from_preds(preds, target):
+    path = [target]
+    while True:
+        p = preds[path[-1]]
+        if p is None:
+            break
+        path.append(p)
+    path.reverse()
+    return path
+
+
+def _path_cost(path, weight):
+    ''' Computes the sum of the distance from the source of each node
+        in path.  weight(v, u) returns the cost of the edge v->u. '''
+    cost = 0
+    dist = 0
+    for v, u in zip(path, path[1:]):
+        dist += weight(v, u)
+        cost += dist
+    return cost
+
+
+def _astar(source, target, successors, heuristic=None, cutoff=None):
+    ''' The search engine behind astar() and csr_dijkstra().
+        successors(v) yields (u, cost) for the edges v->u.
+        If the heuristic turns out not to be consistent, so that we find
+        a cheaper path to a node that we have already settled, we settle
+        that node again.
+        Returns (dist, preds) for the settled nodes. '''
+    stats.searches += 1
+    preds = {source: None}
+    dist = {}  # dictionary of final distances
+    seen = {source: 0}
+    c = itertools.count()
+    fringe = []  # use heapq with (estimate, counter, distance, label) tuples
+    heappush(fringe, (0, next(c), 0, source))
+    while fringe:
+        (_, _, d, v) = heappop(fringe)
+        if v in dist:
+            continue  # already searched this node.
+        dist[v] = d
+        stats.expanded += 1
+        if v == target:
+            break
+
+        for u, cost in successors(v):
+            if cost is None:
+                continue
+            vu_dist = d + cost
+            estimate = vu_dist
+            if heuristic is not None:
+                estimate += heuristic(u, target)
+            if cutoff is not None:
+                if estimate > cutoff:
+                    continue
+            if u in dist:
+                if vu_dist >= dist[u]:
+                    continue
+                if heuristic is None:
+                    raise ValueError('Contradictory paths found:',
+                                     'negative weights?')
+                if dist[u] - vu_dist <= ROUNDING_TOLERANCE * dist[u]:
+                    # Rounding in the heuristic, rather than a better path
+                    continue
+                # The heuristic isn't consistent here, so search u again
+                del dist[u]
+            elif u in seen and vu_dist >= seen[u]:
+                continue
+            seen[u] = vu_dist
+            heappush(fringe, (estimate, next(c), vu_dist, u))
+            preds[u] = v
+
+    return dist, preds
+
+
+def _astar_result(dist, preds, target):
+    if target not in dist:
+        return (None, None)
+    path = _path_from_preds(preds, target)
+    cost = 0
+    for p in path:
+        cost += dist[p]
+    return (cost, path)
+
+
+def _bidirectional(source, target, successors, predecessors, cutoff=None):
+    ''' The search engine behind bidirectional_dijkstra() and
+        csr_dijkstra().  successors(v) yields (u, cost) for the edges v->u
+        and predecessors(v) yields (u, cost) for the edges u->v.
+        Returns the path, or None. '''
+    stats.searches += 1
+    if source == target:
+        stats.expanded += 1
+        return [source]
+
+    # Index 0 is the forward search, 1 is the backward search
+    neighbors = [successors, predecessors]
+    preds = [{source: None}, {target: None}]
+    dists = [{}, {}]
+    seen = [{source: 0}, {target: 0}]
+    c = itertools.count()
+    fringes = [[(0, next(c), source)], [(0, next(c), target)]]
+    best = None
+    meet = None
+    direction = 1
+    while fringes[0] and fringes[1]:
+        direction = 1 - direction
+        fringe = fringes[direction]
+        dist = dists[direction]
+
+        (d, _, v) = heappop(fringe)
+        if v in dist:
+            continue  # already searched this node.
+        dist[v] = d
+        stats.expanded += 1
+
+        if v in dists[1 - direction]:
+            # Both searches have settled v; we have found the best path
+            break
+
+        for u, cost in neighbors[direction](v):
+            if cost is None:
+                continue
+            vu_dist = d + cost
+            if cutoff is not None:
+                if vu_dist > cutoff:
                     continue
-                vu_dist = dist[v] + cost
-                if cutoff is not None:
-                    if vu_dist > cutoff:
-                        continue
-                if u in dist:
-                    if vu_dist < dist[u]:
-                        raise ValueError('Contradictory paths found:',
-                                         'negative weights?')
-                elif u not in seen or vu_dist < seen[u]:
-                    seen[u] = vu_dist
-                    push(fringe, (vu_dist, next(c), u))
-                    paths[u] = paths[v] + [u]
-        if target not in paths:
+            if u in dist:
+                if vu_dist < dist[u]:
+                    raise ValueError('Contradictory paths found:',
+                                     'negative weights?')
+            elif u not in seen[direction] or vu_dist < seen[direction][u]:
+                seen[direction][u] = vu_dist
+                heappush(fringe, (vu_dist, next(c), u))
+                preds[direction][u] = v
+                if u in seen[1 - direction]:
+                    total = vu_dist + seen[1 - direction][u]
+                    if best is None or total < best:
+                        best = total
+                        meet = u
+
+    if meet is None or (cutoff is not None and best > cutoff):
+        return None
+
+    path = _path_from_preds(preds[0], meet)
+    tail = _path_from_preds(preds[1], meet)
+    tail.reverse()
+    return path + tail[1:]
+
+
+def _networkx_neighbors(G, edge_weight):
+    if G.is_directed():
+        G_succ, G_pred = G.succ, G.pred
+    else:
+        G_succ, G_pred = G.adj, G.adj
+
+    def successors(v):
+        for u, e in G_succ[v].items():
+            yield u, edge_weight(v, u, e)
+
+    def predecessors(v):
+        for u, e in G_pred[v].items():
+            yield u, edge_weight(u, v, e)
+
+    return successors, predecessors
+
+
+def astar(G, source, target, heuristic=None, cutoff=None, edge_weight=None):
+    ''' A* search from source to target.  heuristic(u, target) must not
+        overestimate the cost from u to target.  With no heuristic this is
+        Dijkstra's algorithm. '''
+    successors, _ = _networkx_neighbors(G, edge_weight or _default_edge_weight)
+    dist, preds = _astar(source, target, successors, heuristic=heuristic,
+                         cutoff=cutoff)
+    return _astar_result(dist, preds, target)
+
+
+def bidirectional_dijkstra(G, source, target, cutoff=None, edge_weight=None):
+    ''' Dijkstra's algorithm searching from both source and target at
+        the same time, alternating between the two directions. '''
+    edge_weight = edge_weight or _default_edge_weight
+    successors, predecessors = _networkx_neighbors(G, edge_weight)
+    path = _bidirectional(source, target, successors, predecessors,
+                          cutoff=cutoff)
+    if path is None:
+        return (None, None)
+    return (_path_cost(path, lambda v, u: edge_weight(v, u, G[v][u])), path)
+
+
+def dijkstra(G, source, target, cutoff=None, edge_weight=None,
+             heuristic=None, bidirectional=False):
+    ''' Find the shortest path from source to target.
+        If heuristic is provided, performs an A* search.
+        If bidirectional is True, searches from both ends; this cannot
+        be combined with a heuristic. '''
+    if bidirectional:
+        if heuristic is not None:
+            raise ValueError('bidirectional search does not support '
+                             'a heuristic')
+        return bidirectional_dijkstra(G, source, target, cutoff=cutoff,
+                                      edge_weight=edge_weight)
+    return astar(G, source, target, heuristic=heuristic, cutoff=cutoff,
+                 edge_weight=edge_weight)
+
+
+def csr_dijkstra(graph, source, target, cutoff=None, edge_weight=None,
+                 heuristic_scale=None, bidirectional=False):
+    ''' Find the shortest path from source to target in a CSRGraph.
+        edge_weight(e) returns the cost of edge id e; by default every
+        edge costs 1.
+        If heuristic_scale is provided, performs an A* search using
+        heuristic_scale times the distance between the node positions
+        as the heuristic.
+        If bidirectional is True, searches from both ends; this cannot
+        be combined with a heuristic. '''
+    if edge_weight is None:
+        def edge_weight(e):
+            return 1
+
+    indptr = graph.indptr
+    dst = graph.dst
+
+    def successors(v):
+        for e in range(indptr[v], indptr[v + 1]):
+            yield dst[e], edge_weight(e)
+
+    if bidirectional:
+        if heuristic_scale is not None:
+            raise ValueError('bidirectional search does not support '
+                             'a heuristic')
+        src = graph.src
+
+        def predecessors(v):
+            for e in graph.in_edges_of(v):
+                yield src[e], edge_weight(e)
+
+        path = _bidirectional(source, target, successors, predecessors,
+                              cutoff=cutoff)
+        if path is None:
             return (None, None)
-        cost = 0
-        for p in paths[target]:
-            cost += dist[p]
-        return (cost, paths[target])
+        return (_path_cost(path, lambda v, u: edge_weight(graph.edge_between(v, u))),
+                path)
+
+    heuristic = None
+    if heuristic_scale is not None:
+        x = graph.x
+        y = graph.y
+
+        def heuristic(u, t):
+            return heuristic_scale * math.hypot(x[u] - x[t], y[u] - y[t])
+
+    dist, preds = _astar(source, target, successors, heuristic=heuristic,
+                         cutoff=cutoff)
+    return _astar_result(dist, preds, target)
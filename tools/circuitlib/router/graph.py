@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from array import array
+
+
+class CSRGraph(object):
+    ''' A compact directed graph with integer node and edge ids.
+
+        Nodes and edges are added incrementally and then finalize() packs
+        the edges into compressed sparse row form: the outgoing edges of
+        node v are the edge ids in range(indptr[v], indptr[v + 1]), and
+        the incoming edges of v are in_edges[in_indptr[v]:in_indptr[v + 1]].
+        The edges of a node retain the order in which they were added.
+
+        Each node records the object that it represents, its position
+        and its layer index (or -1 if it isn't on a specific layer).
+        Each edge records its source (src) and target (dst) node, the
+        line that it follows (or None), the length of that line, whether
+        it is a via and its layer index.
+    '''
+
+    def __init__(self):
+        self.nodes = []
+        self.x = array('d')
+        self.y = array('d')
+        self.node_layer = array('i')
+        self._edges = []
+
+    def add_node(self, obj, x, y, layer=-1):
+        ''' Adds a node and returns its id '''
+        self.nodes.append(obj)
+        self.x.append(x)
+        self.y.append(y)
+        self.node_layer.append(layer)
+        return len(self.nodes) - 1
+
+    def add_edge(self, u, v, line=None, via=False, layer=-1):
+        self._edges.append((u, v, line, via, layer))
+
+    @property
+    def num_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def num_edges(self):
+        return len(self.src)
+
+    def finalize(self):
+        ''' Packs the edges into CSR form '''
+        n = len(self.nodes)
+        edges = sorted(self._edges, key=lambda e: e[0])
+
+        self.src = array('i', [e[0] for e in edges])
+        self.dst = array('i', [e[1] for e in edges])
+        self.lines = [e[2] for e in edges]
+        self.length = array('d', [e[2].length if e[2] else 0.0
+                                  for e in edges])
+        self.via = array('b', [1 if e[3] else 0 for e in edges])
+        self.edge_layer = array('i', [e[4] for e in edges])
+
+        self.indptr = array('i', [0] * (n + 1))
+        for u in self.src:
+            self.indptr[u + 1] += 1
+        for v in range(n):
+            self.indptr[v + 1] += self.indptr[v]
+
+        by_dst = sorted(range(len(edges)), key=lambda e: self.dst[e])
+        self.in_edges = array('i', by_dst)
+        self.in_indptr = array('i', [0] * (n + 1))
+        for v in self.dst:
+            self.in_indptr[v + 1] += 1
+        for v in range(n):
+            self.in_indptr[v + 1] += self.in_indptr[v]
+
+        self._edges = []
+        return self
+
+    def out_edges(self, v):
+        return range(self.indptr[v], self.indptr[v + 1])
+
+    def in_edges_of(self, v):
+        return self.in_edges[self.in_indptr[v]:self.in_indptr[v + 1]]
+
+    def edge_between(self, u, v):
+        ''' returns the id of the edge u->v, or None '''
+        for e in self.out_edges(u):
+            if self.dst[e] == v:
+                return e
+        return None
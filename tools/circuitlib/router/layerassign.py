@@ -1,14 +1,21 @@
 from __future__ import absolute_import
 from __future__ import print_function
-import networkx
 from . import (types, tri, dijkstra)
+from .graph import CSRGraph
 from ...utils import pairwise
+from array import array
+import heapq
 import itertools
+import math
+import multiprocessing
+import numbers
+import numpy
+import time
 from tqdm import tqdm
-from shapely.geometry import (Point, Polygon, MultiPolygon, CAP_STYLE,
+from shapely.geometry import (Polygon, MultiPolygon, CAP_STYLE,
                               JOIN_STYLE, box, LineString, MultiLineString, MultiPoint)
-from shapely.ops import unary_union
 from shapely.prepared import prep
+from shapely.strtree import STRtree
 
 # Alpha is a parameter that shifts the balance between vias and
 # overall line length.  It must be > 0 and < 1.
@@ -16,6 +23,14 @@ from shapely.prepared import prep
 # will bias towards more vias.
 ALPHA = 0.1
 
+# The scale of the A* heuristic of InputTwoNet.find_path
+ASTAR_SCALE = (1 - ALPHA) * (1 - 1e-6)
+
+# The layers, in the order of the layer indices used in the CSRGraph
+LAYERS = [types.FRONT, types.BACK]
+
+NAN = float('nan')
+
 
 def line_between(shape1, shape2):
     return LineString([shape1.centroid, shape2.centroid])
@@ -33,23 +48,53 @@ class NodeLayerAssignment(object):
 class SourceSinkNode(object):
     ''' one of the endpoints of a two net assignment graph '''
 
-    def __init__(self, nla):
-        assert isinstance(nla, NodeLayerAssignment)
-        self.nla = nla
+    def __init__(self, node):
+        assert isinstance(node, types.Connectable)
+        self.node = node
 
 
 class InputTwoNet(object):
-    def __init__(self, a, b):
-        self.source = SourceSinkNode(a)
-        self.sink = SourceSinkNode(b)
-        self.g = self.build_graph()
+    ''' The layer assignment graph for a pair of nodes.
+        The nodes and edges are added to graph, which is shared by all
+        of the InputTwoNets in a routing run; source and sink are the
+        ids of the SourceSinkNodes in that graph.
+        This depends only on the nodes, so it is built once per
+        routing run and shared read-only between Configurations;
+        the per-configuration state for the endpoints is held
+        in the NodeLayerAssignment table of the Configuration. '''
+
+    def __init__(self, a, b, graph):
+        self.graph = graph
+        self.source = self._add_node(SourceSinkNode(a), a.shape)
+        self.sink = self._add_node(SourceSinkNode(b), b.shape)
+        self.build_graph()
+
+    def _add_node(self, obj, shape, layer=None):
+        c = shape.centroid
+        return self.graph.add_node(obj, c.x, c.y,
+                                   LAYERS.index(layer) if layer else -1)
+
+    def find_path(self, edge_weight, cutoff=None, astar=False):
+        ''' Search for the best path from source to sink.
+            Every edge costs at least (1 - ALPHA) times the distance
+            between its ends, so with astar we use a little less than that
+            as an A* heuristic; the margin keeps rounding from making it
+            inconsistent.  A* finds a path of the same length, but may
+            choose a different one of several equally short paths than
+            Dijkstra would, which changes the cost that we return and so
+            the order of the assignment.  The default is Dijkstra. '''
+        return dijkstra.csr_dijkstra(
+            self.graph, self.source, self.sink,
+            edge_weight=edge_weight,
+            cutoff=cutoff,
+            heuristic_scale=ASTAR_SCALE if astar else None)
 
     def build_graph(self, via_count=3):
         ''' Build a layer assignment graph for the path a->b. '''
-        g = networkx.DiGraph()
+        g = self.graph
 
-        a = self.source.nla.node
-        b = self.sink.nla.node
+        a = g.nodes[self.source].node
+        b = g.nodes[self.sink].node
 
         if a.net != b.net:
             print('a.net', a.net)
@@ -68,22 +113,27 @@ class InputTwoNet(object):
             via_points.append(vp)
             left = vp
 
-        g.add_node(self.source)
-        g.add_node(self.sink)
+        def branch(shape, layer, proxy_for=None):
+            node = types.Branch(shape, net=a.net, layer=layer,
+                                proxy_for=proxy_for)
+            return self._add_node(node, node.shape, layer)
+
+        def add_line(u, v, layer):
+            g.add_edge(u, v, line=line_between(g.nodes[u].shape,
+                                               g.nodes[v].shape),
+                       layer=LAYERS.index(layer))
 
         nodes_by_layer = {}
 
-        for layer in [types.FRONT, types.BACK]:
+        for layer in LAYERS:
             if a.is_on_layer(layer):
-                al = types.Branch(a.shape, net=a.net, layer=layer, proxy_for=a)
-                g.add_node(al)
+                al = branch(a.shape, layer, proxy_for=a)
                 g.add_edge(self.source, al)
             else:
                 al = None
 
             if b.is_on_layer(layer):
-                bl = types.Branch(b.shape, net=b.net, layer=layer, proxy_for=b)
-                g.add_node(bl)
+                bl = branch(b.shape, layer, proxy_for=b)
                 g.add_edge(bl, self.sink)
             else:
                 bl = None
@@ -92,15 +142,14 @@ class InputTwoNet(object):
 
             last = al
             for pt in via_points:
-                vl = types.Branch(pt, net=a.net, layer=layer)
+                vl = branch(pt, layer)
                 nodes_by_layer[layer].append(vl)
-                if last:
-                    g.add_edge(last, vl, line=line_between(
-                        last.shape, vl.shape))
+                if last is not None:
+                    add_line(last, vl, layer)
                 last = vl
 
-            if bl:
-                g.add_edge(last, bl, line=line_between(last.shape, bl.shape))
+            if bl is not None:
+                add_line(last, bl, layer)
 
             # Generate the short circuit branches.  The purpose
             # of these is to avoid understimation of certain
@@ -113,35 +162,53 @@ class InputTwoNet(object):
                     if i + seq_len < len(nodes_by_layer):
                         t = nodes_by_layer[layer][i + seq_len]
                         if t is not None:
-                            g.add_edge(nodes_by_layer[layer][i], t, line=line_between(
-                                nodes_by_layer[layer][i].shape, t.shape))
+                            add_line(nodes_by_layer[layer][i], t, layer)
 
         for i, node in enumerate(nodes_by_layer[types.FRONT]):
             # Can traverse up or down
             other = nodes_by_layer[types.BACK][i]
-            if node and other:
+            if node is not None and other is not None:
                 g.add_edge(node, other, via=i > 1)
                 g.add_edge(other, node, via=i > 1)
 
-        return g
-
 
 class Component(object):
     ''' Represents a component formed out of connected paths
         on a layer of a board '''
 
+    # If set, this is called as diagnostics(component, line, hull) when
+    # detour_cost is unable to find distinct hull vertices for the ends
+    # of the line.  See detour_svg_diagnostics.
+    diagnostics = None
+
     def __init__(self, a, b):
-        a = a.centroid
-        b = b.centroid
-        self.terminals = set([(a.x, a.y), (b.x, b.y)])
-        self.lines = [LineString([(a.x, a.y), (b.x, b.y)])]
-        self.shape = self.lines[0]
+        ''' a and b are the (x, y) coordinates of the ends of the
+            initial line of the component '''
+        self.terminals = set([a, b])
+        self.lines = [LineString([a, b])]
+        self._shape = self.lines[0]
+        self._coords = None
+
+    @property
+    def shape(self):
+        if self._shape is None:
+            self._shape = MultiLineString(self.lines)
+        return self._shape
+
+    @property
+    def coords(self):
+        ''' The vertices of the lines as an (n, 2) array '''
+        if self._coords is None:
+            self._coords = numpy.array(
+                [c for line in self.lines for c in line.coords], dtype=float)
+        return self._coords
 
     def update_with(self, comp):
         ''' Extends self with the component info from comp '''
         self.terminals.update(comp.terminals)
         self.lines += comp.lines
-        self.shape = MultiLineString(self.lines)
+        self._shape = None
+        self._coords = None
 
     def __str__(self):
         return '%d terminals %d lines' % (len(self.terminals), len(self.lines))
@@ -157,194 +224,381 @@ class Component(object):
             detour cost is then the smallest distance walking from A to B
             either clockwise or counter clockwise around the vertices of
             the hull '''
-        joined = unary_union([self.shape, line])
-        hull = joined.convex_hull
-        if hasattr(hull, 'exterior'):
-            hull = list(hull.exterior.coords)
-            # the final coord loops back to the start; remove it
-            hull.pop()
-        else:
-            hull = list(hull.coords)
-
-        a, b = list(line.coords)
+        ends = numpy.array(line.coords, dtype=float)
+        hull = convex_hull(numpy.concatenate([self.coords, ends]))
+        a, b = ends
 
-        # Since we buffered out the shapes, we need to make a pass to find
-        # the closest points to our A and B points
+        def distances(vert):
+            return numpy.sqrt(((hull - vert) ** 2).sum(axis=1))
 
-        def closest(vert, exclude=None):
-            best = None
-            vert = Point(vert)
-            for p in hull:
-                if exclude and exclude == p:
-                    continue
-                d = vert.distance(Point(p))
-                if not best or d < best[0]:
-                    best = [d, p]
-            return best[1]
+        def positions(vert):
+            return numpy.flatnonzero((hull == vert).all(axis=1))
 
-        a_close = closest(a)
-        b_close = closest(b, exclude=a_close)
+        # Find the closest hull vertices to our A and B points
+        a_dist = distances(a)
+        a_close = hull[numpy.argmin(a_dist)]
+        b_dist = distances(b)
+        b_dist[positions(a_close)] = float('inf')
+        b_close = hull[numpy.argmin(b_dist)]
 
         # Map those to indices
-        for i in range(0, len(hull)):
-            if hull[i] == a_close:
-                a_pos = i
-            if hull[i] == b_close:
-                b_pos = i
+        a_pos = positions(a_close)[-1]
+        b_pos = positions(b_close)[-1]
 
         if a_pos == b_pos:
-            print(line)
-            print(hull)
-            print('boom')
-            from ... import svg
-            doc = svg.SVG()
-            doc.add(self.shape, stroke='red',
-                    stroke_width=0.01, fill_opacity=0)
-            doc.add(line, stroke='blue', stroke_width=0.01, fill_opacity=0)
-            doc.add(joined.convex_hull, stroke='grey',
-                    stroke_width=0.01, fill_opacity=0)
-            doc.save('/tmp/gah.svg')
+            if Component.diagnostics:
+                Component.diagnostics(self, line, hull)
             assert a_pos != b_pos
             return 0
 
-        # [A x y B] -> [A, x, y, B] and [B, A]
-        # [x A y B] -> [A, y, B] and [B, x, A]
-        # [B x A y] -> [A, y, B] and [B, x, A]
+        def walk(start, end):
+            ''' Sum the edge lengths walking the vertices
+                hull[start:] + hull[:-start] until we reach end '''
+            n = len(hull)
+            idx = numpy.concatenate([numpy.arange(start, n),
+                                     numpy.arange(0, n - start if start else 0)])
+            path = hull[idx]
+            costs = numpy.cumsum(
+                numpy.sqrt(((path[1:] - path[:-1]) ** 2).sum(axis=1)))
+            arrived = numpy.flatnonzero((path[1:] == end).all(axis=1))
+            if len(arrived):
+                cost = costs[arrived[0]]
+                assert cost != 0
+                return cost
+            return costs[-1] if len(costs) else 0
+
+        a_cost = walk(a_pos, b)
+        b_cost = walk(b_pos, a)
+
+        base_detour = numpy.sqrt(((a - a_close) ** 2).sum()) + \
+            numpy.sqrt(((b - b_close) ** 2).sum())
+        return float(min(a_cost, b_cost) + base_detour)
+
+
+def convex_hull(coords):
+    ''' Computes the convex hull of an (n, 2) array of coords.
+        Returns an array of the hull vertices in the same order that
+        shapely produces them: clockwise starting from the lowest,
+        leftmost vertex, without repeating the first vertex.
+        Collinear input yields just the two extreme points. '''
+    order = numpy.lexsort((coords[:, 1], coords[:, 0]))
+    ordered = coords[order]
+    distinct = numpy.ones(len(ordered), dtype=bool)
+    distinct[1:] = (ordered[1:] != ordered[:-1]).any(axis=1)
+    if distinct.sum() <= 2:
+        # keep them in the order that they first appear
+        first = []
+        for p in coords.tolist():
+            if p not in first:
+                first.append(p)
+        return numpy.array(first, dtype=float)
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    # Andrew's monotone chain over the points sorted by x, then y
+    pts = [tuple(p) for p in ordered[distinct].tolist()]
+    lower = []
+    for p in pts:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+    upper = []
+    for p in reversed(pts):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+
+    # Counter-clockwise from the leftmost point; reverse it and rotate
+    # it to start from the lowest point
+    hull = numpy.array((lower[:-1] + upper[:-1])[::-1], dtype=float)
+    if len(hull) <= 2:
+        hull = numpy.array([pts[0], pts[-1]], dtype=float)
+    start = numpy.lexsort((hull[:, 0], hull[:, 1]))[0]
+    return numpy.roll(hull, -start, axis=0)
+
+
+def detour_svg_diagnostics(filename):
+    ''' Returns a function suitable for use as Component.diagnostics that
+        renders the component, line and hull into an SVG file '''
+    def diagnostics(comp, line, hull):
+        from ... import svg
+        print(line)
+        print(hull)
+        doc = svg.SVG()
+        doc.add(comp.shape, stroke='red',
+                stroke_width=0.01, fill_opacity=0)
+        doc.add(line, stroke='blue', stroke_width=0.01, fill_opacity=0)
+        doc.add(Polygon(hull) if len(hull) > 2 else LineString(hull),
+                stroke='grey', stroke_width=0.01, fill_opacity=0)
+        doc.save(filename)
+
+    return diagnostics
 
-        a_path = hull[a_pos:] + hull[:-a_pos]
-        a_cost = 0
-        for i, j in pairwise(a_path):
-            a_cost += LineString([i, j]).length
-            if j == b:
-                assert a_cost != 0
-                break
 
-        b_path = hull[b_pos:] + hull[:-b_pos]
-        b_cost = 0
-        for i, j in pairwise(b_path):
-            b_cost += LineString([i, j]).length
-            if j == a:
-                assert b_cost != 0
-                break
+class ComponentList(object):
+    ''' A list of components on a layer.
 
-        base_detour = LineString([a, a_close]).length + \
-            LineString([b, b_close]).length
-        return min(a_cost, b_cost) + base_detour
+        The terminals are held in a disjoint-set forest keyed by their
+        coordinates, with the root of each set mapping to its component.
+        We use union by size without path compression so that the
+        unions performed by add() can be undone by remove().
 
+        The individual lines of the components are held in a grid of
+        GRID_SIZE cells, keyed by their bounding boxes, so that
+        intersects() only needs to examine lines that are nearby.
+        Merging components doesn't move any lines; the line entries
+        find their component via the terminal forest. '''
 
-class ComponentList(object):
-    ''' A list of components on a layer '''
+    GRID_SIZE = 10.0
 
     def __init__(self):
         self.comps = set()
+        # terminal -> parent terminal
+        self._parent = {}
+        # root terminal -> number of terminals in its set
+        self._size = {}
+        # root terminal -> Component
+        self._comp_by_root = {}
+        # grid cell -> list of (line, terminal)
+        self._grid = {}
+
+    def _find(self, vert):
+        while True:
+            parent = self._parent[vert]
+            if parent == vert:
+                return vert
+            vert = parent
+
+    def _cells(self, bounds):
+        minx, miny, maxx, maxy = [int(math.floor(v / self.GRID_SIZE))
+                                  for v in bounds]
+        for x in range(minx, maxx + 1):
+            for y in range(miny, maxy + 1):
+                yield (x, y)
 
     def component_for_vertex(self, vert):
-        for comp in self.comps:
-            if vert in comp.terminals:
-                return comp
-        return None
+        if vert not in self._parent:
+            return None
+        return self._comp_by_root[self._find(vert)]
 
     def add(self, comp):
-        ''' Adds a component, merging it if appropriate '''
+        ''' Adds a component, merging it if appropriate.
+            Returns a record of the changes that must be passed to
+            remove() to undo the addition. '''
 
         # Find the set of components that share vertices
-        to_merge = set()
+        merged_roots = {}
+        new_verts = []
         for vert in comp.terminals:
-            m = self.component_for_vertex(vert)
-            if m:
-                to_merge.add(m)
-                # Remove it from the set; it will be merged
-                # into the component we're adding in this call
-                self.comps.remove(m)
+            if vert in self._parent:
+                root = self._find(vert)
+                merged_roots[root] = self._comp_by_root[root]
+            else:
+                new_verts.append(vert)
+
+        for vert in new_verts:
+            self._parent[vert] = vert
+            self._size[vert] = 1
+
+        # Index the lines that are new with this component, before
+        # it absorbs the lines of the components that it merges
+        lines = list(comp.lines)
+        vert = next(iter(comp.terminals))
+        for line in lines:
+            for cell in self._cells(line.bounds):
+                self._grid.setdefault(cell, []).append((line, vert))
+
+        # Join the terminals into a single set
+        unions = []
+        root = None
+        for vert in comp.terminals:
+            r = self._find(vert)
+            if root is None:
+                root = r
+                continue
+            if r == root:
+                continue
+            if self._size[r] > self._size[root]:
+                r, root = root, r
+            self._parent[r] = root
+            self._size[root] += self._size[r]
+            unions.append((r, root))
 
         # Now merge them together
-        for m in to_merge:
+        for r, m in merged_roots.items():
+            del self._comp_by_root[r]
+            self.comps.remove(m)
             comp.update_with(m)
 
+        self._comp_by_root[root] = comp
         self.comps.add(comp)
+        return (merged_roots, new_verts, lines, unions, root)
+
+    def remove(self, comp, record):
+        ''' Undoes a prior add(comp) that returned record.  Additions
+            must be undone in the reverse order that they were made. '''
+        merged_roots, new_verts, lines, unions, root = record
+
+        self.comps.remove(comp)
+        del self._comp_by_root[root]
+
+        for r, parent in reversed(unions):
+            self._parent[r] = r
+            self._size[parent] -= self._size[r]
+
+        for vert in new_verts:
+            del self._parent[vert]
+            del self._size[vert]
+
+        for line in reversed(lines):
+            for cell in self._cells(line.bounds):
+                self._grid[cell].pop()
+
+        for r, m in merged_roots.items():
+            self._comp_by_root[r] = m
+            self.comps.add(m)
 
     def intersects(self, shape):
         vert_a, vert_b = list(shape.coords)
-        shape = prep(shape)
-        for comp in self.comps:
-            if vert_a in comp.terminals:
-                continue
-            if vert_b in comp.terminals:
-                continue
-            if shape.intersects(comp.shape):
-                yield comp
+        exclude = set()
+        for vert in (vert_a, vert_b):
+            if vert in self._parent:
+                exclude.add(self._find(vert))
+
+        prepared = prep(shape)
+        for cell in self._cells(shape.bounds):
+            for line, vert in self._grid.get(cell, ()):
+                root = self._find(vert)
+                if root in exclude:
+                    continue
+                if prepared.intersects(line):
+                    # Only report each component once
+                    exclude.add(root)
+                    yield self._comp_by_root[root]
 
 
 class Path(object):
-    ''' Holds some path related state '''
+    ''' Holds some path related state.  path is the list of node ids
+        in the graph of input_2net and edges the corresponding list
+        of edge ids. '''
 
     def __init__(self, cost, input_2net, path):
         self.cost = cost
         self.input_2net = input_2net
         self.path = path
+        g = input_2net.graph
+        self.edges = [g.edge_between(a, b) for a, b in pairwise(path)]
+
+    def segments(self):
+        ''' yields (a, b, line) for the line segments of the path, where
+            a and b are the Branch nodes at either end '''
+        g = self.input_2net.graph
+        for e in self.edges:
+            line = g.lines[e]
+            if line is None:
+                continue
+            a = g.src[e]
+            b = g.dst[e]
+            if g.node_layer[a] < 0 or g.node_layer[b] < 0:
+                continue
+            yield g.nodes[a], g.nodes[b], line
 
 
 class Configuration(object):
-    def __init__(self, two_nets):
+    ''' Holds the state of a layer assignment in progress.
+
+        All mutations to the state are recorded in an undo journal so
+        that we can cheaply rewind to the point just after any of the
+        paths was added; this allows evaluating a new assignment order
+        by resuming from the longest prefix that it shares with the
+        current one, rather than routing everything from scratch. '''
+
+    def __init__(self, two_nets, input_two_nets=None):
+        ''' two_nets is the list of (a, b) node pairs to route.
+            input_two_nets is the corresponding list of InputTwoNet
+            instances; pass the two_nets list from another Configuration
+            for the same two_nets to share its graphs. '''
         self.cost = None
         self.paths = []
-        self.cost_cache = {}
         self.assignment_order = []
+        # The undo journal, and the length it had after each path was
+        # added; _checkpoints[i] is the state with i paths.
+        self._journal = []
+        self._checkpoints = [0]
+        # The lines of the segments in paths, as (line, a, b) tuples,
+        # and a spatial index over them
+        self._segments = []
+        self._tree = None
+        self._tree_index = None
+        # Counts of cost_cache entries that were invalidated or retained
+        # when adding paths
+        self.cache_stats = {'invalidated': 0, 'retained': 0}
         self.components_by_layer = {
             types.FRONT: ComponentList(),
             types.BACK: ComponentList(),
         }
-        self.two_nets = []
         self.raw_two_nets = two_nets
-
-        nla_map = {}
-
-        def nla_for_node(node):
-            nla = nla_map.get(node)
-            if not nla:
-                nla = NodeLayerAssignment(node)
-                nla_map[node] = nla
-            return nla
-
-        for net in two_nets:
-            self.two_nets.append(InputTwoNet(nla_for_node(net[0]),
-                                             nla_for_node(net[1])))
-
-    def edge_weight(self, source, target, edgedata):
-        key = (source, target)
-        cost = self.cost_cache.get(key)
-        if cost is None:
+        if input_two_nets is None:
+            g = CSRGraph()
+            input_two_nets = [InputTwoNet(a, b, g) for a, b in two_nets]
+            self.graph = g.finalize()
+        elif input_two_nets:
+            self.graph = input_two_nets[0].graph
+        else:
+            self.graph = CSRGraph().finalize()
+        self.two_nets = input_two_nets
+
+        # The cost of each edge in graph, or NaN if we don't know it
+        self.cost_cache = array('d', [NAN]) * self.graph.num_edges
+        self._num_cached = 0
+
+        # The layer assignment state for each of the endpoint nodes,
+        # and for the ids of the SourceSinkNodes that represent them
+        self.nla_by_node = {}
+        self._nla_by_terminal = {}
+        for n in self.two_nets:
+            for terminal in (n.source, n.sink):
+                node = self.graph.nodes[terminal].node
+                if node not in self.nla_by_node:
+                    self.nla_by_node[node] = NodeLayerAssignment(node)
+                self._nla_by_terminal[terminal] = self.nla_by_node[node]
+
+        self._index = {n: i for i, n in enumerate(self.two_nets)}
+
+    def edge_weight(self, e):
+        ''' returns the cost of traversing edge id e '''
+        cost = self.cost_cache[e]
+        if cost != cost:
+            # NaN; not yet known
+            g = self.graph
             detour_cost = 0
             basic_cost = 0
-            is_via = edgedata.get('via', False)
+            is_via = g.via[e]
+            source = g.src[e]
+            target = g.dst[e]
 
-            if isinstance(source, SourceSinkNode) or isinstance(target, SourceSinkNode):
+            if source in self._nla_by_terminal or target in self._nla_by_terminal:
                 # Source/sink node traversal.
 
-                if not isinstance(source, SourceSinkNode):
+                if source not in self._nla_by_terminal:
                     # we can never have SourceSinkNode->SourceSinkNode, so we can
                     # safely swap the values here to make the code simpler
                     source, target = target, source
 
-                # assert isinstance(source, SourceSinkNode)
-                # assert not isinstance(target, SourceSinkNode)
-                # assert len(target.layers) == 1
-
-                layer = target.layers[0]
-                if layer not in source.nla.available_layers:
+                layer = LAYERS[g.node_layer[target]]
+                nla = self._nla_by_terminal[source]
+                if layer not in nla.available_layers:
                     basic_cost = float('inf')
-                elif (len(source.nla.configured_layers) > 0) and (
-                        layer not in source.nla.configured_layers):
+                elif (len(nla.configured_layers) > 0) and (
+                        layer not in nla.configured_layers):
                     basic_cost = float('inf')
 
             elif not is_via:
-                my_line = edgedata.get('line')
+                my_line = g.lines[e]
                 if my_line:
-                    basic_cost = my_line.length
-
-                    # assert len(source.layers) == 1
-                    # assert len(target.layers) == 1
-                    layer = source.layers[0]
+                    basic_cost = g.length[e]
+                    layer = LAYERS[g.node_layer[source]]
 
                     # Compute the detour cost; this is minimum length of an alternate
                     # path that we'd need to take to avoid intersecting segments
@@ -361,150 +615,385 @@ class Configuration(object):
             if is_via:
                 cost += ALPHA
 
-            self.cost_cache[key] = cost
+            self.cost_cache[e] = cost
+            self._num_cached += 1
+            self._journal.append((self._undo_cache_set, e))
         return cost
 
+    def _undo_cache_set(self, e):
+        self.cost_cache[e] = NAN
+        self._num_cached -= 1
+
+    def _undo_cache_del(self, e, cost):
+        self.cost_cache[e] = cost
+        self._num_cached += 1
+
+    def _undo_add_path(self):
+        self.paths.pop()
+        self.assignment_order.pop()
+
+    def _undo_component(self, layer, comp, record):
+        self.components_by_layer[layer].remove(comp, record)
+
+    def _undo_configured_layer(self, nla, layer):
+        nla.configured_layers.remove(layer)
+
+    def rewind(self, num_paths):
+        ''' Restore the state to how it was immediately after the first
+            num_paths paths were added. '''
+        mark = self._checkpoints[num_paths]
+        while len(self._journal) > mark:
+            entry = self._journal.pop()
+            entry[0](*entry[1:])
+        del self._checkpoints[num_paths + 1:]
+        self.cost = None
+
+    def _segment_tree(self):
+        ''' returns an STRtree over the committed segment lines,
+            building it if segments were added or rewound since
+            it was last used '''
+        if self._tree is None:
+            self._tree = STRtree([seg[0] for seg in self._segments])
+            self._tree_index = {id(seg[0]): idx for idx,
+                                seg in enumerate(self._segments)}
+        return self._tree
+
+    def _segments_intersecting(self, line):
+        ''' yields the committed (line, a, b) segments that intersect line '''
+        if not self._segments:
+            return
+        for hit in self._segment_tree().query(line):
+            # Newer versions of shapely return indices, older versions
+            # return the geometries themselves
+            if not isinstance(hit, numbers.Integral):
+                hit = self._tree_index[id(hit)]
+            seg = self._segments[hit]
+            if seg[0].intersects(line):
+                yield seg
+
+    def _undo_add_segment(self):
+        self._segments.pop()
+        self._tree = None
+
     def _invalidate_cache_for_path(self, path):
         ''' Invalidate cached cost information for segments that intersect
             those in the newly added path '''
-        if not self.paths or not self.cost_cache:
+        if not self.paths or not self._num_cached:
             return
 
-        g = path.input_2net.g
-
         invalidated = set()
-        for source, target in pairwise(path.path):
-            if isinstance(source, SourceSinkNode) or isinstance(target, SourceSinkNode):
-                continue
-            my_line = g[source][target].get('line')
-            if not my_line:
-                continue
-            for p in self.paths:
-                for i, j in pairwise(p.path):
-                    if (i in invalidated) and (j in invalidated):
-                        continue
-
-                    if not (hasattr(i, 'shape') and hasattr(j, 'shape')):
-                        continue
-
-                    seg_line = p.input_2net.g[i][j].get('line')
-                    if seg_line and seg_line.intersects(my_line):
-                        invalidated.add(i)
-                        invalidated.add(j)
-
-        for key in list(self.cost_cache.keys()):
-            a, b = key
-            if (a in invalidated) or (b in invalidated):
-                del self.cost_cache[key]
+        for _, _, my_line in path.segments():
+            for _, i, j in self._segments_intersecting(my_line):
+                invalidated.add(i)
+                invalidated.add(j)
+
+        g = self.graph
+        num_invalidated = 0
+        for node in invalidated:
+            for edges in (g.out_edges(node), g.in_edges_of(node)):
+                for e in edges:
+                    cost = self.cost_cache[e]
+                    if cost == cost:
+                        self.cost_cache[e] = NAN
+                        self._journal.append((self._undo_cache_del, e, cost))
+                        num_invalidated += 1
+
+        self._num_cached -= num_invalidated
+        self.cache_stats['invalidated'] += num_invalidated
+        self.cache_stats['retained'] += self._num_cached
 
     def add_path(self, path):
         self._invalidate_cache_for_path(path)
         self.paths.append(path)
         self.cost = None
         self.assignment_order.append(path.input_2net)
+        self._journal.append((self._undo_add_path,))
+
+        g = self.graph
+
+        # Record the segments so that later paths can find them
+        for e in path.edges:
+            line = g.lines[e]
+            if line and g.node_layer[g.src[e]] >= 0 and g.node_layer[g.dst[e]] >= 0:
+                self._segments.append((line, g.src[e], g.dst[e]))
+                self._journal.append((self._undo_add_segment,))
+                self._tree = None
 
         # Track the layer assignments
-        for a, b in pairwise(path.path):
-            if isinstance(a, SourceSinkNode):
+        for e in path.edges:
+            a = g.src[e]
+            b = g.dst[e]
+            if a in self._nla_by_terminal:
                 source, node = a, b
-            elif isinstance(b, SourceSinkNode):
+            elif b in self._nla_by_terminal:
                 source, node = b, a
             else:
-                if a.shape != b.shape:
-                    comp = Component(a.shape, b.shape)
-                    self.components_by_layer[a.layers[0]].add(comp)
+                a_pos = (g.x[a], g.y[a])
+                b_pos = (g.x[b], g.y[b])
+                if a_pos != b_pos:
+                    layer = LAYERS[g.node_layer[a]]
+                    comp = Component(a_pos, b_pos)
+                    record = self.components_by_layer[layer].add(comp)
+                    self._journal.append(
+                        (self._undo_component, layer, comp, record))
                 continue
 
-            layer = node.layers[0]
-            source.nla.configured_layers.add(layer)
+            layer = LAYERS[g.node_layer[node]]
+            nla = self._nla_by_terminal[source]
+            if layer not in nla.configured_layers:
+                nla.configured_layers.add(layer)
+                self._journal.append(
+                    (self._undo_configured_layer, nla, layer))
+
+        self._checkpoints.append(len(self._journal))
 
     def compute_cost(self):
         if self.cost is None:
             self.cost = 0
             for path in tqdm(self.paths, desc='compute cost'):
-                for a, b in pairwise(path.path):
-                    self.cost += self.edge_weight(a,
-                                                  b, path.input_2net.g[a][b])
+                for e in path.edges:
+                    self.cost += self.edge_weight(e)
 
         return self.cost
 
     def initial_assignment(self):
-        ''' Assign 2net in ascending order of cost '''
-        with tqdm(desc='initial 2net assignment', total=len(self.two_nets)) as pbar:
-            free = set(self.two_nets)
-
-            while len(free) > 0:
-                pbar.update(1)
-                best = None
-                for n in free:
-                    cost, path = dijkstra.dijkstra(n.g, n.source, n.sink,
-                                                   edge_weight=self._make_edge_weight_func(),
-                                                   cutoff=best.cost if best is not None else None)
-
-                    if cost is None:
-                        # hit the cutoff
-                        continue
-
-                    if not best or cost < best.cost:
-                        best = Path(cost, n, path)
+        ''' Assign 2net in ascending order of cost.
+
+            This is a lazy-greedy evaluation: adding a path can only
+            increase the cost of the edges in the graph, so the cost that
+            we last computed for a 2net is a lower bound for its current
+            cost.  We keep the 2nets in a priority queue keyed by their
+            last known cost and only re-run the path finding for the head
+            of the queue.  If the refreshed cost is still no worse than
+            the next best lower bound then it is the best choice and we
+            can commit it without looking at the rest of the queue.
+            Ties are broken by the position in the input list so that
+            the order is stable from run to run. '''
+        edge_weight = self._make_edge_weight_func()
+        calls = 0
+        expanded = dijkstra.stats.expanded
+
+        # Each entry is [cost, bounded, idx, generation, path].
+        # generation is the number of paths that had been committed when
+        # cost was computed; if that matches the current number of paths
+        # then cost is exact, otherwise it is a lower bound.  bounded is
+        # 1 if the search hit the cutoff, in which case the true cost is
+        # strictly greater than cost and we have no path; this sorts it
+        # after exact entries of the same cost.
+        queue = []
+        for idx, n in enumerate(tqdm(self.two_nets, desc='initial 2net costs')):
+            cost, path = n.find_path(edge_weight)
+            calls += 1
+            heapq.heappush(queue, [cost, 0, idx, len(self.paths), path])
 
-                free.remove(best.input_2net)
-                self.add_path(best)
-                #tqdm.write('best is cost=%r (overall %r)' % (cost, self.compute_cost()))
+        with tqdm(desc='initial 2net assignment', total=len(self.two_nets)) as pbar:
+            while queue:
+                cost, bounded, idx, generation, path = queue[0]
+                if generation == len(self.paths) and not bounded:
+                    heapq.heappop(queue)
+                    pbar.update(1)
+                    self.add_path(Path(cost, self.two_nets[idx], path))
+                    continue
 
-            return self
+                # Stale; refresh the head.  There is no point computing a
+                # cost that exceeds the next best lower bound because we
+                # would not select it this round anyway.
+                cutoff = None
+                if len(queue) > 1:
+                    cutoff = queue[1][0]
+                    if len(queue) > 2:
+                        cutoff = min(cutoff, queue[2][0])
+                    if cutoff <= cost:
+                        # The cutoff can't tell us anything new
+                        cutoff = None
+
+                n = self.two_nets[idx]
+                cost, path = n.find_path(edge_weight, cutoff=cutoff)
+                calls += 1
+                bounded = 0
+                if cost is None:
+                    # hit the cutoff, so that is our new lower bound
+                    cost = cutoff
+                    bounded = 1
+                heapq.heapreplace(
+                    queue, [cost, bounded, idx, len(self.paths), path])
+
+        n = len(self.two_nets)
+        self.initial_assignment_dijkstra_calls = calls
+        self.initial_assignment_dijkstra_saved = (n * (n + 1)) // 2 - calls
+        tqdm.write('initial 2net assignment: %d path searches (%d saved), '
+                   '%d nodes expanded' % (
+                       calls, self.initial_assignment_dijkstra_saved,
+                       dijkstra.stats.expanded - expanded))
+
+        return self
 
     def _make_edge_weight_func(self):
-        def fn(v, u, e):
-            return self.edge_weight(v, u, e)
+        def fn(e):
+            return self.edge_weight(e)
         return fn
 
-    def improve(self):
-        improved = True
+    def route_order(self, order, best_cost=None):
+        ''' Route the 2nets in the specified order, adding each path to
+            this configuration.  order is a list of indices into
+            raw_two_nets.  Any paths that we've already added that are
+            not a prefix of order are rewound first, so routing resumes
+            from the longest shared prefix.
+            best_cost may be a function that returns the cost of the
+            best configuration known so far; if we can't beat it then
+            we give up early.  Returns True if all of the nets were
+            routed within that budget. '''
+        current = self._order_indices()
+        shared = 0
+        while shared < len(current) and shared < len(order) and \
+                current[shared] == order[shared]:
+            shared += 1
+        self.rewind(shared)
+
+        cutoff = None
+        if best_cost is not None and shared > 0:
+            cutoff = best_cost() - self.compute_cost()
+            if cutoff < 0:
+                return False
+
+        for idx in order[shared:]:
+            n = self.two_nets[idx]
+            cost, path = n.find_path(
+                self._make_edge_weight_func(), cutoff=cutoff)
+            if cost is None:
+                # It's not possible to yield a better result
+                # than the best we already have
+                return False
+            self.add_path(Path(cost, n, path))
+            if best_cost is not None:
+                cutoff = best_cost() - self.compute_cost()
+                if cutoff < 0:
+                    # Can't do well enough to improve on this round
+                    return False
+        return True
+
+    def _order_indices(self):
+        ''' returns the assignment order as indices into raw_two_nets '''
+        return [self._index[n] for n in self.assignment_order]
+
+    def improve(self, deadline=10, workers=None):
+        ''' Try to find a lower cost configuration by moving each net
+            to the end of the assignment order in turn.
+            The candidate orderings for a pass are evaluated in a pool
+            of worker processes; the cost of the best configuration is
+            shared with the workers so that they can abandon hopeless
+            candidates early.
+            deadline is the number of seconds to spend looking for an
+            improvement, or None to try every candidate.
+            workers is the size of the process pool; None uses one per
+            cpu and 1 evaluates the candidates in this process.
+            The winner of each pass is the lowest cost candidate, with
+            ties going to the earliest candidate, so the result doesn't
+            depend on the worker count or scheduling, provided that
+            the deadline doesn't cut a pass short. '''
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
         best_cfg = self
-        import time
+        best_cost = multiprocessing.Value('d', self.compute_cost(), lock=False)
 
-        start = time.time()
+        pool = None
+        if workers <= 1:
+            _improve_worker_init(self.raw_two_nets, self.two_nets, best_cost)
+        else:
+            pool = multiprocessing.Pool(workers,
+                                        initializer=_improve_worker_init,
+                                        initargs=(self.raw_two_nets, self.two_nets,
+                                                  best_cost))
 
+        start = time.time()
         # Setting a deadline because there are a lot of combinations to
         # try and it is relatively expensive
-        deadline = start + 10
-        while improved and time.time() < deadline:
-            improved = False
+        if deadline is not None:
+            deadline = start + deadline
 
-            best_order = [x for x in best_cfg.assignment_order]
-            for i, node in enumerate(tqdm(best_order, desc='improving')):
-                if time.time() >= deadline:
-                    break
+        def expired():
+            return deadline is not None and time.time() >= deadline
 
-                order = [x for x in best_order]
-                order.insert(0, order.pop(i))
+        try:
+            improved = True
+            while improved and not expired():
+                improved = False
 
-                if order == best_order:
-                    continue
+                candidates = _candidate_orders(best_cfg._order_indices())
 
-                cfg = Configuration(self.raw_two_nets)
-                cutoff = None
-                failed = False
-                for n in tqdm(order, desc='pass %d' % i):
-                    cost, path = dijkstra.dijkstra(
-                        n.g, n.source, n.sink, edge_weight=cfg._make_edge_weight_func(), cutoff=cutoff)
-                    if cost is None:
-                        # It's not possible to yield a better result
-                        # than the best we already have
-                        failed = True
-                        break
-                    cfg.add_path(Path(cost, n, path))
-                    cutoff = best_cfg.compute_cost() - cfg.compute_cost()
-                    if cutoff <= 0:
-                        # Can't do well enough to improve on this round
-                        failed = True
-                        break
+                if pool:
+                    results = pool.imap(_improve_worker_evaluate, candidates)
+                else:
+                    results = (_improve_worker_evaluate(order)
+                               for order in candidates)
 
-                if not failed and cfg.compute_cost() < best_cfg.compute_cost():
-                    improved = True
+                winner = None
+                for order, cost in zip(candidates, tqdm(results, desc='improving',
+                                                        total=len(candidates))):
+                    if expired():
+                        break
+                    if cost is None:
+                        continue
+                    if cost < best_cost.value:
+                        best_cost.value = cost
+                    if winner is None or cost < winner[1]:
+                        winner = (order, cost)
+
+                if winner and winner[1] < best_cfg.compute_cost():
+                    # Re-run the winning order here so that the paths
+                    # reference our own graph nodes.  We leave self alone,
+                    # but after that we can resume from the prefix that
+                    # the winner shares with the previous best.
+                    previous_cost = best_cfg.compute_cost()
+                    if best_cfg is self:
+                        best_cfg = Configuration(self.raw_two_nets,
+                                                 self.two_nets)
+                    best_cfg.route_order(winner[0])
                     tqdm.write('Improved cost from %r to %r' %
-                               (best_cfg.compute_cost(), cfg.compute_cost()))
-                    best_cfg = cfg
+                               (previous_cost, best_cfg.compute_cost()))
+                    best_cost.value = best_cfg.compute_cost()
+                    improved = True
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        return best_cfg
+
+
+def _candidate_orders(best_order):
+    ''' Returns the orders to try in a pass of improve(); best_order with
+        each net in turn moved to the end.  Moving the net at position i
+        keeps the first i nets in place, so only the rest are re-routed.
+        The candidates run from the last position to the first so that
+        each shares its prefix with the one before it, too. '''
+    candidates = []
+    for i in reversed(range(0, len(best_order) - 1)):
+        order = [x for x in best_order]
+        order.append(order.pop(i))
+        candidates.append(order)
+    return candidates
+
+
+# State for the improve() worker processes.  Each worker keeps a single
+# Configuration and rewinds it between candidates.
+_worker_cfg = None
+_worker_best_cost = None
 
-        return cfg
+
+def _improve_worker_init(raw_two_nets, input_two_nets, best_cost):
+    global _worker_cfg
+    global _worker_best_cost
+
+    _worker_cfg = Configuration(raw_two_nets, input_two_nets)
+    _worker_best_cost = best_cost
+
+
+def _improve_worker_evaluate(order):
+    ''' Evaluate a candidate assignment order.  Returns its cost, or None
+        if it cannot beat the best known cost. '''
+    cfg = _worker_cfg
+    if not cfg.route_order(order, best_cost=lambda: _worker_best_cost.value):
+        return None
+    return cfg.compute_cost()
@@ -4,245 +4,276 @@ from shapely.geometry import Point as sPoint
 
 # Derived from https://github.com/Keydrain/Steiner-Tree-Visualization/blob/master/Steiner.py
 
+import multiprocessing
+import numpy
 from tqdm import tqdm
 from . import types
 
 
-class UnionFind:
-    '''Union-find data structure.
-    Each unionFind instance X maintains a family of disjoint sets of
-    hashable objects, supporting the following two methods:
-    - X[item] returns a name for the set containing the given item.
-      Each set is named by an arbitrarily-chosen one of its members; as
-      long as the set remains unchanged it will keep the same name. If
-      the item is not yet part of a set in X, a new singleton set is
-      created for it.
-    - X.union(item1, item2, ...) merges the sets containing each item
-      into a single larger set.  If any item is not yet part of a set
-      in X, it is added to X as one of the members of the merged set.
-
-    Based on Josiah Carlson's code,
-    http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/215912
-    with significant additional changes by D. Eppstein.
-    '''
-
-    def __init__(self):
-        """Create a new empty union-find structure."""
-        self.weights = {}
-        self.parents = {}
-
-    def __getitem__(self, obj):
-        """Find and return the name of the set containing the object."""
-
-        # check for previously unknown object
-        if obj not in self.parents:
-            self.parents[obj] = obj
-            self.weights[obj] = 1
-            return obj
-
-        # find path of objects leading to the root
-        path = [obj]
-        root = self.parents[obj]
-        while root != path[-1]:
-            path.append(root)
-            root = self.parents[root]
-
-        # compress the path and return
-        for ancestor in path:
-            self.parents[ancestor] = root
-        return root
-
-    def __iter__(self):
-        """Iterate through all items ever found or unioned by this structure."""
-        return iter(self.parents)
-
-    def union(self, *objects):
-        """Find the sets containing the objects and merge them all."""
-        roots = [self[x] for x in objects]
-        heaviest = max([(self.weights[r], r) for r in roots])[1]
-        for r in roots:
-            if r != heaviest:
-                self.weights[heaviest] += self.weights[r]
-                self.parents[r] = heaviest
-
-
 class Point(object):
-    def __init__(self, x, y, node=None):
+    def __init__(self, x, y, col=None, row=None):
         self.x = x
         self.y = y
-        self.reset()
-        # node is the input node.  If none then this is a Steiner point
-        self.node = node
-
-    def reset(self):
         self.deg = 0
-        self.edges = []
-        self.MSTedges = []
-
-    def update(self, edge):
-        self.edges.append(edge)
-
-    def MSTupdate(self, edge):
-        self.deg += 1
-        self.MSTedges.append(edge)
+        # The position of a Steiner point on the Hanan grid
+        self.col = col
+        self.row = row
 
     def __str__(self):
-        return 'x=%s, y=%s deg=%r edges=%d' % (self.x, self.y, self.deg, len(self.edges))
-
-
-class Line:
-    ''' Contains the two end points as well as the weight of the line. 
-    Supports determining the first or last point as well as the other given one. '''
-
-    def __init__(self, p1, p2, w):
-        self.points = [p1, p2]
-        self.w = w
-
-    def getOther(self, pt):
-        if pt == self.points[0]:
-            return self.points[1]
-        elif pt == self.points[1]:
-            return self.points[0]
-        else:
-            raise Exception(
-                "The line does not contain points that make sense.")
-
-    def getFirst(self):
-        return self.points[0]
-
-    def getLast(self):
-        return self.points[1]
-
-
-def hanan_points(input_points):
-    points = []
-    for i in range(0, len(input_points)):
-        for j in range(i, len(input_points)):
-            if i != j:
-                points.append(Point(input_points[i].x, input_points[j].y))
-                points.append(Point(input_points[j].x, input_points[i].y))
-    return points
-
-
-def delta_mst(points, point):
-    ''' Determines the difference in a MST's total weight after adding a point. '''
-    MST = kruskal(points)
-    cost1 = 0
-    for p in MST:
-        cost1 += p.w
-
-    combo = points + [point]
-    MST = kruskal(combo)
-    cost2 = 0
-    for p in MST:
-        cost2 += p.w
-
-    return cost1 - cost2
-
-
-def kruskal(points):
-    ''' Kruskal's Algorithm
-    Sorts edges by weight, and adds them one at a time to the tree while avoiding cycles
-    Takes any set of Point instances and converts to a dictionary via edge crawling 
-    Takes the dictionary and iterates through each level to discover neighbors and weights
-    Takes list of point index pairs and converts to list of Lines then returns
-    '''
-
-    for p in points:
-        p.reset()
-
-    for i in range(0, len(points)):
-        for j in range(i, len(points)):
-            if i != j:
-                dist = (abs(points[i].x - points[j].x)
-                        + abs(points[i].y - points[j].y))
-                line = Line(points[i], points[j], dist)
-                points[i].update(line)
-                points[j].update(line)
-            else:
-                dist = 100000
-                line = Line(points[i], points[j], dist)
-                points[i].update(line)
-
-    G = {}
-    for i in range(0, len(points)):
-        off = 0
-        subset = {}
-        for j in range(0, len(points[i].edges)):
-            subset[j] = points[i].edges[j].w
-        G[i] = subset
-
-    subtrees = UnionFind()
+        return 'x=%s, y=%s deg=%r' % (self.x, self.y, self.deg)
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def kruskal(xs, ys):
+    ''' Kruskal's Algorithm over the complete graph of the points
+    xs[i], ys[i] with rectilinear edge weights.
+    The edges are considered in (weight, i, j) order, which decides the
+    tree when there are ties.
+    Returns (cost, tree, deg): tree is the list of (i, j, weight) with
+    i < j in the order that they were added, cost is the sum of the
+    weights in that order and deg is the degree of each point. '''
+    n = len(xs)
+    deg = [0] * n
+    if n < 2:
+        return 0, [], deg
+
+    first, second = numpy.triu_indices(n, 1)
+    weights = (numpy.abs(xs[first] - xs[second]) +
+               numpy.abs(ys[first] - ys[second]))
+    order = numpy.lexsort((second, first, weights))
+
+    first = first[order].tolist()
+    second = second[order].tolist()
+    weights = weights[order].tolist()
+
+    parent = list(range(n))
     tree = []
-    for W, u, v in sorted((G[u][v], u, v) for u in G for v in G[u]):
-        if subtrees[u] != subtrees[v]:
-            tree.append([u, v])
-            subtrees.union(u, v)
-
-    MST = []
-    for i in range(0, len(tree)):
-        point1 = points[tree[i][0]]
-        point2 = points[tree[i][1]]
-        for edge in point1.edges:
-            if point2 == edge.getOther(point1):
-                point1.MSTupdate(edge)
-                point2.MSTupdate(edge)
-                MST.append(edge)
-    return MST
-
-
-def rectilinear_steiner_minimum_spanning_tree(list_of_nodes, net=None):
+    cost = 0
+    for i, j, w in zip(first, second, weights):
+        ri = _find(parent, i)
+        rj = _find(parent, j)
+        if ri == rj:
+            continue
+        parent[ri] = rj
+        tree.append((i, j, w))
+        cost += w
+        deg[i] += 1
+        deg[j] += 1
+        if len(tree) == n - 1:
+            break
+    return cost, tree, deg
+
+
+def steiner_gains(tree, dist):
+    ''' Computes the reduction in the weight of the minimum spanning tree
+    of a set of points from adding each of a batch of candidate points.
+    tree is the MST of the points, as returned by kruskal(), and
+    dist[c, i] is the distance from candidate c to point i.
+
+    The MST with the candidate is a subset of tree plus the edges from
+    the candidate.  Merging the points in the order of the edges of tree
+    produces a hierarchy of clusters in which the heaviest edge on the
+    tree path between two points is the one that first joined their
+    clusters.  A tree edge joining clusters A and B is replaced by an
+    edge to the candidate when the candidate is closer than that edge
+    to both A and B, so we only need the distance from each candidate
+    to the nearest point of each cluster. '''
+    n = dist.shape[1]
+    parent = list(range(n))
+    # The distance from each candidate to the closest point of the
+    # cluster rooted at each point
+    nearest = [dist[:, i] for i in range(n)]
+
+    gains = -dist.min(axis=1)
+    for i, j, w in tree:
+        ri = _find(parent, i)
+        rj = _find(parent, j)
+        a = nearest[ri]
+        b = nearest[rj]
+        gains += numpy.maximum(w - numpy.maximum(a, b), 0)
+        parent[ri] = rj
+        nearest[rj] = numpy.minimum(a, b)
+    return gains
+
+
+def steiner_tree(coords):
+    ''' Computes the rectilinear Steiner minimum spanning tree of the
+    (x, y) points in coords.
+    This only deals in plain coordinates so that it can be run in a
+    worker process; see steiner_trees().
+    Returns (steiner_points, edges): steiner_points is the list of the
+    (x, y) of the Steiner points and edges is the list of (i, j) index
+    pairs into coords + steiner_points. '''
     steiner_points = []
 
-    points = [Point(n.shape.centroid.x, n.shape.centroid.y, n)
-              for n in list_of_nodes]
+    points = [Point(x, y) for x, y in coords]
+
+    # Every Hanan point of the input points and the Steiner points that
+    # we pick from them lies on the grid formed by the x and y
+    # coordinates of the input points.  Each point is tracked by its
+    # (column, row) on that grid and candidates by their cell number.
+    grid_x, cols = numpy.unique([p.x for p in points], return_inverse=True)
+    grid_y, rows = numpy.unique([p.y for p in points], return_inverse=True)
+    cols = cols.tolist()
+    rows = rows.tolist()
+    num_rows = len(grid_y)
+    col_dist = numpy.abs(grid_x[:, None] - grid_x[None, :])
+    row_dist = numpy.abs(grid_y[:, None] - grid_y[None, :])
+
+    while True:
+        num_merged = len(points) + len(steiner_points)
+        if num_merged < 2:
+            break
 
-    RSMT = []
-    candidate_set = [0]  # Just to start the loop
-    while candidate_set:
-        max_point = None
+        merged_cols = numpy.array(cols + [p.col for p in steiner_points])
+        merged_rows = numpy.array(rows + [p.row for p in steiner_points])
+        merged_xs = grid_x[merged_cols]
+        merged_ys = grid_y[merged_rows]
+
+        # The Hanan points of the merged points; for each pair i < j
+        # these are (x[i], y[j]) then (x[j], y[i]).  Points that occur
+        # more than once score the same each time, so we only need to
+        # score the first occurrence, but track the last occurrence too.
+        first, second = numpy.triu_indices(num_merged, 1)
+        hanan_cols = numpy.stack([merged_cols[first], merged_cols[second]],
+                                 axis=1).ravel()
+        hanan_rows = numpy.stack([merged_rows[second], merged_rows[first]],
+                                 axis=1).ravel()
+        hanan = hanan_cols * num_rows + hanan_rows
+        cells, first_seen = numpy.unique(hanan, return_index=True)
+        last_seen = len(hanan) - 1 - numpy.unique(hanan[::-1],
+                                                  return_index=True)[1]
+        order = numpy.argsort(first_seen, kind='stable')
+        cells = cells[order]
+        last_seen = last_seen[order]
+        cand_cols = cells // num_rows
+        cand_rows = cells % num_rows
+
+        cost1, tree, _ = kruskal(merged_xs, merged_ys)
+        dist = (col_dist[cand_cols][:, merged_cols] +
+                row_dist[cand_rows][:, merged_rows])
+        gains = steiner_gains(tree, dist)
+
+        exact = {}
+
+        def exact_gain(c):
+            ''' Returns (gain, deg) for candidate c, computed by summing
+                the new MST in Kruskal order.  We use this to make the
+                decisions that are sensitive to rounding. '''
+            if c not in exact:
+                cost2, _, deg = kruskal(
+                    numpy.append(merged_xs, grid_x[cand_cols[c]]),
+                    numpy.append(merged_ys, grid_y[cand_rows[c]]))
+                exact[c] = (cost1 - cost2, deg)
+            return exact[c]
+
+        # Candidates that reduce the weight of the tree
+        tolerance = 1e-9 * max(1.0, cost1)
+        candidate_set = numpy.nonzero(gains > tolerance)[0].tolist()
+        for c in numpy.nonzero(abs(gains) <= tolerance)[0].tolist():
+            if exact_gain(c)[0] > 0:
+                candidate_set.append(c)
+        candidate_set.sort()
 
-        merged_points = points + steiner_points
-        candidate_set = [x for x in hanan_points(
-            merged_points) if delta_mst(merged_points, x) > 0]
+        max_point = None
+        if candidate_set:
+            best = gains[candidate_set].max()
+            cost = 0
+            for c in candidate_set:
+                if gains[c] >= best - tolerance:
+                    delta_cost = exact_gain(c)[0]
+                    if delta_cost > cost:
+                        max_point = c
+                        cost = delta_cost
+
+            # The degree of the existing Steiner points is that from the
+            # MST including the last of the candidates to be scored
+            last = max(candidate_set, key=lambda c: last_seen[c])
+        else:
+            last = int(numpy.argmax(last_seen))
 
-        cost = 0
-        for pt in candidate_set:
-            delta_cost = delta_mst(merged_points, pt)
-            if delta_cost > cost:
-                max_point = pt
-                cost = delta_cost
+        deg = exact_gain(last)[1]
+        for i, pt in enumerate(steiner_points):
+            pt.deg = deg[len(points) + i]
 
         # Remember the current set of steiner_points so that we can tell
         # when we need to terminate the loop; if we didn't mutate them
         # then there is no point continuing.
         before = [p for p in steiner_points]
-        if max_point:
-            steiner_points.append(max_point)
+        if max_point is not None:
+            col = int(cand_cols[max_point])
+            row = int(cand_rows[max_point])
+            pt = Point(grid_x[col].item(), grid_y[row].item(),
+                       col=col, row=row)
+            pt.deg = exact_gain(max_point)[1][-1]
+            steiner_points.append(pt)
 
         steiner_points = [pt for pt in steiner_points if pt.deg > 2]
 
-        RSMT = kruskal(points + steiner_points)
-
-        if before == steiner_points:
+        if before == steiner_points or not candidate_set:
             # The add/remove stuff above had no net effect, so terminate
             # the loop!
             break
 
-    def point_to_node(pt):
-        ''' converts a Steiner point (which by definition has node=None)
-            into a Branch node.  Make sure we do this only once as we
-            want to use that node in a graph later on.  This is as simple
-            as just assigning the node property to the generated Branch '''
-        if pt.node is None:
-            pt.node = types.Branch(sPoint(pt.x, pt.y), net=net)
-        return pt.node
-
-    # unpack the internal representation into something our caller can use
-    mst = []
-    for line in RSMT:
-        node_a = point_to_node(line.getFirst())
-        node_b = point_to_node(line.getLast())
-        mst.append((node_a, node_b))
-
-    return mst
+    merged_points = points + steiner_points
+    _, RSMT, _ = kruskal(numpy.array([p.x for p in merged_points]),
+                         numpy.array([p.y for p in merged_points]))
+
+    return ([(p.x, p.y) for p in steiner_points],
+            [(i, j) for i, j, _ in RSMT])
+
+
+def steiner_trees(list_of_coords, workers=None):
+    ''' Computes steiner_tree() for each of list_of_coords, returning
+    the results in the same order.
+    The trees are independent, so they are computed in a pool of
+    worker processes; None uses one per cpu and 1 computes them
+    in this process. '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(list_of_coords))
+
+    if workers <= 1:
+        return [steiner_tree(coords) for coords in
+                tqdm(list_of_coords, desc='steiner trees')]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # The larger nets take much longer than the rest, so hand
+        # them out one at a time
+        return list(tqdm(pool.imap(steiner_tree, list_of_coords,
+                                   chunksize=1),
+                         desc='steiner trees', total=len(list_of_coords)))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def tree_to_nodes(list_of_nodes, steiner_points, edges, net=None):
+    ''' Maps a tree computed by steiner_tree() for the centroids of
+    list_of_nodes back to the nodes, generating a Branch for each of the
+    Steiner points.  Returns the list of (node_a, node_b) edges. '''
+    nodes = list(list_of_nodes) + [None] * len(steiner_points)
+
+    def point_to_node(i):
+        ''' converts a Steiner point into a Branch node.  Make sure we do
+            this only once as we want to use that node in a graph later
+            on. '''
+        if nodes[i] is None:
+            x, y = steiner_points[i - len(list_of_nodes)]
+            nodes[i] = types.Branch(sPoint(x, y), net=net)
+        return nodes[i]
+
+    return [(point_to_node(i), point_to_node(j)) for i, j in edges]
+
+
+def rectilinear_steiner_minimum_spanning_tree(list_of_nodes, net=None):
+    coords = [(n.shape.centroid.x, n.shape.centroid.y) for n in list_of_nodes]
+    steiner_points, edges = steiner_tree(coords)
+    return tree_to_nodes(list_of_nodes, steiner_points, edges, net=net)
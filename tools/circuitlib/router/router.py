@@ -193,7 +193,12 @@ class RBSLayer(object):
         return 'RBSLayer %s with %d terminals' % (self.layer, len(self.terminals))
 
 
-def route(data, profile=False):
+def route(data, profile=False, improve_deadline=10, improve_workers=None):
+    ''' Compute the layer assignment and topological routing for data,
+        as produced by Circuit.computeRoutingData.
+        improve_deadline and improve_workers are passed to
+        Configuration.improve as the time budget (None for no limit)
+        and process pool size (None for one per cpu). '''
     cfg = layerassign.Configuration(data['2nets'])
     cfg = cfg.initial_assignment()
 
@@ -204,7 +209,8 @@ def route(data, profile=False):
         pr = cProfile.Profile()
         pr.enable()
 
-    cfg = cfg.improve()
+    cfg = cfg.improve(deadline=improve_deadline, workers=improve_workers)
+    tqdm.write('layer assignment path search: %s' % dijkstra.stats)
 
     if profile:
         pr.disable()
@@ -220,16 +226,7 @@ def route(data, profile=False):
         layers[layer] = RBSLayer(layer, tri)
 
     for path in tqdm(cfg.paths, desc='build rbs'):
-        for i, j in pairwise(path.path):
-            if isinstance(i, layerassign.SourceSinkNode):
-                continue
-            if isinstance(j, layerassign.SourceSinkNode):
-                continue
-            g = path.input_2net.g
-            edge = g[i][j]
-            line = edge.get('line')
-            if not line:
-                continue
+        for i, j, _ in path.segments():
             layer = i.layers[0]
             layers[layer].add_2net(i, j)
 
@@ -242,17 +239,19 @@ def route(data, profile=False):
 
     routed_graph = networkx.Graph()
     for path in tqdm(cfg.paths, desc='distil route'):
-        for i, j in pairwise(path.path):
+        g = path.input_2net.graph
+        for e in path.edges:
+            i = g.nodes[g.src[e]]
+            j = g.nodes[g.dst[e]]
             if isinstance(i, layerassign.SourceSinkNode):
                 continue
             if isinstance(j, layerassign.SourceSinkNode):
                 continue
-            g = path.input_2net.g
             layer = None
             #tqdm.write('path segment layers: %r %r' % (i.layers, j.layers))
             if i.layers == j.layers:
                 layer = i.layers[0]
-            cost = cfg.edge_weight(i, j, g[i][j])
+            cost = cfg.edge_weight(e)
             routed_graph.add_node(i)
             routed_graph.add_node(j)
             distance = i.shape.centroid.distance(j.shape.centroid)
@@ -261,6 +260,6 @@ def route(data, profile=False):
                                   collision=cost > distance *
                                   (1 - layerassign.ALPHA),
                                   layer=layer,
-                                  via=g[i][j].get('via'))
+                                  via=bool(g.via[e]))
 
     return routed_graph
@@ -6,9 +6,39 @@ from shapely.geometry import (Point, Polygon, MultiPolygon, CAP_STYLE,
 from shapely.ops import unary_union
 from shapely.affinity import (translate, scale, rotate)
 from shapely.validation import explain_validity
+from shapely.prepared import prep
+import shapely.wkb
 import shapely.wkt
+import hashlib
+import json
 import math
-from . import circuit as circuitlib
+import numpy
+import os
+from .. import filesystem
+
+# The results of make_shapes() are cached in this directory, keyed by
+# the layout, the shape_config and the code that computes them.
+SHAPE_CACHE_DIR = os.path.join('outputs', 'shape-cache')
+
+# The cache key includes the source of the modules below and the
+# footprints in SHAPE_FOOTPRINT_DIR, so changing them discards the cached
+# shapes.  If compute_shapes() comes to depend on any other code or data
+# then add it to _SHAPE_MODULES, or else bump SHAPE_CACHE_VERSION along
+# with every change to it; stale shapes would be served silently.
+SHAPE_CACHE_VERSION = 1
+
+# The modules, relative to tools/, whose code produces the shapes
+_SHAPE_MODULES = ('kle.py', 'circuitlib/shape.py', 'circuitlib/circuit.py',
+                  'circuitlib/component.py', 'circuitlib/kicadpcb.py')
+
+# compute_shapes() places the mounting holes from these footprints
+SHAPE_FOOTPRINT_DIR = os.path.join('kicad', 'clacker.pretty')
+
+# The shape_config settings that compute_shapes() uses.  The rest are
+# for the consumers of the shapes, so leaving them out of the cache key
+# lets the case and the pcb for the same layout share the shapes.
+SHAPE_CONFIG_KEYS = ('mcu', 'mcu_coords', 'trrs', 'rj45',
+                     'cirque_coords', 'azoteq_coords')
 
 
 def add_geoms(geoms, shape):
@@ -59,7 +89,327 @@ def find_corners(shape):
     return corners
 
 
-def make_shapes(layout, shape_config=None):
+def _tool_version():
+    ''' a digest of the code and footprints that compute the shapes '''
+    h = hashlib.sha1(str(SHAPE_CACHE_VERSION).encode('ascii'))
+    h.update(shapely.__version__.encode('ascii'))
+    tools_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    files = [(name, os.path.join(tools_dir, name)) for name in _SHAPE_MODULES]
+    if os.path.isdir(SHAPE_FOOTPRINT_DIR):
+        files += [(name, os.path.join(SHAPE_FOOTPRINT_DIR, name))
+                  for name in sorted(os.listdir(SHAPE_FOOTPRINT_DIR))]
+    for name, filename in files:
+        h.update(name.encode('utf-8') + b'\0')
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def shapes_cache_key(layout, shape_config=None):
+    ''' Returns the key under which the shapes for layout are cached,
+        or None if the layout cannot be cached because it wasn't
+        loaded from a file. '''
+    if layout.digest is None:
+        return None
+    config = dict((k, v) for k, v in (shape_config or {}).items()
+                  if k in SHAPE_CONFIG_KEYS)
+    h = hashlib.sha1()
+    h.update(layout.digest.encode('ascii'))
+    h.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+    h.update(_tool_version().encode('ascii'))
+    return h.hexdigest()
+
+
+def save_shapes(shapes, dirname):
+    ''' Saves the dict returned by compute_shapes() into dirname.
+        The geometry is concatenated as WKB into shapes.wkb and
+        manifest.json records the (offset, length) of each item. '''
+    blobs = []
+    offset = [0]
+
+    def add(geom):
+        data = shapely.wkb.dumps(geom)
+        blobs.append(data)
+        entry = [offset[0], len(data)]
+        offset[0] += len(data)
+        return entry
+
+    manifest = {}
+    for name, value in shapes.items():
+        if value is None:
+            manifest[name] = None
+        elif isinstance(value, tuple):
+            manifest[name] = {'tuple': list(value)}
+        elif isinstance(value, list):
+            manifest[name] = {'wkb_list': [add(g) for g in value]}
+        else:
+            manifest[name] = {'wkb': add(value)}
+
+    # Write into a temporary directory and then rename it into place so
+    # that a concurrent or interrupted build never sees a partial entry
+    filesystem.mkdir_p(os.path.dirname(dirname))
+    tmpdir = '%s.tmp%d' % (dirname, os.getpid())
+    filesystem.mkdir_p(tmpdir)
+    with open(os.path.join(tmpdir, 'shapes.wkb'), 'wb') as f:
+        for data in blobs:
+            f.write(data)
+    with open(os.path.join(tmpdir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=1)
+    try:
+        os.rename(tmpdir, dirname)
+    except OSError:
+        # Someone else got there first; their result is the same as ours
+        for name in os.listdir(tmpdir):
+            os.unlink(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+
+def load_shapes(dirname):
+    ''' Loads the shapes saved by save_shapes(), or returns None if
+        there are none. '''
+    try:
+        with open(os.path.join(dirname, 'manifest.json')) as f:
+            manifest = json.load(f)
+        with open(os.path.join(dirname, 'shapes.wkb'), 'rb') as f:
+            data = f.read()
+    except (IOError, OSError, ValueError):
+        return None
+
+    def load(entry):
+        offset, length = entry
+        return shapely.wkb.loads(data[offset:offset + length])
+
+    shapes = {}
+    for name, entry in manifest.items():
+        if entry is None:
+            shapes[name] = None
+        elif 'tuple' in entry:
+            shapes[name] = tuple(entry['tuple'])
+        elif 'wkb_list' in entry:
+            shapes[name] = [load(e) for e in entry['wkb_list']]
+        else:
+            shapes[name] = load(entry['wkb'])
+    return shapes
+
+
+def _edges(shape):
+    ''' returns the (x1, y1, x2, y2) arrays of the edges of the rings
+        of the polygons in shape '''
+    rings = []
+    polygons = []
+    add_geoms(polygons, shape)
+    for polygon in polygons:
+        if polygon.is_empty or not hasattr(polygon, 'exterior'):
+            continue
+        rings.append(polygon.exterior.coords)
+        rings.extend(interior.coords for interior in polygon.interiors)
+    if not rings:
+        return [numpy.zeros(0)] * 4
+    coords = [numpy.asarray(ring) for ring in rings]
+    start = numpy.concatenate([c[:-1] for c in coords])
+    end = numpy.concatenate([c[1:] for c in coords])
+    return start[:, 0], start[:, 1], end[:, 0], end[:, 1]
+
+
+def rasterize(shape, x0, y0, nx, ny, step=1.0):
+    ''' Returns an (ny, nx) boolean array that is True for the cells of
+        the grid with its origin at (x0, y0) whose centers lie inside
+        shape, using the even-odd rule.  Each edge toggles the cells to
+        the right of where it crosses the center line of each row. '''
+    x1, y1, x2, y2 = _edges(shape)
+
+    # The rows whose center line the edge crosses; a center on the upper
+    # end of an edge counts as crossing it and one on the lower end not
+    lo = numpy.minimum(y1, y2)
+    hi = numpy.maximum(y1, y2)
+    first = numpy.clip(numpy.floor((lo - y0) / step - 0.5) + 1, 0, ny)
+    last = numpy.clip(numpy.floor((hi - y0) / step - 0.5) + 1, 0, ny)
+    counts = (last - first).astype(numpy.int64)
+    counts[counts < 0] = 0
+    if counts.sum() == 0:
+        return numpy.zeros((ny, nx), dtype=bool)
+
+    edge = numpy.repeat(numpy.arange(len(x1)), counts)
+    offset = numpy.arange(len(edge)) - numpy.repeat(
+        numpy.cumsum(counts) - counts, counts)
+    rows = first[edge].astype(numpy.int64) + offset
+    yc = y0 + (rows + 0.5) * step
+    t = (yc - y1[edge]) / (y2[edge] - y1[edge])
+    xs = x1[edge] + t * (x2[edge] - x1[edge])
+    cols = numpy.clip(numpy.floor((xs - x0) / step - 0.5) + 1,
+                      0, nx).astype(numpy.int64)
+    toggles = numpy.bincount(rows * (nx + 1) + cols,
+                             minlength=ny * (nx + 1)) % 2
+    toggles = toggles.astype(numpy.uint8).reshape(ny, nx + 1)
+    return numpy.bitwise_xor.accumulate(toggles, axis=1)[:, :nx] == 1
+
+
+def summed_area_table(mask):
+    ''' sat[r, c] is the number of set cells in mask[:r, :c] '''
+    ny, nx = mask.shape
+    sat = numpy.zeros((ny + 1, nx + 1), dtype=numpy.int32)
+    sat[1:, 1:] = mask.cumsum(axis=0, dtype=numpy.int32).cumsum(axis=1)
+    return sat
+
+
+def _window_sums(sat, rows, cols, r0, c0, h, w):
+    ''' Returns an array of the number of set cells in the h x w
+        rectangle at (r0 + j, c0 + i) for each j < rows and i < cols '''
+    r1 = r0 + h
+    c1 = c0 + w
+    return (sat[r1:r1 + rows, c1:c1 + cols] -
+            sat[r0:r0 + rows, c1:c1 + cols] -
+            sat[r1:r1 + rows, c0:c0 + cols] +
+            sat[r0:r0 + rows, c0:c0 + cols])
+
+
+def _mask_rectangles(mask):
+    ''' Decomposes a boolean mask into a list of (row, col, height, width)
+        rectangles by merging runs of identical rows; an axis aligned box
+        is a single rectangle. '''
+    rects = []
+    open_runs = {}
+    previous = None
+    for r, row in enumerate(mask.tolist() + [[]]):
+        runs = []
+        c = 0
+        while c < len(row):
+            if row[c]:
+                start = c
+                while c < len(row) and row[c]:
+                    c += 1
+                runs.append((start, c - start))
+            c += 1
+        if runs != previous:
+            for (col, width), top in open_runs.items():
+                rects.append((top, col, r - top, width))
+            open_runs = dict((run, r) for run in runs)
+            previous = runs
+    return rects
+
+
+def find_space(hull, avoid, shape, padding=5, rotations=(0,), step=1.0,
+               at_edge=True):
+    ''' Find somewhere to put shape such that it does not intersect
+        avoid and has the largest overlap with the rest of hull.
+        Candidate positions are on a grid of the given step, starting at
+        the top left of the hull and extending padding grid steps past
+        its left and right edges.  Each of the rotations (in degrees)
+        is tried.  If at_edge is True the top of the shape must be at or
+        above the top edge of the hull, which is where the sockets need
+        to be.
+
+        The hull, avoid and shape are rasterized onto the grid and summed
+        area tables score and bound the overlap at every position at once.
+        The positions that the raster thinks are clear are then scored
+        exactly against the real geometry, best bound first, until none
+        of the rest can do better.  The bounds assume that hull is convex.
+        Returns the placed shape. '''
+    component_space = hull.symmetric_difference(avoid)
+    bounds = component_space.envelope.bounds
+    prepared_avoid = prep(avoid)
+
+    parts = []
+    for angle in rotations:
+        part = rotate(shape, angle, origin=(0, 0)) if angle else shape
+        part = translate(part, -part.bounds[0], -part.bounds[1])
+        part_w = int(math.ceil(part.bounds[2] / step))
+        part_h = int(math.ceil(part.bounds[3] / step))
+        mask = rasterize(part, 0, 0, part_w, part_h, step)
+        parts.append((part, part_w, part_h, _mask_rectangles(mask)))
+
+    # The grid has a spare row at the top for the edge test
+    x0 = int(bounds[0]) - padding * step
+    y0 = bounds[1] - step
+    cols = int(round((int(bounds[2]) + padding * step - x0) / step))
+    rows = max(1, int(math.ceil((bounds[3] - bounds[1]) / step)))
+    nx = cols + max(p[1] for p in parts)
+    ny = rows + max(p[2] for p in parts) + 1
+    xs = x0 + step * numpy.arange(cols)
+    ys = y0 + step * (numpy.arange(rows) + 1)
+
+    # The cells whose centers are in the hull and the cells that touch it
+    centers = rasterize(hull, x0, y0, nx, ny, step)
+    corners = rasterize(hull, x0 - step / 2, y0 - step / 2,
+                        nx + 1, ny + 1, step)
+    touched = centers | corners[:-1, :-1] | corners[1:, :-1] | \
+        corners[:-1, 1:] | corners[1:, 1:]
+    for x, y in hull.exterior.coords if hasattr(hull, 'exterior') else []:
+        c = int((x - x0) // step)
+        r = int((y - y0) // step)
+        if 0 <= r < ny and 0 <= c < nx:
+            touched[r, c] = True
+    inside = summed_area_table(centers)
+    upper = summed_area_table(touched)
+    blocked = summed_area_table(rasterize(avoid, x0, y0, nx, ny, step))
+
+    cell = step * step
+    candidates = []
+    for n, (part, part_w, part_h, rects) in enumerate(parts):
+        score = numpy.zeros((rows, cols), dtype=numpy.int32)
+        most = numpy.zeros((rows, cols), dtype=numpy.int32)
+        clash = numpy.zeros((rows, cols), dtype=numpy.int32)
+        for r, c, h, w in rects:
+            score += _window_sums(inside, rows, cols, r + 1, c, h, w)
+            most += _window_sums(upper, rows, cols, r + 1, c, h, w)
+            clash += _window_sums(blocked, rows, cols, r + 1, c, h, w)
+        valid = clash == 0
+        if at_edge:
+            # the row above the shape must be clear of the hull
+            valid &= _window_sums(inside, rows, cols, 0, 0, 1, part_w) == 0
+
+        j, i = numpy.nonzero(valid)
+        most = numpy.minimum(most[j, i] * cell, part.area)
+        candidates.append((most, score[j, i], numpy.full(len(j), n), j, i))
+
+    most, score, which, j, i = [numpy.concatenate(c)
+                                for c in zip(*candidates)]
+    if len(most) == 0:
+        raise Exception('could not place component')
+
+    # Score the positions exactly, starting with the highest upper bound,
+    # then the raster score, then closest to the top edge and then
+    # leftmost.  We can stop once no remaining position could beat the
+    # best so far.
+    order = numpy.lexsort((i, j, -score, -most))
+    best = None
+    for n in order:
+        if best and most[n] <= best[0]:
+            break
+        part = parts[which[n]][0]
+        candidate = translate(part, xs[i[n]], ys[j[n]])
+        if prepared_avoid.intersects(candidate):
+            continue
+        overlap = component_space.intersection(candidate).area
+        if (not best) or (overlap > best[0]):
+            best = (overlap, candidate)
+
+    if not best:
+        raise Exception('could not place component')
+    return best[1]
+
+
+def make_shapes(layout, shape_config=None, cache_dir=SHAPE_CACHE_DIR):
+    ''' Returns the dict of shapes computed by compute_shapes(), loading
+        them from cache_dir if they have already been computed for the
+        same layout and shape_config.  Pass cache_dir=None to always
+        compute them. '''
+    key = shapes_cache_key(layout, shape_config) if cache_dir else None
+    if key is None:
+        return compute_shapes(layout, shape_config=shape_config)
+
+    dirname = os.path.join(cache_dir, key)
+    shapes = load_shapes(dirname)
+    if shapes is not None:
+        print('Using cached shapes %s' % dirname)
+        return shapes
+
+    shapes = compute_shapes(layout, shape_config=shape_config)
+    save_shapes(shapes, dirname)
+    return shapes
+
+
+def compute_shapes(layout, shape_config=None):
     # First pass to compute some shapes
     cap_holes = []
     raw_cap_holes = []
@@ -105,22 +455,6 @@ def make_shapes(layout, shape_config=None):
     # so we're trying to find the location with the largest overlap; once found,
     # we can include the components in the hull and continue with the rest of
     # the placement below.
-    def find_space(hull, avoid, shape, padding=5):
-        component_space = hull.symmetric_difference(avoid)
-        bounds = component_space.envelope.bounds
-        best = None
-        for x in range(int(bounds[0]) - padding, int(bounds[2]) + padding):
-            candidate = translate(shape, x, bounds[1])
-            if avoid.intersects(candidate):
-                continue
-            overlap = component_space.intersection(candidate).area
-            if (not best) or (overlap > best[0]):
-                best = (overlap, candidate)
-
-        if not best:
-            raise Exception('could not place component')
-        return best[1]
-
     mcu_type = shape_config.get('mcu', 'feather') if shape_config else 'feather'
     if mcu_type == 'feather':
         mcu_dims = (23, 51)
@@ -237,6 +571,9 @@ def make_shapes(layout, shape_config=None):
     bottom_plate = overall_hull
 
 
+    # This is only needed for the footprints, and is expensive to import
+    from . import circuit as circuitlib
+
     mounting_holes = []
     circuit = circuitlib.Circuit()
     if mcu_type == 'feather':
@@ -0,0 +1,335 @@
+''' An optional resident server that keeps the targets loaded.
+
+    `clacker.py daemon` loads the info files once and then runs the
+    commands of the other invocations of clacker.py that connect to it
+    over a unix domain socket in the outputs dir.  That saves them the
+    cost of importing the tools and evaluating the info files, and keeps
+    the board prefs and the build log in memory between builds.
+
+    The client passes its stdout and stderr to the daemon, which runs the
+    command with them in place of its own and then sends back the exit
+    status.  If the client goes away while its command is running, as it
+    does when it is interrupted with ctrl-c, the daemon interrupts the
+    command too, so that it is free for the next client.  Before each
+    command the daemon checks the info.py files and the keyboard layouts
+    that the targets were loaded from, and loads them all again if any of
+    them have changed.  `clacker.py clean`
+    stops the daemon first, as it removes the socket with the rest of
+    the outputs.
+
+    This module is imported by every client, so it only imports the rest
+    of the tools when it is running as the daemon.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+
+import array
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+SOCKET = os.path.join('outputs', '.clacker-daemon')
+
+# The subcommands that the daemon runs for its clients
+COMMANDS = ('build', 'upload', 'test', 'list-firmware', 'list-tests',
+            'gen-pcb', 'gen-case')
+
+
+class ClientHungUp(BaseException):
+    ''' Raised in the command that the daemon is running when its client
+        goes away.  Like KeyboardInterrupt, it isn't an Exception, so
+        that the command doesn't catch it. '''
+
+
+def _send_fds(sock, fds):
+    sock.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                           array.array('i', fds))])
+
+
+def _recv_fds(sock, maxfds):
+    fds = array.array('i')
+    _, ancdata, _, _ = sock.recvmsg(
+        1, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    return list(fds)
+
+
+def _connect():
+    ''' Returns a socket connected to the daemon, or None if it
+        isn't running '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET)
+    except (IOError, OSError):
+        sock.close()
+        return None
+    return sock
+
+
+def run_client(argv):
+    ''' Runs the command in argv in the daemon, if it is running and it
+        can run that command.  Returns the exit status, or None if the
+        command should be run by this process instead. '''
+    if not argv or argv[0] not in COMMANDS:
+        return None
+    if '--watch' in argv:
+        # The watch mode runs until it is interrupted, and would keep the
+        # daemon from serving anyone else all that time
+        return None
+    sock = _connect()
+    if sock is None:
+        return None
+
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _send_fds(sock, [sys.stdout.fileno(), sys.stderr.fileno()])
+        request = {'argv': argv, 'cwd': os.getcwd()}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        reply = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+
+    if not reply:
+        sys.stderr.write('the clacker daemon exited while running %s\n' %
+                         ' '.join(argv))
+        return 1
+    return json.loads(reply.decode('utf-8'))['status']
+
+
+def stop():
+    ''' Asks the daemon to exit once it has finished any command that it
+        is running, and waits for it to remove its socket.  Returns True
+        if it was running. '''
+    sock = _connect()
+    if sock is None:
+        return False
+
+    try:
+        # The same as a command, but without passing any fds
+        sock.sendall(b'F' + json.dumps({'stop': True}).encode('utf-8') +
+                     b'\n')
+        sock.makefile('rb').readline()
+    finally:
+        sock.close()
+
+    for _ in range(50):
+        if not os.path.exists(SOCKET):
+            break
+        time.sleep(0.1)
+    return True
+
+
+class _HangupMonitor(object):
+    ''' Watches the connection to a client while its command runs, and
+        calls hangup() if the client closes it.  The client sends nothing
+        after its request, so the connection only becomes readable when
+        it is closed. '''
+
+    def __init__(self, conn, hangup):
+        self.conn = conn
+        self.hangup = hangup
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._watch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _watch(self):
+        poller = select.poll()
+        poller.register(self.conn.fileno(), select.POLLIN)
+        while not self.done.is_set():
+            if not poller.poll(100):
+                continue
+            try:
+                data = self.conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                self.hangup()
+            return
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+
+
+class Daemon(object):
+    ''' Serves the clients once the info files under dir have been
+        loaded.  run(argv) runs a command in this process. '''
+
+    def __init__(self, dir, run):
+        self.dir = dir
+        self.run = run
+        self.inputs = None
+        self.stopping = False
+        self.running = False
+        # The number of SIGINTs that we have sent ourselves because a
+        # client went away, which the handler hasn't yet seen
+        self._hangups = 0
+        self._main_thread = None
+
+    def _stat_inputs(self):
+        ''' The stat info of the info files, the dirs that were searched
+            for them and the keyboard layouts '''
+        from . import infofile
+        from . import keymatrix
+
+        inputs = {}
+        for path in infofile.loaded_from + keymatrix.layout_files():
+            try:
+                st = os.stat(path)
+                inputs[path] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                inputs[path] = None
+        return inputs
+
+    def _load(self):
+        from . import infofile
+
+        infofile.reload_info_files(self.dir)
+        self.inputs = self._stat_inputs()
+
+    def serve(self):
+        from . import filesystem
+
+        if _connect() is not None:
+            raise Exception('the clacker daemon is already running')
+
+        self.inputs = self._stat_inputs()
+
+        filesystem.mkdir_p(os.path.dirname(SOCKET))
+        try:
+            os.unlink(SOCKET)
+        except OSError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(SOCKET)
+        sock.listen(5)
+        print('clacker daemon is listening on %s' % SOCKET)
+        sys.stdout.flush()
+
+        # Remove the socket when we are killed, too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self._main_thread = threading.main_thread().ident
+        signal.signal(signal.SIGINT, self._on_sigint)
+
+        try:
+            while not self.stopping:
+                conn, _ = sock.accept()
+                try:
+                    self._handle(conn)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    conn.close()
+        finally:
+            sock.close()
+            try:
+                os.unlink(SOCKET)
+            except OSError:
+                # `clacker.py clean` may have removed it already
+                pass
+
+    def _hangup(self):
+        ''' Called by the _HangupMonitor of the running command '''
+        self._hangups += 1
+        signal.pthread_kill(self._main_thread, signal.SIGINT)
+
+    def _on_sigint(self, signum, frame):
+        if self._hangups:
+            self._hangups -= 1
+            if self.running:
+                raise ClientHungUp()
+            # The command finished before the signal arrived
+            return
+        raise KeyboardInterrupt()
+
+    def _handle(self, conn):
+        fds = _recv_fds(conn, 2)
+        try:
+            request = json.loads(
+                conn.makefile('rb').readline().decode('utf-8'))
+            if request.get('stop'):
+                print('clacker daemon is stopping')
+                sys.stdout.flush()
+                self.stopping = True
+                status = 0
+            elif len(fds) != 2 or os.path.realpath(request['cwd']) != \
+                    os.path.realpath(os.getcwd()):
+                # The paths of the targets are relative to our cwd, so
+                # let the client run this one itself
+                status = None
+            else:
+                try:
+                    status = self._run_with_output(request['argv'], fds,
+                                                   conn)
+                except ClientHungUp:
+                    print('Interrupted %s as its client went away' %
+                          ' '.join(request['argv']))
+                    sys.stdout.flush()
+                    return
+            try:
+                conn.sendall(json.dumps({'status': status}).encode('utf-8') +
+                             b'\n')
+            except OSError:
+                # The client went away just as its command finished
+                pass
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _run_with_output(self, argv, fds, conn):
+        ''' Runs argv with its stdout and stderr going to fds, while
+            watching conn for the client going away '''
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = [os.dup(1), os.dup(2)]
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        monitor = _HangupMonitor(conn, self._hangup)
+        self.running = True
+        try:
+            return self._run(argv)
+        finally:
+            self.running = False
+            monitor.stop()
+            for f in (sys.stdout, sys.stderr):
+                try:
+                    f.flush()
+                except (IOError, OSError):
+                    # The client's output may have gone with it
+                    pass
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+    def _run(self, argv):
+        from . import buildlog
+
+        try:
+            if self._stat_inputs() != self.inputs:
+                print('Reloading the info files')
+                self._load()
+            if buildlog.log is not None:
+                buildlog.log.forget_stats()
+            self.run(argv)
+            return 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            sys.stderr.write('%s\n' % e.code)
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
@@ -1,14 +1,29 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import copy
 import os
-import re
 
+from . import buildlog
 from . import targets
 from . import board
 from . import library
 from . import projectdir
 from . import filesystem
+from . import objcache
+from . import scheduler
+
+
+def _run_step(output, commands, inputs, run):
+    ''' Calls run() to build output from the ordered list of inputs with
+        commands, unless the build log says that it is up to date '''
+    if not commands:
+        return
+    log = buildlog.get()
+    command = '; '.join(' '.join(cmd) for cmd in commands)
+    if log.needs_build(output, command, inputs):
+        run()
+        log.record_step(output, command, inputs)
 
 
 class Linkable(targets.Target):
@@ -43,53 +58,40 @@ class Linkable(targets.Target):
     def get_deps(self):
         return [self.lib]
 
-    def _build_library(self, lib, outputs):
-        # print('Build library %s' % lib.full_name)
+    def get_inputs(self):
+        ''' The inputs of all of our deps, plus the headers that the
+            compiler said our objects depend on when it last built them '''
+        outputs = os.path.realpath(
+            os.path.join(
+                'outputs',
+                self.full_name.replace(':', '/')))
 
-        def check_depfile(objfile, depfile, srcfile, ext):
-            ''' reads a makefile compatible dependency file.
-                Returns True if the object needs to be compiled,
-                False if it is up to date. '''
-            try:
-                obj_stat = os.lstat(objfile)
-            except:
-                # doesn't exist, so compile it
-                # print('%s not present' % depfile)
-                return True
-
-            if not os.path.exists(depfile):
-                # do a basic mtime check
-                src_stat = os.lstat(srcfile)
-                return src_stat.st_mtime > obj_stat.st_mtime
-
-            with open(depfile, 'r') as f:
-                blob = f.read()
-                blob = blob.replace('\\', ' ')
-                blob = re.sub(r'\s+', ' ', blob)
-                lines = blob.strip().split(' ')
-                # The first line is our own object, the rest are the deps
-                for dep in lines[1:]:
-                    try:
-                        dep_stat = os.lstat(dep)
-                        if dep_stat.st_mtime > obj_stat.st_mtime:
-                            # It changed more recently, so recompile
-                            # print('%s newer than %s' % (dep, objfile))
-                            return True
-                    except Exception as e:
-                        # It doesn't exist, so recompile
-                        # print('failed to stat %s: %s. depfile is %s' % (dep, str(e), depfile))
-                        return True
-
-            # Up to date!
-            return False
+        inputs = set(super(Linkable, self).get_inputs())
+        for d in self._expand_deps():
+            inputs.update(d.get_inputs())
+            if isinstance(d, library.Library):
+                inputs.update(d.get_srcs(self.board))
+        inputs.update(buildlog.get().deps_under(outputs))
+        return sorted(inputs)
+
+    def _build_library(self, lib, outputs, sched):
+        ''' Adds the jobs to build lib to sched.
+            Returns (outputs, jobs): the objects or library that lib
+            produces and the jobs that produce them. '''
+        # print('Build library %s' % lib.full_name)
 
+        log = buildlog.get()
         srcs = lib.get_srcs(self.board)
         objs = []
+        compiles = []
 
         libname = os.path.join(outputs, lib.full_name.replace(':', '/')) + '.a'
         filesystem.mkdir_p(os.path.dirname(libname))
         # print('Should make lib %s' % libname)
 
+        cppflags = ' '.join(
+            self.cppflags + lib.get_cppflags_for_compile(self.board) + ['-I%s' % projectdir.Root])
+
         for s in srcs:
             name, ext = os.path.splitext(s)
             if os.path.isabs(name):
@@ -100,38 +102,35 @@ class Linkable(targets.Target):
 
             filesystem.mkdir_p(os.path.dirname(ofile))
 
-            if check_depfile(ofile, depfile, s, ext):
-                print(' COMPILE %s from %s' % (os.path.relpath(ofile), s))
+            command = ' '.join(self.board.compile_command(
+                s, ofile, depfile, cppflags))
 
-                cppflags = ' '.join(
-                    self.cppflags + lib.get_cppflags_for_compile(self.board) + ['-I%s' % projectdir.Root])
+            if log.needs_build(ofile, command):
+                def compile(s=s, ofile=ofile, depfile=depfile,
+                            cppflags=cppflags, command=command):
+                    self.board.compile_src(s, ofile, depfile, cppflags)
+                    log.record(ofile, command, depfile, s)
 
-                self.board.compile_src(s, ofile, depfile, cppflags)
+                compiles.append(sched.add(ofile, compile))
 
             objs.append(ofile)
 
         if not objs or lib.no_dot_a:
             # Nothing to link; header only library
-            return objs
-
-        need_link = False
-        try:
-            lib_stat = os.lstat(libname)
-            for o in objs:
-                obj_stat = os.lstat(o)
-                if obj_stat.st_mtime > lib_stat.st_mtime:
-                    need_link = True
-                    break
-
-        except:
-            need_link = True
+            return objs, compiles
 
-        if need_link:
-            self.board.link_lib(libname, objs)
+        def archive():
+            # An object from the object cache keeps the mtime that it
+            # had when it was first compiled, which may be older than
+            # the library, so we go by the build log rather than mtimes
+            _run_step(libname, self.board.link_lib_commands(libname, objs),
+                      objs, lambda: self.board.link_lib(libname, objs))
 
-        return [libname]
+        return [libname], [sched.add(libname, archive, deps=compiles)]
 
-    def build(self):
+    def build(self, jobs=None):
+        ''' Builds the target, running up to jobs compiles at once;
+            None runs one per cpu. '''
         print('Build %s' % self.full_name)
 
         # Compute outputs dir
@@ -142,15 +141,22 @@ class Linkable(targets.Target):
         filesystem.mkdir_p(outputs)
 
         deps = self._expand_deps() + self.board.injected_deps()
+        cache_stats = copy.copy(objcache.get().stats)
 
+        # All of the compiles for all of the libraries go into one DAG,
+        # so that they can run concurrently
+        sched = scheduler.Scheduler(jobs)
         objs = []
         libs = []
+        link_deps = []
         for d in deps:
             if not isinstance(d, library.Library):
                 #  print('* Nothing to build for %s' % d.full_name)
                 continue
 
-            for obj in self._build_library(d, outputs):
+            produced, lib_jobs = self._build_library(d, outputs, sched)
+            link_deps += lib_jobs
+            for obj in produced:
                 _, ext = os.path.splitext(obj)
                 if ext == '.a':
                     libs.insert(0, obj)
@@ -158,10 +164,26 @@ class Linkable(targets.Target):
                     objs.append(obj)
 
         exe = os.path.join(outputs, '%s.elf' % self.name)
-        self.board.link_exe(exe, objs + libs)
-
         hex = os.path.join(outputs, '%s.hex' % self.name)
-        self.board.exe_to_hex(exe, hex)
+
+        def link():
+            inputs = objs + libs
+            _run_step(exe, self.board.link_exe_commands(exe, inputs),
+                      inputs, lambda: self.board.link_exe(exe, inputs))
+            _run_step(hex, self.board.exe_to_hex_commands(exe, hex),
+                      [exe], lambda: self.board.exe_to_hex(exe, hex))
+
+        sched.add(exe, link, deps=link_deps)
+        try:
+            sched.run()
+        finally:
+            # Remember what we did build, even if some of it failed
+            buildlog.get().save()
+            objcache.get().trim()
+
+        stats = objcache.get().stats - cache_stats
+        if stats.hits or stats.misses:
+            print('Object cache: %s' % stats)
 
 
 class Firmware(Linkable):
@@ -1,45 +1,158 @@
+''' Finds and evaluates the info.py files that define the targets.
+
+    Every invocation of clacker.py does this, so we keep a cache of the
+    list of info.py files and of their compiled code in outputs.  The list
+    is reused while none of the directories that we searched have changed
+    mtime; adding or removing an entry changes the mtime of its directory.
+    The code of each file is reused while its mtime and size are the same.
+'''
 from __future__ import absolute_import
 from __future__ import print_function
+import marshal
 import os
 import string
+import sys
 
 from . import (
     board,
     case,
+    filesystem,
     firmware,
     keymatrix,
     library,
     pcb,
     projectdir,
+    targets,
     test
 )
 
+INFO_CACHE = os.path.join('outputs', '.info_cache')
+INFO_CACHE_VERSION = 1
 
-def load_info_files(dir):
-    ''' evaluate the info files that exist under the specified dir '''
-    for infodir, _, files in os.walk(dir):
-        if 'info.py' in files:
-            load_info_file(os.path.join(infodir, 'info.py'))
+# The info files and the dirs that were searched for them by the
+# last call to load_info_files()
+loaded_from = []
 
 
-def load_info_file(filename):
-    projectdir.set(os.path.dirname(filename))
-    with open(filename, 'r') as f:
-        code = compile(f.read(), filename, 'exec')
-        g = {}
+def _cache_version():
+    # marshalled code can only be loaded by the same version of python
+    return '%d %s' % (INFO_CACHE_VERSION, sys.version)
+
+
+def _load_cache():
+    try:
+        with open(INFO_CACHE, 'rb') as f:
+            data = marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != _cache_version():
+        return None
+    return data
+
+
+def _save_cache(data):
+    filesystem.mkdir_p(os.path.dirname(INFO_CACHE))
+    tmp = '%s.tmp%d' % (INFO_CACHE, os.getpid())
+    with open(tmp, 'wb') as f:
+        marshal.dump(data, f)
+    os.rename(tmp, INFO_CACHE)
+
+
+def _dirs_unchanged(dirs):
+    for path, mtime in dirs.items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _walk(dir, files, dirs):
+    ''' Adds the info.py files under dir to files and the mtime of each
+        directory that we searched to dirs.  We stat the directory before
+        we list it, so that a change made while we are looking is seen
+        the next time around. '''
+    dirs[dir] = os.stat(dir).st_mtime_ns
+    entries = sorted(os.scandir(dir), key=lambda e: e.name)
+    if any(e.name == 'info.py' for e in entries):
+        files.append(os.path.join(dir, 'info.py'))
+    for e in entries:
+        # Skip hidden dirs and the git clones of third party code,
+        # such as freertos.git, which never hold info files
+        if e.name.startswith('.') or e.name.endswith('.git'):
+            continue
+        if e.is_dir(follow_symlinks=False):
+            _walk(e.path, files, dirs)
+
+
+_exports = None
 
-        def export(module, g):
-            ''' Export globals into g '''
+
+def _exported_globals():
+    ''' The globals that the info files can use '''
+    global _exports
+
+    if _exports is None:
+        _exports = {}
+        for module in (firmware, keymatrix, library, board, test, pcb, case):
             for k in dir(module):
                 if k[0] in string.ascii_uppercase:
-                    g[k] = getattr(module, k)
+                    _exports[k] = getattr(module, k)
+    return _exports
+
+
+def load_info_files(dir):
+    ''' evaluate the info files that exist under the specified dir '''
+    cache = _load_cache()
+    if cache is not None and cache['dir'] == dir and \
+            _dirs_unchanged(cache['dirs']):
+        files = cache['files']
+        dirs = cache['dirs']
+    else:
+        files = []
+        dirs = {}
+        _walk(dir, files, dirs)
+
+    old_code = cache['code'] if cache is not None else {}
+    code = {}
+    for filename in files:
+        st = os.stat(filename)
+        key = [st.st_mtime_ns, st.st_size]
+        entry = old_code.get(filename)
+        if entry is None or entry[0] != key:
+            entry = [key, _compile(filename)]
+        code[filename] = entry
+        load_info_file(filename, entry[1])
+
+    data = {
+        'version': _cache_version(),
+        'dir': dir,
+        'dirs': dirs,
+        'files': files,
+        'code': code,
+    }
+    if data != cache:
+        _save_cache(data)
 
-        export(firmware, g)
-        export(keymatrix, g)
-        export(library, g)
-        export(board, g)
-        export(test, g)
-        export(pcb, g)
-        export(case, g)
+    loaded_from[:] = sorted(dirs) + files
+    targets.freeze()
 
-        eval(code, g)
+
+def reload_info_files(dir):
+    ''' Forgets all of the targets and loads the info files again '''
+    targets.reset()
+    load_info_files(dir)
+
+
+def _compile(filename):
+    with open(filename, 'r') as f:
+        return compile(f.read(), filename, 'exec')
+
+
+def load_info_file(filename, code=None):
+    projectdir.set(os.path.dirname(filename))
+    if code is None:
+        code = _compile(filename)
+    g = dict(_exported_globals())
+    eval(code, g)
@@ -5,7 +5,6 @@ import math
 import re
 import os
 
-from . import kle
 from . import library
 from . import projectdir
 from . import targets
@@ -119,16 +118,33 @@ class KeyLayout(object):
             self.layout_filename = os.path.join(projectdir.Dir, layout_filename)
         self._layout = None
 
+    def files(self):
+        ''' Returns the layout files that this is loaded from '''
+        if self._mirror_layout:
+            return self._mirror_layout.files()
+        return [self.layout_filename]
+
     @property
     def layout(self):
         if self._layout is None:
             if self._mirror_layout:
                 self._layout = self._mirror_layout.layout.mirror()
             else:
+                from . import kle
                 self._layout = kle.Layout(self.layout_filename)
         return self._layout
 
 
+def layout_files():
+    ''' Returns the layout files used by the targets '''
+    files = set()
+    for t in targets.Targets.values():
+        for value in vars(t).values():
+            if isinstance(value, KeyLayout):
+                files.update(value.files())
+    return sorted(files)
+
+
 class KeyMatrix(targets.Target):
     ''' Compute information about a keyboard matrix
 
@@ -301,7 +317,14 @@ const KeyEntry keyMapData[%d * %d]
             f.write('\n}\n')
 
         projectdir.set(outputs)
-        return library.Library(name='matrix-lib')
+        self.lib = library.Library(name='matrix-lib')
+        return self.lib
 
     def get_deps(self):
         return [self._compute_lib(), 'src/libs/keyprocessor:keyprocessor']
+
+    def get_inputs(self):
+        inputs = super(KeyMatrix, self).get_inputs() + self.layout.files()
+        if getattr(self, 'keymap', None):
+            inputs += self.keymap.files()
+        return inputs
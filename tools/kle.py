@@ -1,6 +1,8 @@
 import copy
+import hashlib
 import json
 import math
+import numpy
 import shapely.geometry
 import shapely.affinity
 
@@ -10,7 +12,30 @@ SWITCH_SPACING = 19.05
 SWITCH_HOLE = 14
 
 
+class GeometryCacheStats(object):
+    ''' Counts the lookups of the derived geometry memoized by Keys '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __str__(self):
+        return '%d hits, %d misses, %d invalidations' % (
+            self.hits, self.misses, self.invalidations)
+
+
+cache_stats = GeometryCacheStats()
+
+
 class Key(object):
+    # The attributes that the derived geometry depends on; setting
+    # any of these drops the memoized geometry
+    _GEOMETRY_ATTRS = frozenset(['x', 'y', 'width', 'height', 'rotation_angle',
+                                 'rotation_x', 'rotation_y'])
+    # Maps (name, unit) to the derived geometry
+    _geometry_cache = None
+
     x = 0
     y = 0
     x2 = 0
@@ -31,6 +56,28 @@ class Key(object):
     def __init__(self):
         self._cluster = [0, 0]
 
+    def __setattr__(self, name, value):
+        if name in self._GEOMETRY_ATTRS and self._geometry_cache:
+            cache_stats.invalidations += 1
+            object.__setattr__(self, '_geometry_cache', None)
+        object.__setattr__(self, name, value)
+
+    def _memoize(self, name, unit, compute):
+        ''' Returns the derived geometry name for unit, calling compute()
+            to produce it if it isn't already cached '''
+        cache = self._geometry_cache
+        if cache is None:
+            cache = {}
+            object.__setattr__(self, '_geometry_cache', cache)
+        key = (name, unit)
+        if key in cache:
+            cache_stats.hits += 1
+            return cache[key]
+        cache_stats.misses += 1
+        value = compute()
+        cache[key] = value
+        return value
+
     def update_with(self, item):
         ''' Update the current item with the serialized data from
             the saved json file '''
@@ -94,43 +141,53 @@ class Key(object):
 
     def polygon(self, unit=SWITCH_SPACING):
         ''' returns the bounding polygon for this key '''
-        x = self.x * unit
-        y = self.y * unit
-        w = self.width * unit
-        h = self.height * unit
-        p = shapely.geometry.box(x, y, x + w, y + h)
+        def compute():
+            x = self.x * unit
+            y = self.y * unit
+            w = self.width * unit
+            h = self.height * unit
+            p = shapely.geometry.box(x, y, x + w, y + h)
 
-        return self.rotated(p, unit)
+            return self.rotated(p, unit)
+        return self._memoize('polygon', unit, compute)
 
     def switch_hole(self, unit=SWITCH_SPACING):
-        x, y = self.centroid(unit)
-        w = SWITCH_HOLE
-        h = SWITCH_HOLE
-        p = shapely.geometry.box(
-            x - (w / 2), y - (h / 2), x + (w / 2), y + (h / 2))
+        def compute():
+            x, y = self.centroid(unit)
+            w = SWITCH_HOLE
+            h = SWITCH_HOLE
+            p = shapely.geometry.box(
+                x - (w / 2), y - (h / 2), x + (w / 2), y + (h / 2))
 
-        return shapely.affinity.rotate(p, self.rotation_angle,
-                                       origin=(x, y))
+            return shapely.affinity.rotate(p, self.rotation_angle,
+                                           origin=(x, y))
+        return self._memoize('switch_hole', unit, compute)
 
     def centroid(self, unit=SWITCH_SPACING):
-        c = tuple(self.polygon(unit).centroid.coords)[0]
-        return c[0], c[1]
+        def compute():
+            c = tuple(self.polygon(unit).centroid.coords)[0]
+            return c[0], c[1]
+        return self._memoize('centroid', unit, compute)
 
     def pin1(self, unit):
         ''' returns coords for pin1 of the keyswitch '''
-        x = self.x * unit
-        y = self.y * unit
-        x += (self.width * unit) / 4.0
-        y += (self.height * unit) / 4.0
-        return self.rotated(shapely.geometry.Point(x, y), unit)
+        def compute():
+            x = self.x * unit
+            y = self.y * unit
+            x += (self.width * unit) / 4.0
+            y += (self.height * unit) / 4.0
+            return self.rotated(shapely.geometry.Point(x, y), unit)
+        return self._memoize('pin1', unit, compute)
 
     def pin2(self, unit):
         ''' returns coords for pin2 of the keyswitch '''
-        x = self.x * unit
-        y = self.y * unit
-        x += (self.width * unit) * 3.0 / 4.0
-        y += (self.height * unit) / 4.0
-        return self.rotated(shapely.geometry.Point(x, y), unit)
+        def compute():
+            x = self.x * unit
+            y = self.y * unit
+            x += (self.width * unit) * 3.0 / 4.0
+            y += (self.height * unit) / 4.0
+            return self.rotated(shapely.geometry.Point(x, y), unit)
+        return self._memoize('pin2', unit, compute)
 
     def rotated(self, shape, unit):
         ''' helper for computing coords for the switch '''
@@ -152,15 +209,208 @@ class Key(object):
 
 
 
+class KeyGeometry(object):
+    ''' A columnar representation of the geometry of a list of keys.
+        Each of the COLUMNS is held in a numpy array indexed by key
+        number, along with the (n x 2) cluster array.
+        The derived geometry for all of the keys is computed in one go
+        for a given unit and cached until a column is modified through
+        a KeyView, which calls invalidate(). '''
+
+    COLUMNS = ('x', 'y', 'width', 'height',
+               'rotation_angle', 'rotation_x', 'rotation_y')
+
+    def __init__(self, keys):
+        for name in self.COLUMNS:
+            setattr(self, name, numpy.array(
+                [getattr(k, name) for k in keys], dtype=float))
+        self.cluster = numpy.array([k._cluster for k in keys],
+                                   dtype=float).reshape(-1, 2)
+        self._derived = {}
+
+    def __len__(self):
+        return len(self.x)
+
+    def invalidate(self):
+        self._derived = {}
+
+    def take(self, indices):
+        ''' returns a KeyGeometry holding the given rows of this one,
+            along with any of their derived geometry computed so far '''
+        result = KeyGeometry([])
+        for name in self.COLUMNS + ('cluster',):
+            setattr(result, name, getattr(self, name)[indices])
+        result._derived = dict(
+            (unit, dict((name, value[indices])
+                        for name, value in derived.items()))
+            for unit, derived in self._derived.items())
+        return result
+
+    def _get(self, unit):
+        derived = self._derived.get(unit)
+        if derived is None:
+            derived = self._compute(unit)
+            self._derived[unit] = derived
+        return derived
+
+    def _compute(self, unit):
+        ''' Computes the corners of the key outlines and switch holes,
+            the centroids and the pin positions for all of the keys
+            with a single rotation of each about its rotation origin,
+            matching Key.rotated(). '''
+        angle = self.rotation_angle * math.pi / 180.0
+        cosp = numpy.cos(angle)
+        sinp = numpy.sin(angle)
+        cosp[numpy.abs(cosp) < 2.5e-16] = 0.0
+        sinp[numpy.abs(sinp) < 2.5e-16] = 0.0
+        x0 = self.rotation_x * unit
+        y0 = self.rotation_y * unit
+        xoff = x0 - x0 * cosp + y0 * sinp
+        yoff = y0 - x0 * sinp - y0 * cosp
+
+        minx = self.x * unit
+        miny = self.y * unit
+        w = self.width * unit
+        h = self.height * unit
+        maxx = minx + w
+        maxy = miny + h
+
+        # The points to transform for each key; the corners of the
+        # outline, in the same order as shapely.geometry.box, then the
+        # center, pin1 and pin2
+        px = numpy.stack([maxx, maxx, minx, minx, minx + w / 2,
+                          minx + w / 4, minx + w * 3.0 / 4.0], axis=1)
+        py = numpy.stack([miny, maxy, maxy, miny, miny + h / 2,
+                          miny + h / 4, miny + h / 4], axis=1)
+        cosp = cosp[:, None]
+        sinp = sinp[:, None]
+        tx = cosp * px - sinp * py + xoff[:, None]
+        ty = sinp * px + cosp * py + yoff[:, None]
+        points = numpy.stack([tx, ty], axis=2)
+
+        # The switch holes are rotated about the centroid of the key
+        half = SWITCH_HOLE / 2
+        hx = numpy.array([half, half, -half, -half])
+        hy = numpy.array([-half, half, half, -half])
+        centroids = points[:, 4]
+        holes = numpy.stack([
+            cosp * hx - sinp * hy + centroids[:, 0:1],
+            sinp * hx + cosp * hy + centroids[:, 1:2]], axis=2)
+
+        return {
+            'polygons': points[:, 0:4],
+            'centroids': centroids,
+            'pin1': points[:, 5],
+            'pin2': points[:, 6],
+            'switch_holes': holes,
+        }
+
+    def polygons(self, unit=SWITCH_SPACING):
+        ''' returns the (n x 4 x 2) corners of the key outlines '''
+        return self._get(unit)['polygons']
+
+    def centroids(self, unit=SWITCH_SPACING):
+        ''' returns the (n x 2) centers of the keys '''
+        return self._get(unit)['centroids']
+
+    def switch_holes(self, unit=SWITCH_SPACING):
+        ''' returns the (n x 4 x 2) corners of the switch holes '''
+        return self._get(unit)['switch_holes']
+
+    def pins(self, unit):
+        ''' returns the (n x 2) positions of pin1 and of pin2 '''
+        derived = self._get(unit)
+        return derived['pin1'], derived['pin2']
+
+
+def _column_property(name):
+    def get(self):
+        return getattr(self._geometry, name)[self._index].item()
+
+    def set(self, value):
+        getattr(self._geometry, name)[self._index] = value
+        self._geometry.invalidate()
+
+    return property(get, set)
+
+
+class KeyView(Key):
+    ''' A Key whose geometry is held in a KeyGeometry.
+        The non-geometric attributes (labels and so on) are still
+        held on the key itself. '''
+
+    def __init__(self, geometry, index, key=None):
+        self._geometry = geometry
+        self._index = index
+        if key is not None:
+            for name, value in vars(key).items():
+                if name not in KeyGeometry.COLUMNS and name not in (
+                        '_cluster', '_geometry_cache'):
+                    setattr(self, name, value)
+
+    x = _column_property('x')
+    y = _column_property('y')
+    width = _column_property('width')
+    height = _column_property('height')
+    rotation_angle = _column_property('rotation_angle')
+    rotation_x = _column_property('rotation_x')
+    rotation_y = _column_property('rotation_y')
+
+    @property
+    def _cluster(self):
+        # A view of the row, so that update_with can assign to it
+        return self._geometry.cluster[self._index]
+
+    def polygon(self, unit=SWITCH_SPACING):
+        return shapely.geometry.Polygon(
+            self._geometry.polygons(unit)[self._index])
+
+    def switch_hole(self, unit=SWITCH_SPACING):
+        return shapely.geometry.Polygon(
+            self._geometry.switch_holes(unit)[self._index])
+
+    def centroid(self, unit=SWITCH_SPACING):
+        x, y = self._geometry.centroids(unit)[self._index]
+        return x.item(), y.item()
+
+    def pin1(self, unit):
+        return shapely.geometry.Point(
+            self._geometry.pins(unit)[0][self._index])
+
+    def pin2(self, unit):
+        return shapely.geometry.Point(
+            self._geometry.pins(unit)[1][self._index])
+
+
+def geometry_of(keys):
+    ''' Returns a KeyGeometry for keys, in order, so that the bulk readers
+        can use the coordinate arrays rather than a shapely object per
+        key.  If the keys are KeyViews of the same columnar layout then
+        its rows are taken, otherwise the columns are read from the keys. '''
+    keys = list(keys)
+    geometries = set(id(getattr(k, '_geometry', None)) for k in keys)
+    if len(geometries) == 1 and isinstance(keys[0], KeyView):
+        return keys[0]._geometry.take([k._index for k in keys])
+    return KeyGeometry(keys)
+
+
 class Layout(object):
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, columnar=False):
+        ''' If columnar is True, the geometry of the keys is held in a
+            KeyGeometry (see make_columnar) '''
         self._keys = []
+        self.geometry = None
+        # sha1 of the json that the layout was loaded from, or None if
+        # it was constructed some other way
+        self.digest = None
         if filename is None:
             return
 
-        with open(filename) as f:
-            self._data = json.load(f)
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        self.digest = hashlib.sha1(raw).hexdigest()
+        self._data = json.loads(raw.decode('utf-8'))
 
         self._meta = self._data[0] if not isinstance(
             self._data[0], list) else {}
@@ -193,6 +443,17 @@ class Layout(object):
             current.y += 1
             current.x = current.rotation_x
 
+        if columnar:
+            self.make_columnar()
+
+    def make_columnar(self):
+        ''' Switch to holding the geometry of the keys in numpy arrays.
+            The keys are replaced by KeyViews onto self.geometry, which
+            computes the derived geometry for all of the keys at once. '''
+        self.geometry = KeyGeometry(self._keys)
+        self._keys = [KeyView(self.geometry, i, key)
+                      for i, key in enumerate(self._keys)]
+
     def name(self):
         return self._meta.get('name', 'anon')
 
@@ -1,18 +1,16 @@
-from .kle import SWITCH_SPACING
 from scipy.cluster.vq import kmeans2
-from shapely.geometry import Point
 from tqdm import tqdm
-from .utils import bounds_of
+from .kle import geometry_of
 from numpy import array
-import itertools
 import numpy
 import warnings
 
 
-def same_size_kmeans(keys, k, max_iter=1000):
+def same_size_kmeans(keys, k, max_iter=1000, geometry=None):
     ''' Given a list of keys, group into k sets of
         spatially clustered items, with evenly balanced
-        membership
+        membership.  geometry is the KeyGeometry of keys,
+        if the caller already has it.
 
         Inspired by https://elki-project.github.io/tutorial/same-size_k_means
         '''
@@ -24,13 +22,14 @@ def same_size_kmeans(keys, k, max_iter=1000):
         we divide up the bounding box by k and pick the center of
         each of those columns '''
 
-    arr = []
-    for key in keys:
-        pt = key.polygon().centroid
-        pt = (pt.x, pt.y)
-        arr.append(list(pt))
+    if geometry is None:
+        geometry = geometry_of(keys)
+    points = geometry.centroids()
 
-    bounds = list(map(int, bounds_of([key.polygon() for key in keys])))
+    # The bounds of the keys, taking in the origin as bounds_of() does
+    corners = numpy.vstack([geometry.polygons().reshape(-1, 2), [[0, 0]]])
+    bounds = list(map(int, numpy.concatenate([corners.min(axis=0),
+                                              corners.max(axis=0)])))
     kinit = []
     width = bounds[2] - bounds[0]
     height = bounds[3] - bounds[1]
@@ -54,10 +53,15 @@ def same_size_kmeans(keys, k, max_iter=1000):
         # iteratively improve the result.  Let's suppress the warning
         # to head off questions about that.
         warnings.simplefilter('ignore')
-        centroid, _ = kmeans2(arr, kinit, minit='matrix',
-                              check_finite=False, iter=max_iter)
-
-    cluster_centroid = [Point(*x) for x in centroid]
+        # Run one iteration at a time so that we can stop as soon as the
+        # centroids settle; after that each iteration is the same.
+        centroid = kinit
+        for _ in range(max_iter):
+            previous = centroid
+            centroid, _ = kmeans2(points, previous, minit='matrix',
+                                  check_finite=False, iter=1)
+            if numpy.array_equal(centroid, previous):
+                break
 
     ''' the rest of this method is an algorithm to re-balance
         the distribution of clusters such that they are equal.
@@ -68,198 +72,153 @@ def same_size_kmeans(keys, k, max_iter=1000):
         but if a given cluster is too full, we recompute
         and move it to a second ary choice.
         The improvement phase of the algorithm tries to
-        swap keys to improve the overall placement. '''
+        swap keys to improve the overall placement.
+
+        The state is held in arrays indexed by the key number:
+        dists[i, c] is the (penalized) distance from key i to the
+        centroid of cluster c and primary[i] is the cluster that
+        key i is assigned to. '''
 
+    n = len(keys)
     INF = float("inf")
-    max_size = int((len(keys) + k - 1) / k)
-    min_size = int(len(keys) / k)
+    max_size = int((n + k - 1) / k)
+    min_size = int(n / k)
+    idx = numpy.arange(n)
 
     ''' affects how harshly we penalize distance '''
     dist_pow = 3
 
-    class Item(object):
-        npt = None
-
-        def __init__(self, key):
-            self.key = key
-            pt = key.polygon(SWITCH_SPACING).centroid
-            self.npt = [pt.x, pt.y]
-            self.pt = pt
-            ''' our preferred cluster '''
-            self.primary = 0
-            ''' our least preferred cluster '''
-            self.secondary = 0
-            ''' dists holds the distancees to each of the k cluster
-                centroids.  '''
-            self.dists = list(itertools.repeat(INF, k))
-            for i in range(0, k):
-                dist = pt.distance(cluster_centroid[i]) ** dist_pow
-                self.dists[i] = dist
-                if i > 0:
-                    if dist < self.dists[self.primary]:
-                        self.primary = i
-                    elif dist > self.dists[self.secondary]:
-                        self.secondary = i
-
-        def priority(self):
-            ''' Priority / badness: difference between best and worst.
-            (Assuming that "secondary" is the worst) '''
-            return self.dists[self.secondary] - self.dists[self.primary]
-
-        def gain(self, i):
-            ''' Gain from switching to cluster i. '''
-            return self.dists[self.primary] - self.dists[i]
-
-        def compute_fallback(self, clusters):
-            ''' Called when our primary is known to be full.
-                We need to figure out an alternative primary. '''
-            fix_idx = self.primary
-            for i in range(0, k):
-                if len(clusters[i]) >= max_size:
-                    continue
-                if self.primary == fix_idx or \
-                        self.dists[i] < self.dists[self.primary]:
-                    self.primary = i
-
-        def update_distance(self, centroids):
-            ''' recompute the cached distances to cluster centroids
-                after we've re-balanced the centroids '''
-            self.secondary = -1
-            for i in range(0, k):
-                dist = self.pt.distance(Point(centroids[i])) ** dist_pow
-                self.dists[i] = dist
-                if self.primary != i:
-                    if self.secondary < 0 or \
-                            self.dists[i] < self.dists[self.secondary]:
-                        self.secondary = i
-
-        def __str__(self):
-            return '%s p=%d s=%d %f' % (self.key.shortLabel(),
-                                        self.primary,
-                                        self.secondary,
-                                        self.priority())
-
-        __repr__ = __str__
-
-    ''' initialize by building up the item list '''
-    items = []
-    for idx, coord in enumerate(arr):
-        items.append(Item(keys[idx]))
-
-    clusters = []
-    for i in range(k):
-        clusters.append(set())
-
-    ''' now populate clusters with preferred items until they are full '''
-    while len(items) > 0:
-        ''' (re)sort by priority.  Note that priority can change as
-            clusters are filled up '''
-        items = sorted(items, key=Item.priority, reverse=True)
-
-        item = items.pop(0)
-        c = clusters[item.primary]
-        c.add(item)
-
-        if len(c) == max_size:
-            ''' now that cluster is full, adjust remaining items to use another '''
-            full_idx = item.primary
-            for item in items:
-                if item.primary == full_idx:
-                    item.compute_fallback(clusters)
-
-    def compute_centroids(clusters):
-        ''' computes the centroids of the cluster assignments '''
-        result = []
-        for cluster in clusters:
-            pts = []
-            for item in cluster:
-                pts.append(item.npt)
-            result.append(numpy.mean(pts, axis=0))
-        return result
+    def distances(centroids):
+        delta = points[:, None, :] - numpy.asarray(centroids)[None, :, :]
+        return numpy.sqrt((delta ** 2).sum(axis=2)) ** dist_pow
+
+    dists = distances(centroid[:k])
+    ''' our preferred cluster, and our least preferred cluster '''
+    primary = dists.argmin(axis=1)
+    secondary = dists.argmax(axis=1)
+
+    def priority(items):
+        ''' Priority / badness: difference between best and worst.
+        (Assuming that "secondary" is the worst) '''
+        return dists[items, secondary[items]] - dists[items, primary[items]]
+
+    ''' now populate clusters with preferred items until they are full.
+        The items are taken in order of decreasing priority; the order
+        only changes when a cluster fills up and the items that wanted
+        to join it have to pick another '''
+    sizes = numpy.zeros(k, dtype=int)
+    full = numpy.zeros(k, dtype=bool)
+    pending = idx[numpy.argsort(-priority(idx), kind='stable')]
+    while len(pending) > 0:
+        item = pending[0]
+        pending = pending[1:]
+        c = primary[item]
+        sizes[c] += 1
+
+        if sizes[c] == max_size:
+            ''' now that cluster is full, adjust remaining items to use
+                the closest cluster that isn't full '''
+            full[c] = True
+            fallback = pending[primary[pending] == c]
+            if len(fallback) > 0:
+                primary[fallback] = numpy.where(
+                    full, INF, dists[fallback]).argmin(axis=1)
+                pending = pending[numpy.argsort(-priority(pending),
+                                                kind='stable')]
 
     ''' Now to iteratively improve things '''
 
     moved = 0
 
-    for improvement_iters in tqdm(range(0, max_iter), desc='clustering'):
-        centroids = compute_centroids(clusters)
-        ''' update distances based on the new centroids '''
-        items = []
-        for cluster in clusters:
-            for item in cluster:
-                item.update_distance(centroids)
-                items.append(item)
+    for improvement_iters in range(0, max_iter):
+        ''' update distances based on the centroids of the clusters '''
+        centroids = [points[primary == c].mean(axis=0) for c in range(k)]
+        dists = distances(centroids)
 
-        items = sorted(items, key=Item.priority, reverse=False)
+        ''' the secondary is now the closest of the other clusters '''
+        others = dists.copy()
+        others[idx, primary] = INF
+        secondary = others.argmin(axis=1)
 
-        transfers_by_cluster = []
-        for _ in range(0, k):
-            transfers_by_cluster.append(set())
+        items = idx[numpy.argsort(priority(idx), kind='stable')].tolist()
+        ''' preferred destination clusters based on distance '''
+        prefs = numpy.argsort(dists, axis=1, kind='stable').tolist()
+        sizes = numpy.bincount(primary, minlength=k)
+        gains = dists.tolist()
 
-        def centroid_distance(cluster_idx, item):
-            return item.pt.distance(Point(centroids[cluster_idx]))
+        def gain(item, i):
+            ''' Gain from switching item to cluster i. '''
+            return gains[item][primary[item]] - gains[item][i]
 
+        ''' the items that would like to leave each cluster, in the
+            order that they asked '''
+        transfers_by_cluster = [dict() for _ in range(0, k)]
+
+        moves = 0
         for _ in range(0, 2):
             for item in items:
-                ''' compute preferred destination clusters based on distance '''
-                prefs = sorted(
-                    range(0, k), key=lambda x: centroid_distance(x, item))
-
-                for dest_cluster in prefs:
-                    if item.primary == dest_cluster:
+                for dest_cluster in prefs[item]:
+                    if primary[item] == dest_cluster:
                         continue
 
                     ''' see if we can swap with an item in the transfer list '''
                     for other in transfers_by_cluster[dest_cluster]:
-                        if item.gain(dest_cluster) + other.gain(item.primary) > 0:
+                        if gain(item, dest_cluster) + gain(other, primary[item]) > 0:
                             ''' yep, it's worth it '''
-                            assert dest_cluster == other.primary
+                            assert dest_cluster == primary[other]
 
-                            old_cluster = item.primary
-
-                            clusters[old_cluster].remove(item)
-                            clusters[dest_cluster].remove(other)
-
-                            clusters[old_cluster].add(other)
-                            clusters[dest_cluster].add(item)
-
-                            item.primary = dest_cluster
-                            other.primary = old_cluster
-                            transfers_by_cluster[dest_cluster].remove(other)
-                            moved += 2
+                            transfers_by_cluster[primary[item]].pop(item, None)
+                            primary[other] = primary[item]
+                            primary[item] = dest_cluster
+                            del transfers_by_cluster[dest_cluster][other]
+                            moves += 2
                             break
 
                     else:
-                        if item.gain(dest_cluster) > 0 and \
-                                len(clusters[dest_cluster]) < max_size and \
-                                len(clusters[item.primary]) > min_size:
+                        if gain(item, dest_cluster) > 0 and \
+                                sizes[dest_cluster] < max_size and \
+                                sizes[primary[item]] > min_size:
                             ''' there's room in the preferred cluster, so
                                 we can just move this item in without having
                                 to figure out a swap '''
-                            assert item in clusters[item.primary]
-                            clusters[item.primary].remove(item)
-                            clusters[dest_cluster].add(item)
-                            item.primary = dest_cluster
-                            moved += 1
+                            sizes[primary[item]] -= 1
+                            sizes[dest_cluster] += 1
+                            transfers_by_cluster[primary[item]].pop(item, None)
+                            primary[item] = dest_cluster
+                            moves += 1
                             break
 
                 ''' if we're not in our preferred slot, request a transfer '''
-                if item.primary != prefs[0] and \
-                        item.dists[item.primary] > item.dists[prefs[0]]:
-                    assert item in clusters[item.primary]
-                    transfers_by_cluster[item.primary].add(item)
+                best = prefs[item][0]
+                if primary[item] != best and \
+                        gains[item][primary[item]] > gains[item][best]:
+                    transfers_by_cluster[primary[item]][item] = True
 
-        moved -= 1
-        if moved < 0:
+        moved += moves - 1
+        if moved < 0 or moves == 0:
             ''' if we didn't think that anything should have moved,
-                then no more improvements are needed '''
+                then no more improvements are needed.  Once nothing
+                moves, the following iterations would all be the same. '''
             break
 
     tqdm.write('done in %d steps!' % improvement_iters)
 
+    ''' filling the clusters to max_size can leave the last of them
+        short, and the improvement phase may not be able to fix that.
+        Top those up with the items that are the least worse off for
+        moving, taken from clusters that can spare them. '''
+    sizes = numpy.bincount(primary, minlength=k)
+    while (sizes < min_size).any():
+        c = int(numpy.argmax(sizes < min_size))
+        movable = idx[sizes[primary] > min_size]
+        cost = dists[movable, c] - dists[movable, primary[movable]]
+        item = movable[numpy.argmin(cost)]
+        sizes[primary[item]] -= 1
+        sizes[c] += 1
+        primary[item] = c
+
     result = []
-    origin = Point(0, 0)
-    for items in clusters:
-        result.append([item.key for item in items])
+    for c in range(k):
+        result.append([keys[i] for i in numpy.nonzero(primary == c)[0]])
 
     return result
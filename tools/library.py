@@ -30,6 +30,10 @@ class Library(targets.Target):
         return []
 
     def get_cppflags_for_compile(self, board):
+        return list(self._memoized(('cppflags', board),
+                                   lambda: self._compute_cppflags(board)))
+
+    def _compute_cppflags(self, board):
         flags = self.get_scoped_cppflags(board) + self.get_cppflags(board)
 
         for d in self._expand_deps():
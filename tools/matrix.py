@@ -7,11 +7,13 @@ import math
 from .svg import SVG
 import networkx as nx
 from shapely.geometry import (Point, LineString)
-from .kle import Key
-from .tsp import greedy_tsp
+from .kle import (Key, geometry_of)
+from .tsp import (greedy_tsp, solve_tsp, distance_matrix)
 import itertools
+import numpy
 from .utils import pairwise
 import os
+import time
 from pprint import pprint
 
 
@@ -295,16 +297,73 @@ def min_matrix_simple_fit(layout, matrix, k):
     return columns
 
 
+class _ClusterOrder(object):
+    ''' Sort key used to pick the first key of a column '''
+
+    def __init__(self, x, y):
+        self.pt = Point(x, y)
+
+    def __lt__(self, other):
+        if self.pt.x < other.pt.x:
+            return True
+        return self.pt.y < other.pt.y
+
+    def __eq__(self, other):
+        return self.pt.x == other.pt.x and self.pt.y == other.pt.y
+
+
+def _clusters_of(keys, k):
+    ''' Groups keys into k clusters with same_size_kmeans, and returns
+        each of them sorted by the _ClusterOrder of the minimum corner of
+        their outlines, along with the KeyGeometry of its keys in that
+        order.  The geometry of all the keys is computed once, and the
+        clusters take their rows of it. '''
+    geometry = geometry_of(keys)
+    index = dict((id(key), i) for i, key in enumerate(keys))
+    result = []
+    for cluster in same_size_kmeans(keys, k, geometry=geometry):
+        rows = [index[id(key)] for key in cluster]
+        corners = geometry.take(rows).polygons().min(axis=1)
+        order = sorted(range(len(cluster)),
+                       key=lambda i: _ClusterOrder(*corners[i]))
+        result.append(([cluster[i] for i in order],
+                       geometry.take([rows[i] for i in order])))
+    return result
+
+
+def _column_order(cluster, geometry=None):
+    ''' Returns the keys of cluster in the order that the column wire
+        visits them, starting with cluster[0].  This is an open path
+        rather than a cycle, because the wire doesn't return to the start.
+        geometry is the KeyGeometry of cluster, if the caller has it. '''
+    if geometry is None:
+        geometry = geometry_of(cluster)
+    dist = distance_matrix(geometry.centroids())
+    path, _ = solve_tsp(dist, source=0, cycle=False)
+    return [cluster[i] for i in path]
+
+
+def _greedy_column_order(cluster):
+    ''' The previous implementation of _column_order, based on
+        greedy_tsp; kept for benchmark_column_order() '''
+    g = nx.DiGraph()
+    for k1, k2 in itertools.permutations(cluster, 2):
+        g.add_edge(k1, k2, weight=k1.polygon(
+        ).centroid.distance(k2.polygon().centroid))
+
+    cycle, weight = greedy_tsp(g, cluster[0])
+    cycle.pop()  # break the cycle, so we just have the desired order
+    # Now we want to rotate the cycle until our chosen first key is at the start
+    while cycle[0] != cluster[0]:
+        last = cycle.pop()
+        cycle.insert(0, last)
+    return cycle
+
+
 def min_matrix_kmeans(layout, k):
     keys = list(layout.keys())
     k = int(math.ceil(math.sqrt(len(keys))))
-    arr = []
-    for key in keys:
-        pt = key.polygon().centroid
-        pt = (pt.x, pt.y)
-        arr.append(list(pt))
 
-    clusters = same_size_kmeans(keys, k)
     ''' now, we want to return the results in a well-defined order.
         For each cluster, we identify the key that is closest to the
         origin point.  This is used to order the clusters.
@@ -317,33 +376,8 @@ def min_matrix_kmeans(layout, k):
     columns = []
     origin = Point(0, 0)
 
-    class Pt(object):
-        def __init__(self, shape):
-            self.pt = Point(shape.bounds[0], shape.bounds[1])
-
-        def __lt__(self, other):
-            if self.pt.x < other.pt.x:
-                return True
-            return self.pt.y < other.pt.y
-
-        def __eq__(self, other):
-            return self.pt.x == other.pt.x and self.pt.y == other.pt.y
-
-    for idx, cluster in enumerate(clusters):
-        g = nx.DiGraph()
-
-        cluster = sorted(cluster, key=lambda k: Pt(k.polygon()))
-        for k1, k2 in itertools.permutations(cluster, 2):
-            g.add_edge(k1, k2, weight=k1.polygon(
-            ).centroid.distance(k2.polygon().centroid))
-
-        cycle, weight = greedy_tsp(g, cluster[0])
-        cycle.pop()  # break the cycle, so we just have the desired order
-        # Now we want to rotate the cycle until our chosen first key is at the start
-        while cycle[0] != cluster[0]:
-            last = cycle.pop()
-            cycle.insert(0, last)
-        columns.append(cycle)
+    for cluster, geometry in _clusters_of(keys, k):
+        columns.append(_column_order(cluster, geometry))
 
     columns = sorted(
         columns, key=lambda cluster: origin.distance(cluster[0].polygon()))
@@ -351,6 +385,40 @@ def min_matrix_kmeans(layout, k):
     return columns
 
 
+def benchmark_column_order(layout, repeat=5):
+    ''' Compares the time taken and the length of the column wiring
+        for _column_order and _greedy_column_order over the columns
+        that min_matrix_kmeans produces for layout.  Each column is
+        ordered repeat times, and the fastest of those is counted.
+        Returns a dict holding the totals for each. '''
+    keys = list(layout.keys())
+    k = int(math.ceil(math.sqrt(len(keys))))
+    clusters = _clusters_of(keys, k)
+
+    def wire_length(column):
+        steps = numpy.diff(geometry_of(column).centroids(), axis=0)
+        return numpy.hypot(steps[:, 0], steps[:, 1]).sum()
+
+    results = {}
+    for name, fn in (('greedy', lambda cluster, geometry:
+                      _greedy_column_order(cluster)),
+                     ('solve_tsp', _column_order)):
+        elapsed = 0
+        length = 0
+        for cluster, geometry in clusters:
+            fastest = None
+            for _ in range(repeat):
+                start = time.time()
+                column = fn(cluster, geometry)
+                seconds = time.time() - start
+                if fastest is None or seconds < fastest:
+                    fastest = seconds
+            elapsed += fastest
+            length += wire_length(column)
+        results[name] = {'seconds': elapsed, 'wire_length': length}
+    return results
+
+
 def min_matrix(layout, matrix):
     keys = list(layout.keys())
     k = int(math.ceil(math.sqrt(len(keys))))
@@ -444,3 +512,17 @@ def compute_matrix(layout, outputs):
         doc.save(os.path.join(outputs, 'matrix.svg'))
 
     return matrix, phys
+
+
+if __name__ == '__main__':
+    # Benchmark the column ordering; pass the KLE json files of the
+    # layouts to compare on, eg:
+    # python -m tools.matrix src/firmware/*/*.json
+    import sys
+    from .kle import Layout
+
+    for filename in sys.argv[1:]:
+        results = benchmark_column_order(Layout(filename))
+        for name, result in sorted(results.items()):
+            print('%s %s: %.4fs, wiring %.2fmm' % (
+                filename, name, result['seconds'], result['wire_length']))
@@ -0,0 +1,277 @@
+''' A content addressed cache of compiled objects, shared by all targets.
+
+    Many of the targets compile the same library sources for the same
+    board with the same flags, each into its own outputs dir.  Like
+    ccache in its preprocessor mode, we key each object on:
+
+    - the output of running the compile command with -E in place of -c,
+    - the rest of the command, leaving out the -D, -U and -I options,
+      which only matter to the preprocessor, and the output filenames,
+    - the identity of the compiler: its path, size and mtime.
+
+    A hit hard links the cached object into the outputs dir of the
+    target.  The compiler may overwrite its output file in place, so we
+    always remove the object before compiling it, to avoid scribbling on
+    the cached copy.  The depfile is cached alongside the object, so
+    that the build log knows the deps of a cached object.
+
+    The cache is kept under a size bound by removing the least recently
+    used objects.  We track the use in the atime of the cached object,
+    as its mtime is shared with the hard links in the outputs dirs, and
+    make uses that.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from . import filesystem
+from . import scheduler
+
+CACHE_VERSION = 1
+CACHE_DIR = os.path.join('outputs', 'objcache')
+MAX_SIZE = 512 * 1024 * 1024
+
+# These take a value, which may be in the next argument
+_OUTPUT_OPTIONS = ('-o', '-MF', '-MT', '-MQ')
+_PREPROCESSOR_OPTIONS = ('-D', '-U', '-I')
+_DEP_OPTIONS = ('-MMD', '-MD', '-MP')
+
+
+def preprocess_command(cmd):
+    ''' Returns the command that preprocesses the source that cmd
+        compiles, or None if cmd doesn't look like a compile '''
+    if '-c' not in cmd:
+        return None
+    res = []
+    args = iter(cmd)
+    for arg in args:
+        if arg in _OUTPUT_OPTIONS:
+            next(args, None)
+        elif arg.startswith(_OUTPUT_OPTIONS) or arg in _DEP_OPTIONS:
+            pass
+        elif arg == '-c':
+            res.append('-E')
+        else:
+            res.append(arg)
+    return res
+
+
+def _hashed_args(cmd, objfile):
+    ''' The args of cmd that aren't accounted for by the preprocessed
+        source, with the output filenames made generic '''
+    stem = os.path.splitext(objfile)[0]
+    res = []
+    args = iter(cmd)
+    for arg in args:
+        if arg in _PREPROCESSOR_OPTIONS:
+            next(args, None)
+        elif not arg.startswith(_PREPROCESSOR_OPTIONS):
+            res.append(arg.replace(stem, '{output}'))
+    return res
+
+
+class CacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+    def __str__(self):
+        return '%d hits, %d misses, %d uncacheable' % (
+            self.hits, self.misses, self.uncacheable)
+
+    def __sub__(self, other):
+        ''' The stats of what happened since other was copied from us '''
+        res = CacheStats()
+        res.hits = self.hits - other.hits
+        res.misses = self.misses - other.misses
+        res.uncacheable = self.uncacheable - other.uncacheable
+        return res
+
+
+class ObjectCache(object):
+    ''' Keeps the objects under dir, up to max_size bytes of them.
+        compile() may be called from multiple threads. '''
+
+    def __init__(self, dir, max_size=MAX_SIZE):
+        self.dir = dir
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._toolchains = {}
+        self._added = False
+
+    def _toolchain(self, compiler):
+        ''' Identifies the compiler that we run as compiler, or returns
+            None if we can't find it '''
+        with self._lock:
+            if compiler not in self._toolchains:
+                ident = None
+                path = shutil.which(compiler)
+                if path:
+                    path = os.path.realpath(path)
+                    st = os.stat(path)
+                    ident = '%s %d %d' % (path, st.st_size, st.st_mtime_ns)
+                self._toolchains[compiler] = ident
+            return self._toolchains[compiler]
+
+    def _key(self, cmd, objfile):
+        ''' The key of the object that cmd produces, or None if we can't
+            cache it; we let the real compile report any errors. '''
+        toolchain = self._toolchain(cmd[0])
+        preprocess = preprocess_command(cmd)
+        if toolchain is None or preprocess is None:
+            return None
+        try:
+            source = subprocess.check_output(preprocess,
+                                             stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        h = hashlib.sha1()
+        h.update(('%d\0%s\0' % (CACHE_VERSION, toolchain)).encode('utf-8'))
+        for arg in _hashed_args(cmd, objfile):
+            h.update(arg.encode('utf-8') + b'\0')
+        h.update(source)
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.dir, key[:2], key[2:])
+
+    def _fetch(self, entry, objfile, depfile):
+        ''' Links the cached object into objfile, returning True if we
+            had it '''
+        try:
+            if depfile:
+                with open(entry + '.d', 'r') as f:
+                    deps = f.read()
+            st = os.stat(entry + '.o')
+            _remove(objfile)
+            try:
+                os.link(entry + '.o', objfile)
+            except OSError:
+                # Perhaps the outputs are on a different filesystem
+                shutil.copy2(entry + '.o', objfile)
+            # Mark it as recently used, keeping the mtime
+            os.utime(entry + '.o', ns=(time.time_ns(), st.st_mtime_ns))
+        except (IOError, OSError):
+            return False
+
+        if depfile:
+            # The first word of the depfile names the object
+            _, rest = deps.split(':', 1)
+            with open(depfile, 'w') as f:
+                f.write('%s:%s' % (objfile, rest))
+        return True
+
+    def _store(self, entry, objfile, depfile):
+        filesystem.mkdir_p(os.path.dirname(entry))
+        tmp = '%s.tmp%d.%d' % (entry, os.getpid(), threading.get_ident())
+        try:
+            # The depfile goes in first, so that an object in the cache
+            # always has one
+            if depfile:
+                shutil.copyfile(depfile, tmp + '.d')
+                os.rename(tmp + '.d', entry + '.d')
+            try:
+                os.link(objfile, tmp + '.o')
+            except OSError:
+                shutil.copy2(objfile, tmp + '.o')
+            os.rename(tmp + '.o', entry + '.o')
+        except (IOError, OSError):
+            for ext in ('.d', '.o'):
+                _remove(tmp + ext)
+            return
+        self._added = True
+
+    def compile(self, cmd, objfile, depfile=None, srcfile=None):
+        ''' Produces objfile, and depfile if it is given, either by
+            running cmd or from the cache.  Logs which it was, naming
+            srcfile if it is given. '''
+        what = os.path.relpath(objfile)
+        if srcfile:
+            what += ' from %s' % srcfile
+
+        key = self._key(cmd, objfile)
+        if key is None:
+            with self._lock:
+                self.stats.uncacheable += 1
+        else:
+            entry = self._entry(key)
+            hit = self._fetch(entry, objfile, depfile)
+            with self._lock:
+                if hit:
+                    self.stats.hits += 1
+                else:
+                    self.stats.misses += 1
+            if hit:
+                scheduler.log(' CACHED %s' % what)
+                return
+
+        scheduler.log(' COMPILE %s' % what)
+        _remove(objfile)
+        scheduler.check_call(cmd)
+        if key is not None:
+            self._store(entry, objfile, depfile)
+
+    def trim(self):
+        ''' Removes the least recently used objects until the cache is
+            within its size bound '''
+        if not self._added:
+            return
+        self._added = False
+
+        entries = []
+        total = 0
+        for dirpath, _, files in os.walk(self.dir):
+            for name in files:
+                if not name.endswith('.o'):
+                    continue
+                entry = os.path.join(dirpath, name[:-2])
+                size = 0
+                atime = 0
+                for ext in ('.o', '.d'):
+                    try:
+                        st = os.stat(entry + ext)
+                    except OSError:
+                        continue
+                    size += st.st_size
+                    if ext == '.o':
+                        atime = st.st_atime_ns
+                entries.append((atime, size, entry))
+                total += size
+
+        if total <= self.max_size:
+            return
+        # Leave some room so that we don't trim after every build
+        target = self.max_size * 0.9
+        for _, size, entry in sorted(entries):
+            if total <= target:
+                break
+            for ext in ('.o', '.d'):
+                _remove(entry + ext)
+            total -= size
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+cache = None
+
+
+def get():
+    ''' Returns the cache for this invocation '''
+    global cache
+    if not cache:
+        cache = ObjectCache(CACHE_DIR)
+    return cache
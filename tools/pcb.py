@@ -5,25 +5,11 @@ import re
 import subprocess
 
 from . import targets
-from . import board
-from . import library
-from . import projectdir
 from . import filesystem
-from .circuitlib import circuit as circuitlib
-from .circuitlib import shape
-from . import svg
-from . import matrix
 
-from shapely.affinity import (translate, scale, rotate)
-from shapely.geometry import (Point, Polygon, MultiPolygon, CAP_STYLE,
-                              JOIN_STYLE, box, LineString, MultiLineString, MultiPoint)
-import skidl
-from tqdm import tqdm
-
-from .kle import SWITCH_SPACING
-from .circuitlib.router import (router, types, msteinertree)
-
-import pycircuit
+# The geometry and EDA modules take a while to import and every
+# invocation of clacker.py loads this module, so they are imported by
+# the methods that use them.
 
 
 class Pcb(targets.Target):
@@ -33,6 +19,9 @@ class Pcb(targets.Target):
         self.surface_mount = surface_mount
         self.shape_config = shape_config
 
+    def get_inputs(self):
+        return super(Pcb, self).get_inputs() + self.layout.files()
+
     def build(self):
         commit_date = subprocess.check_output([
             'git','show','-s','--format=%ad', '--date=short']).decode('ascii').rstrip()
@@ -47,6 +36,10 @@ class Pcb(targets.Target):
                 'outputs',
                 self.full_name.replace(':', '/')))
         filesystem.mkdir_p(outputs)
+        from .circuitlib import shape
+        from . import kle
+        from . import matrix
+
         layout = self.layout.layout
         shapes = shape.make_shapes(layout, shape_config=self.shape_config)
 
@@ -54,8 +47,13 @@ class Pcb(targets.Target):
             layout, outputs)
         circuit = self.gen_schematic(layout, shapes, outputs, physical_matrix)
         #self.route(circuit, shapes, outputs)
+        print('Key geometry cache: %s' % kle.cache_stats)
 
     def route(self, circuit, shapes, outputs):
+        from shapely.affinity import translate
+        from shapely.geometry import (Point, LineString)
+        from .circuitlib.router import types
+
         data = circuit.computeRoutingData()
         tri = data['triangulation']
 
@@ -144,6 +142,12 @@ class Pcb(targets.Target):
         doc.save(os.path.join(outputs, 'circuit.svg'))
 
     def gen_schematic(self, layout, shapes, outputs, matrix):
+        from shapely.affinity import (translate, rotate)
+        from shapely.geometry import Point
+        from tqdm import tqdm
+        from .circuitlib import circuit as circuitlib
+        from .kle import SWITCH_SPACING
+
         bounds = shapes['bottom_plate'].envelope
 
         def cxlate(shape):
@@ -0,0 +1,146 @@
+''' Runs a DAG of build steps in a bounded pool of worker threads.
+
+    The steps of a build are mostly spent waiting on a compiler
+    subprocess, so threads are enough to keep several cpus busy.
+    While a job is running, the output of the commands that it runs with
+    check_call() and the messages that it passes to log() are captured
+    and then printed in one piece when the job completes, so that the
+    output of concurrent jobs doesn't get interleaved.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import threading
+
+_current = threading.local()
+
+
+def log(msg):
+    ''' print msg, or add it to the output of the current job '''
+    job = getattr(_current, 'job', None)
+    if job is None:
+        print(msg)
+    else:
+        job.output.append(msg + '\n')
+
+
+def check_call(cmd):
+    ''' subprocess.check_call(), capturing the output of cmd if we
+        are running in a job '''
+    job = getattr(_current, 'job', None)
+    if job is None:
+        return subprocess.check_call(cmd)
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    out, _ = proc.communicate()
+    job.output.append(out.decode('utf-8', 'replace'))
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return 0
+
+
+class BuildFailed(Exception):
+    pass
+
+
+class Job(object):
+    ''' A step of the build.  func is called with no arguments once all
+        of the jobs in deps have completed successfully. '''
+
+    def __init__(self, name, func, deps=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps or [])
+        self.output = []
+        self.error = None
+
+    def _run(self):
+        _current.job = self
+        try:
+            self.func()
+        finally:
+            _current.job = None
+
+
+class Scheduler(object):
+    ''' Collects the jobs of a build and then runs them, at most `jobs`
+        at a time; None runs one per cpu. '''
+
+    def __init__(self, jobs=None):
+        self.jobs = jobs or os.cpu_count()
+        self._jobs = []
+        self._by_name = {}
+
+    def add(self, name, func, deps=None):
+        ''' Adds a job to the build and returns it so that it can be
+            used in the deps of other jobs.  Jobs are identified by name,
+            which is usually the file that they produce; adding a job
+            with the same name as an existing one returns the existing
+            one, so that we never build the same file twice at once. '''
+        job = self._by_name.get(name)
+        if job is None:
+            job = Job(name, func, deps)
+            self._jobs.append(job)
+            self._by_name[name] = job
+        return job
+
+    def run(self):
+        ''' Runs all of the jobs, returning once they have completed.
+            If any of them fail, no more are started and BuildFailed is
+            raised once the running jobs have completed. '''
+        # This is slow to import and only needed when we build something
+        from concurrent import futures
+
+        jobs = self._jobs
+        self._jobs = []
+        self._by_name = {}
+
+        waiting_on = dict((job, len(job.deps)) for job in jobs)
+        dependents = dict((job, []) for job in jobs)
+        for job in jobs:
+            for dep in job.deps:
+                dependents[dep].append(job)
+
+        ready = [job for job in jobs if not job.deps]
+        running = {}
+        failed = []
+
+        pool = futures.ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            while ready or running:
+                while ready and not failed and len(running) < self.jobs:
+                    job = ready.pop(0)
+                    running[pool.submit(job._run)] = job
+
+                if not running:
+                    break
+
+                done, _ = futures.wait(list(running),
+                                       return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    job.error = future.exception()
+                    sys.stdout.write(''.join(job.output))
+                    if job.error is not None:
+                        sys.stdout.write('FAILED: %s: %s\n' % (job.name,
+                                                               job.error))
+                        failed.append(job)
+                        continue
+                    for dependent in dependents[job]:
+                        waiting_on[dependent] -= 1
+                        if waiting_on[dependent] == 0:
+                            ready.append(dependent)
+                sys.stdout.flush()
+        finally:
+            pool.shutdown(wait=True)
+
+        if failed:
+            raise BuildFailed('%d build steps failed: %s' % (
+                len(failed), ', '.join(job.name for job in failed)))
+
+        if any(waiting_on[job] for job in jobs):
+            raise BuildFailed('some build steps have cyclic dependencies')
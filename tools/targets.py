@@ -1,5 +1,11 @@
 ''' This is a module that maps fully qualified target names
-    to their instances '''
+    to their instances.
+
+    Once the info files have been loaded, freeze() is called and from
+    then on the expanded dependencies of each target, and anything else
+    that is derived from them, are computed once and remembered for the
+    rest of the invocation.  Defining a target that replaces one with
+    the same name forgets everything that was remembered. '''
 
 from . import projectdir
 import os
@@ -8,6 +14,30 @@ from glob import glob
 
 Targets = {}
 
+# (target, key) -> value; see Target._memoized()
+_memo = {}
+_frozen = False
+
+
+class DependencyCycle(Exception):
+    pass
+
+
+def freeze():
+    ''' Called once all of the info files have been loaded '''
+    global _frozen
+    _frozen = True
+    _memo.clear()
+
+
+def reset():
+    ''' Forgets all of the targets, so that the info files can be
+        loaded again '''
+    global _frozen
+    _frozen = False
+    _memo.clear()
+    Targets.clear()
+
 
 class Target(object):
     def __init__(self, name):
@@ -16,6 +46,8 @@ class Target(object):
         self.dir = projectdir.Dir
         self.name = name
         self.full_name = '%s:%s' % (self.dir, self.name)
+        if self.full_name in Targets:
+            _memo.clear()
         Targets[self.full_name] = self
 
     def _normalize_srcs(self, srcs):
@@ -34,16 +66,27 @@ class Target(object):
     def get_deps(self):
         return None
 
-    def _expand_deps(self, uniq=None):
-        ''' expand the dependencies of this target, and toposort them.
-            Returns an ordered list of the target instances '''
-        global Targets
+    def get_inputs(self):
+        ''' Returns the files that this target is made from, not counting
+            those of its deps.  The watch mode rebuilds the target when
+            any of them change. '''
+        info = os.path.join(self.dir, 'info.py')
+        return [info] if os.path.exists(info) else []
 
-        deps = []
-        if uniq is None:
-            uniq = set()
+    def _memoized(self, key, compute):
+        ''' Returns compute(), remembering it under key once the targets
+            have been frozen '''
+        if not _frozen:
+            return compute()
+        k = (self, key)
+        if k not in _memo:
+            _memo[k] = compute()
+        return _memo[k]
 
-        for d in self.get_deps():
+    def _direct_deps(self):
+        ''' Resolves the names returned by get_deps() to targets '''
+        res = []
+        for d in self.get_deps() or []:
             if not isinstance(d, Target):
                 if d[0] == ':':
                     # name is relative to dir
@@ -53,14 +96,37 @@ class Target(object):
                         '%s depends on %s, but no such target exists\n' % (
                             self.full_name, d))
                 d = Targets[d]
+            res.append(d)
+        return res
+
+    def _expand_deps(self):
+        ''' expand the dependencies of this target, and toposort them.
+            Returns an ordered list of the target instances '''
+        return list(_expand(self, []))
 
-            if d in uniq:
-                # Already covered
-                continue
 
-            uniq.add(d)
-            # add its deps before our own
-            deps += d._expand_deps(uniq)
-            deps.append(d)
+def _expand(target, path):
+    ''' Returns the toposorted tuple of the deps of target.
+        path is the chain of targets that we are expanding, which
+        we use to report a cycle. '''
+    if target in path:
+        cycle = path[path.index(target):] + [target]
+        raise DependencyCycle('dependency cycle: %s' % ' -> '.join(
+            t.full_name for t in cycle))
+
+    def compute():
+        path.append(target)
+        try:
+            deps = []
+            uniq = set()
+            for d in target._direct_deps():
+                # add its deps before itself
+                for t in _expand(d, path) + (d,):
+                    if t not in uniq:
+                        uniq.add(t)
+                        deps.append(t)
+            return tuple(deps)
+        finally:
+            path.pop()
 
-        return deps
+    return target._memoized('deps', compute)
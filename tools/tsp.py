@@ -10,6 +10,8 @@ Categories of algorithms which are implemented:
 - Greedy
 - Simulated Annealing (SA)
 - Threshold Accepting (TA)
+- Nearest neighbour construction with 2-opt and Or-opt local search,
+  operating on a NumPy distance matrix (solve_tsp)
 
 Travelling Salesman Problem tries to find, given the weight
 (distance) between all points where salesman has to visit, the
@@ -31,8 +33,10 @@ import itertools
 import math
 from random import choice, randint, random
 import networkx as nx
+import numpy
 
-__all__ = ['greedy_tsp', 'simulated_annealing_tsp', 'threshold_accepting_tsp']
+__all__ = ['greedy_tsp', 'simulated_annealing_tsp', 'threshold_accepting_tsp',
+           'distance_matrix', 'tour_cost', 'solve_tsp']
 
 
 def greedy_tsp(G, source, weight='weight'):
@@ -484,3 +488,310 @@ def _apply_move(sol, move):
     elif move == '1-0':
         sol.insert(b, sol.pop(a))
     return sol
+
+
+def distance_matrix(points):
+    """Returns the matrix of the euclidean distances between each
+    of the (x, y) points."""
+    points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+    delta = points[:, None, :] - points[None, :, :]
+    return numpy.hypot(delta[..., 0], delta[..., 1])
+
+
+def tour_cost(dist, tour, cycle=True):
+    """Returns the total distance along tour, a sequence of indices
+    into the distance matrix dist.  If cycle is True, this includes
+    returning from the last point to the first."""
+    tour = numpy.asarray(tour)
+    if len(tour) < 2:
+        return 0.0
+    cost = dist[tour[:-1], tour[1:]].sum()
+    if cycle:
+        cost += dist[tour[-1], tour[0]]
+    return float(cost)
+
+
+def nearest_neighbor_tour(dist, source=0):
+    """Builds a tour starting at source by repeatedly visiting the
+    closest point that hasn't yet been visited.  This is the same
+    construction as greedy_tsp()."""
+    n = len(dist)
+    visited = numpy.zeros(n, dtype=bool)
+    tour = [source]
+    visited[source] = True
+    for _ in range(n - 1):
+        d = numpy.where(visited, numpy.inf, dist[tour[-1]])
+        nxt = int(numpy.argmin(d))
+        tour.append(nxt)
+        visited[nxt] = True
+    return tour
+
+
+# Moves must improve the cost by more than this to be applied; this
+# avoids cycling between equivalent tours due to rounding.
+_EPSILON = 1e-9
+
+
+def _two_opt(dist, tour, cycle):
+    """2-opt local search: reverse the section of the tour that gives
+    the greatest improvement, for each starting position in turn,
+    until no reversal helps.  The first point of the tour stays put.
+    Returns True if the tour was changed."""
+    n = len(tour)
+    changed = False
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            t = numpy.asarray(tour)
+            # Reverse t[i:j + 1] for each j > i
+            j = numpy.arange(i + 1, n)
+            a = t[i - 1]
+            b = t[i]
+            c = t[j]
+            if cycle:
+                d = t[(j + 1) % n]
+                after = dist[c, d]
+                delta = dist[a, c] + dist[b, d] - dist[a, b] - after
+            else:
+                # In an open path the end of the reversed section may
+                # be the end of the path
+                has_next = j + 1 < n
+                d = t[numpy.where(has_next, j + 1, 0)]
+                after = numpy.where(has_next, dist[c, d], 0)
+                delta = (dist[a, c] + numpy.where(has_next, dist[b, d], 0) -
+                         dist[a, b] - after)
+            best = int(numpy.argmin(delta))
+            if delta[best] < -_EPSILON:
+                end = int(j[best])
+                tour[i:end + 1] = tour[i:end + 1][::-1]
+                improved = True
+                changed = True
+    return changed
+
+
+def _or_opt(dist, tour, cycle, max_segment=3):
+    """Or-opt local search: move a run of up to max_segment consecutive
+    points, possibly reversed, to the position elsewhere in the tour that
+    gives the greatest improvement, until no move helps.
+    The first point of the tour stays put.
+    Returns True if the tour was changed."""
+    n = len(tour)
+    changed = False
+    improved = True
+    while improved:
+        improved = False
+        for length in range(1, max_segment + 1):
+            for i in range(1, n - length + 1):
+                segment = tour[i:i + length]
+                rest = tour[:i] + tour[i + length:]
+                first = segment[0]
+                last = segment[-1]
+                prev = tour[i - 1]
+                if i + length < n:
+                    nxt = tour[i + length]
+                    removed = (dist[prev, first] + dist[last, nxt] -
+                               dist[prev, nxt])
+                elif cycle:
+                    nxt = tour[0]
+                    removed = (dist[prev, first] + dist[last, nxt] -
+                               dist[prev, nxt])
+                else:
+                    removed = dist[prev, first]
+
+                # Insert between rest[k] and rest[k + 1]
+                r = numpy.asarray(rest)
+                a = r
+                if cycle:
+                    b = numpy.roll(r, -1)
+                    base = dist[a, b]
+                else:
+                    # The open path can also be extended at the end
+                    b = numpy.append(r[1:], r[0])
+                    base = numpy.append(dist[r[:-1], r[1:]], 0)
+                forward = dist[a, first] + dist[last, b]
+                backward = dist[a, last] + dist[first, b]
+                if not cycle:
+                    forward[-1] = dist[r[-1], first]
+                    backward[-1] = dist[r[-1], last]
+                forward = forward - base
+                backward = backward - base
+
+                k = int(numpy.argmin(forward))
+                kb = int(numpy.argmin(backward))
+                reverse = backward[kb] < forward[k]
+                if reverse:
+                    k = kb
+                    added = backward[kb]
+                else:
+                    added = forward[k]
+
+                if added < removed - _EPSILON:
+                    if reverse:
+                        segment = segment[::-1]
+                    tour[:] = rest[:k + 1] + segment + rest[k + 1:]
+                    improved = True
+                    changed = True
+    return changed
+
+
+# Below this many points, solve_tsp() searches with plain python lists;
+# the cost of setting up the numpy operations for each step outweighs
+# what they save.  The two break even at around 128 random points.
+_SMALL_TOUR = 100
+
+
+def _nearest_neighbor_tour_small(dist, source):
+    """nearest_neighbor_tour() for dist as a list of lists"""
+    unvisited = [i for i in range(len(dist)) if i != source]
+    tour = [source]
+    while unvisited:
+        row = dist[tour[-1]]
+        nxt = unvisited[0]
+        for i in unvisited:
+            if row[i] < row[nxt]:
+                nxt = i
+        tour.append(nxt)
+        unvisited.remove(nxt)
+    return tour
+
+
+def _two_opt_small(dist, tour, cycle):
+    """_two_opt() for dist as a list of lists; it makes the same moves"""
+    n = len(tour)
+    changed = False
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            da = dist[tour[i - 1]]
+            db = dist[tour[i]]
+            ab = da[tour[i]]
+            best = best_delta = None
+            for j in range(i + 1, n):
+                c = tour[j]
+                if j + 1 < n or cycle:
+                    d = tour[(j + 1) % n]
+                    delta = da[c] + db[d] - ab - dist[c][d]
+                else:
+                    delta = da[c] - ab
+                if best_delta is None or delta < best_delta:
+                    best = j
+                    best_delta = delta
+            if best_delta < -_EPSILON:
+                tour[i:best + 1] = tour[i:best + 1][::-1]
+                improved = True
+                changed = True
+    return changed
+
+
+def _or_opt_small(dist, tour, cycle, max_segment=3):
+    """_or_opt() for dist as a list of lists; it makes the same moves"""
+    n = len(tour)
+    changed = False
+    improved = True
+    while improved:
+        improved = False
+        for length in range(1, max_segment + 1):
+            for i in range(1, n - length + 1):
+                segment = tour[i:i + length]
+                rest = tour[:i] + tour[i + length:]
+                first = segment[0]
+                last = segment[-1]
+                prev = tour[i - 1]
+                if i + length < n or cycle:
+                    nxt = tour[(i + length) % n]
+                    removed = (dist[prev][first] + dist[last][nxt] -
+                               dist[prev][nxt])
+                else:
+                    removed = dist[prev][first]
+
+                # Insert between rest[k] and rest[k + 1]
+                m = len(rest)
+                k = kb = best_forward = best_backward = None
+                for x in range(m):
+                    da = dist[rest[x]]
+                    if x + 1 < m or cycle:
+                        b = rest[(x + 1) % m]
+                        base = da[b]
+                        forward = da[first] + dist[last][b] - base
+                        backward = da[last] + dist[first][b] - base
+                    else:
+                        # The open path can also be extended at the end
+                        forward = da[first]
+                        backward = da[last]
+                    if best_forward is None or forward < best_forward:
+                        k = x
+                        best_forward = forward
+                    if best_backward is None or backward < best_backward:
+                        kb = x
+                        best_backward = backward
+                reverse = best_backward < best_forward
+                if reverse:
+                    k = kb
+                    added = best_backward
+                else:
+                    added = best_forward
+
+                if added < removed - _EPSILON:
+                    if reverse:
+                        segment = segment[::-1]
+                    tour[:] = rest[:k + 1] + segment + rest[k + 1:]
+                    improved = True
+                    changed = True
+    return changed
+
+
+def solve_tsp(dist, source=0, cycle=True):
+    """Finds a short route that visits each point once, starting
+    at source.
+
+    Parameters
+    ----------
+    dist : square array
+        dist[i, j] is the distance from point i to point j, for example
+        as computed by distance_matrix().  It should be symmetric.
+
+    source : int, optional (default=0)
+        The index of the starting point
+
+    cycle : bool, optional (default=True)
+        If True, the route returns to source at the end and its cost
+        includes that final leg.  Otherwise the route is an open path
+        that may end at any point.
+
+    Returns
+    -------
+    tour : list, cost : float
+        The indices of the points in the order that they are visited,
+        starting with source.  Unlike greedy_tsp(), source is not
+        repeated at the end of a cycle.
+
+    Notes
+    -----
+    The route is built with the nearest neighbour heuristic, as
+    used by greedy_tsp(), and then improved by alternating 2-opt
+    and Or-opt local search until neither finds an improvement.
+    Each search step scores all of the candidate moves for one
+    position at once using the distance matrix.  Routes of fewer than
+    _SMALL_TOUR points make the same moves using python lists instead.
+    """
+    dist = numpy.asarray(dist, dtype=float)
+    if len(dist) == 0:
+        return [], 0.0
+
+    if len(dist) < _SMALL_TOUR:
+        rows = dist.tolist()
+        tour = _nearest_neighbor_tour_small(rows, source)
+        two_opt, or_opt = _two_opt_small, _or_opt_small
+    else:
+        rows = dist
+        tour = nearest_neighbor_tour(dist, source)
+        two_opt, or_opt = _two_opt, _or_opt
+    if len(tour) > 3 or (not cycle and len(tour) > 2):
+        while True:
+            two_opt(rows, tour, cycle)
+            if not or_opt(rows, tour, cycle):
+                break
+
+    return tour, tour_cost(dist, tour, cycle)
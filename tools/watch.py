@@ -0,0 +1,234 @@
+''' Rebuilds targets when the files that they are made from change.
+
+    The files of each target come from its get_inputs(), which for the
+    firmware includes the headers listed in the depfiles of its last
+    build.  We wait for changes with inotify when the inotify_simple
+    module is installed, or else poll their stat info.  Once something
+    has changed we wait for the changes to settle, as editors and
+    `git checkout` touch several files in a row, and then rebuild just
+    the targets whose inputs changed.  A change to an info.py or a
+    keyboard layout loads all of the info files again first.  We take
+    the snapshot of the files and start watching them before each build,
+    so that a file saved while a build is running causes another build.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import time
+import traceback
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+from . import buildlog
+from . import infofile
+from . import keymatrix
+from . import targets
+
+POLL_INTERVAL = 0.5  # seconds
+SETTLE_TIME = 0.3  # seconds
+
+
+def _stat_all(paths):
+    res = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            res[path] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            res[path] = None
+    return res
+
+
+class _Inotify(object):
+    ''' Watches the dirs that hold paths.  We watch the dirs rather than
+        the files because many editors save by replacing the file. '''
+
+    def __init__(self, paths):
+        self.inotify = inotify_simple.INotify()
+        self.dirs = set()
+        self.add(paths)
+
+    def add(self, paths):
+        flags = inotify_simple.flags
+        mask = (flags.CREATE | flags.MODIFY | flags.ATTRIB |
+                flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                flags.DELETE)
+        for d in set(os.path.dirname(os.path.abspath(p)) for p in paths):
+            if d in self.dirs:
+                continue
+            self.dirs.add(d)
+            try:
+                self.inotify.add_watch(d, mask)
+            except OSError:
+                pass
+
+    def wait(self, timeout=None):
+        ''' Returns True if something happened within timeout seconds '''
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        return bool(self.inotify.read(timeout=timeout))
+
+    def close(self):
+        self.inotify.close()
+
+
+class _Poller(object):
+    def __init__(self, paths):
+        self.paths = []
+        self.last = {}
+        self.add(paths)
+
+    def add(self, paths):
+        new = [p for p in paths if p not in self.last]
+        self.paths += new
+        self.last.update(_stat_all(new))
+
+    def wait(self, timeout=None):
+        ''' Returns True if something changed within timeout seconds '''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(POLL_INTERVAL if timeout is None
+                       else min(POLL_INTERVAL, timeout))
+            current = _stat_all(self.paths)
+            if current != self.last:
+                self.last = current
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+    def close(self):
+        pass
+
+
+class Watcher(object):
+    ''' Snapshots the stat info of paths and starts watching them, so
+        that changes made from then on are seen by wait_for_changes(),
+        including those made while a build is running. '''
+
+    def __init__(self, paths):
+        self.started = time.time_ns()
+        self.before = _stat_all(paths)
+        self.waiter = (_Inotify if inotify_simple else _Poller)(paths)
+
+    def add(self, paths):
+        ''' Watches paths as well.  We have no snapshot of them from
+            when we started, so any that have been modified since then
+            count as changed. '''
+        new = [p for p in paths if p not in self.before]
+        for path, stat in _stat_all(new).items():
+            if stat is not None and stat[0] < self.started:
+                self.before[path] = stat
+            else:
+                self.before[path] = 'changed'
+        self.waiter.add(new)
+
+    def _changed(self):
+        after = _stat_all(self.before)
+        return set(p for p in self.before if after[p] != self.before[p])
+
+    def wait_for_changes(self):
+        ''' Waits for some of the paths to change and then stop
+            changing.  Returns the set of those that changed. '''
+        while True:
+            if self._changed():
+                # Let them settle, in case we caught them part way
+                while self.waiter.wait(SETTLE_TIME):
+                    pass
+                changed = self._changed()
+                if changed:
+                    return changed
+            self.waiter.wait()
+
+    def close(self):
+        self.waiter.close()
+
+
+def wait_for_changes(paths):
+    ''' Waits for some of paths to change and then stop changing.
+        Returns the set of those that changed. '''
+    watcher = Watcher(paths)
+    try:
+        return watcher.wait_for_changes()
+    finally:
+        watcher.close()
+
+
+def _build_all(names, build):
+    ''' Builds each of the targets named by names with build(target),
+        printing how long each took '''
+    # The build log remembers the stat info of the files within a build
+    buildlog.get().forget_stats()
+    for name in names:
+        target = targets.Targets.get(name)
+        if target is None:
+            print('%s no longer exists' % name)
+            continue
+        start = time.time()
+        try:
+            build(target)
+            print('Built %s in %.2fs' % (name, time.time() - start))
+        except Exception:
+            traceback.print_exc()
+            print('FAILED to build %s after %.2fs' % (
+                name, time.time() - start))
+
+
+def _inputs(names):
+    ''' Returns (inputs, info_inputs): a dict of the inputs of each of
+        the targets named by names, and the set of the info files and
+        layouts that the targets are loaded from '''
+    inputs = {}
+    for name in names:
+        target = targets.Targets.get(name)
+        inputs[name] = set(target.get_inputs() if target else [])
+    info_inputs = set(infofile.loaded_from + keymatrix.layout_files())
+    return inputs, info_inputs
+
+
+def _all_inputs(inputs, info_inputs):
+    res = set(info_inputs)
+    for paths in inputs.values():
+        res.update(paths)
+    return sorted(res)
+
+
+def watch(names, build, dir='src'):
+    ''' Builds the targets named by names with build(target) and then
+        rebuilds them as their inputs change, until interrupted.
+        dir is where the info files are loaded from. '''
+    pending = names
+    while True:
+        # Start watching before we build, so that we see the files that
+        # are saved while the build is running
+        inputs, info_inputs = _inputs(names)
+        watcher = Watcher(_all_inputs(inputs, info_inputs))
+        try:
+            _build_all(pending, build)
+
+            # The build may have found more headers
+            inputs, info_inputs = _inputs(names)
+            all_inputs = _all_inputs(inputs, info_inputs)
+            watcher.add(all_inputs)
+
+            print('Watching %d files for changes' % len(all_inputs))
+            changed = watcher.wait_for_changes()
+        finally:
+            watcher.close()
+
+        for path in sorted(changed):
+            print('Changed: %s' % path)
+
+        if changed & info_inputs:
+            print('Reloading the info files')
+            try:
+                infofile.reload_info_files(dir)
+            except Exception:
+                traceback.print_exc()
+                pending = []
+                continue
+
+        pending = [name for name in names if inputs[name] & changed]